@@ -0,0 +1,272 @@
+"""
+airports.py
+This module provides AirportRegistry, the airports with valid coordinates
+held in NumPy arrays with a latitude/longitude grid index. It answers
+nearest-airport, radius and bounding-box queries by looking only at the
+grid cells that can contain a match.
+Dependencies:
+- numpy
+"""
+
+import logging
+import math
+import numpy as np
+
+EARTH_RADIUS_KM = 6371.0088
+GRID_CELL_DEGREES = 2.0  # Size of a grid cell in degrees of latitude and longitude
+AIRPORT_FIELDS = ('AIRPORT', 'CITY', 'STATE')  # Descriptive columns kept per airport
+
+
+def haversine_km(latitude, longitude, latitudes, longitudes):
+    """
+    Great-circle distances from one point to many.
+    :param latitude: Latitude of the point in degrees.
+    :param longitude: Longitude of the point in degrees.
+    :param latitudes: Array of latitudes in degrees.
+    :param longitudes: Array of longitudes in degrees.
+    :return: Array of distances in kilometres.
+    """
+    lat1, lon1 = math.radians(latitude), math.radians(longitude)
+    lat2, lon2 = np.radians(latitudes), np.radians(longitudes)
+    sin_lat = np.sin((lat2 - lat1) / 2)
+    sin_lon = np.sin((lon2 - lon1) / 2)
+    a = sin_lat ** 2 + math.cos(lat1) * np.cos(lat2) * sin_lon ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def _parse_coordinate(value, limit):
+    """Return a coordinate as a float, or None if it is missing or invalid."""
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+    return value if math.isfinite(value) and -limit <= value <= limit else None
+
+
+class AirportRegistry:
+    """
+    Airports with valid coordinates, stored in NumPy arrays and indexed by a
+    uniform latitude/longitude grid.
+    """
+    def __init__(self, rows, cell_degrees=GRID_CELL_DEGREES):
+        """
+        Build the registry from rows of the airports table. Rows with
+        missing or invalid coordinates are logged and left out.
+
+        :param rows: Iterable of dictionaries with IATA_CODE, LATITUDE,
+                     LONGITUDE and optionally AIRPORT, CITY and STATE.
+        :param cell_degrees: Size of a grid cell in degrees.
+        """
+        codes, latitudes, longitudes, details = [], [], [], []
+        for row in rows:
+            latitude = _parse_coordinate(row['LATITUDE'], 90)
+            longitude = _parse_coordinate(row['LONGITUDE'], 180)
+            if latitude is None or longitude is None:
+                logging.warning("Missing or invalid coordinates for %s: %s, %s",
+                                row['IATA_CODE'], row['LATITUDE'], row['LONGITUDE'])
+                continue
+            codes.append(row['IATA_CODE'])
+            latitudes.append(latitude)
+            longitudes.append(longitude)
+            details.append({name: row.get(name) for name in AIRPORT_FIELDS})
+
+        self._codes = codes
+        self._details = details
+        self._positions = {code: position for position, code in enumerate(codes)}
+        self.latitudes = np.array(latitudes, dtype=np.float64)
+        self.longitudes = np.array(longitudes, dtype=np.float64)
+
+        # Grid index: airport positions sorted by cell, and per occupied cell
+        # its row, column and slice of the sorted positions
+        self._cell_degrees = cell_degrees
+        self._rows = math.ceil(180 / cell_degrees)
+        self._columns = math.ceil(360 / cell_degrees)
+        cells = (self._cell_rows(self.latitudes) * self._columns
+                 + self._cell_columns(self.longitudes))
+        self._order = np.argsort(cells, kind='stable')
+        occupied, starts = np.unique(cells[self._order], return_index=True)
+        self._cell_row = occupied // self._columns
+        self._cell_column = occupied % self._columns
+        self._cell_start = starts
+        self._cell_end = np.append(starts[1:], len(codes))
+
+
+    def __len__(self):
+        return len(self._codes)
+
+
+    def __contains__(self, code):
+        return code in self._positions
+
+
+    def coordinates(self, code):
+        """
+        Look up the coordinates of an airport.
+        :param code: IATA code.
+        :return: Tuple of (latitude, longitude), or None if unknown.
+        """
+        position = self._positions.get(code)
+        if position is None:
+            return None
+        return float(self.latitudes[position]), float(self.longitudes[position])
+
+
+    def as_dict(self):
+        """
+        Return the coordinates of all airports.
+        :return: Dictionary with airport IATA codes as keys and tuples of
+                 (latitude, longitude) as values.
+        """
+        return {code: (float(latitude), float(longitude)) for code, latitude, longitude
+                in zip(self._codes, self.latitudes, self.longitudes)}
+
+
+    def _cell_rows(self, latitudes):
+        """Grid rows of latitudes."""
+        rows = np.floor((np.asarray(latitudes) + 90) / self._cell_degrees).astype(np.int64)
+        return np.clip(rows, 0, self._rows - 1)
+
+
+    def _cell_columns(self, longitudes):
+        """Grid columns of longitudes, wrapping around the antimeridian."""
+        columns = np.floor((np.asarray(longitudes) + 180) / self._cell_degrees)
+        return columns.astype(np.int64) % self._columns
+
+
+    def _candidates(self, first_row, last_row, first_column, last_column):
+        """
+        Positions of the airports in a block of grid cells. Column ranges
+        may run past either edge of the grid and wrap around.
+        :return: Array of airport positions.
+        """
+        rows = (self._cell_row >= first_row) & (self._cell_row <= last_row)
+        if last_column - first_column + 1 >= self._columns:
+            columns = np.ones_like(rows)
+        else:
+            first, last = first_column % self._columns, last_column % self._columns
+            if first <= last:
+                columns = (self._cell_column >= first) & (self._cell_column <= last)
+            else:
+                columns = (self._cell_column >= first) | (self._cell_column <= last)
+        cells = np.flatnonzero(rows & columns)
+        if not len(cells):
+            return np.empty(0, dtype=np.int64)
+        return np.concatenate([self._order[self._cell_start[cell]:self._cell_end[cell]]
+                               for cell in cells])
+
+
+    def _results(self, positions, distances=None):
+        """Build the result dictionaries of airport positions."""
+        results = []
+        for index, position in enumerate(positions):
+            result = {'IATA_CODE': self._codes[position], **self._details[position],
+                      'LATITUDE': float(self.latitudes[position]),
+                      'LONGITUDE': float(self.longitudes[position])}
+            if distances is not None:
+                result['DISTANCE_KM'] = float(distances[index])
+            results.append(result)
+        return results
+
+
+    def nearest(self, latitude, longitude, count=1):
+        """
+        Find the airports closest to a point. The search grows a block of
+        grid cells around the point until no airport outside the block can
+        be closer than the count-th airport found.
+        :param latitude: Latitude in degrees.
+        :param longitude: Longitude in degrees.
+        :param count: Number of airports to return.
+        :return: List of airport dictionaries with DISTANCE_KM, nearest first.
+        """
+        count = min(count, len(self))
+        if count < 1:
+            return []
+        row = int(self._cell_rows(latitude))
+        column = int(self._cell_columns(longitude))
+        ring = 0
+        while True:
+            candidates = self._candidates(row - ring, row + ring, column - ring, column + ring)
+            covers_all = (row - ring <= 0 and row + ring >= self._rows - 1
+                          and 2 * ring + 1 >= self._columns)
+            if len(candidates) >= count:
+                distances = haversine_km(latitude, longitude, self.latitudes[candidates],
+                                         self.longitudes[candidates])
+                nearest = np.argsort(distances, kind='stable')[:count]
+                if covers_all or distances[nearest[-1]] <= self._clearance_km(
+                        latitude, longitude, row, column, ring):
+                    return self._results(candidates[nearest], distances[nearest])
+            ring += 1
+
+
+    def _clearance_km(self, latitude, longitude, row, column, ring):
+        """
+        Lower bound of the distance from a point to any airport outside the
+        block of cells within ring cells of its own cell.
+        """
+        south = (row - ring) * self._cell_degrees - 90
+        north = (row + ring + 1) * self._cell_degrees - 90
+        gaps = [math.radians(latitude - south) if south > -90 else math.inf,
+                math.radians(north - latitude) if north < 90 else math.inf]
+        west = (column - ring) * self._cell_degrees - 180
+        east = (column + ring + 1) * self._cell_degrees - 180
+        if 2 * ring + 1 < self._columns:
+            # Distance from the point to the half-meridians bounding the
+            # block, which meet at the poles
+            longitude_gap = math.radians(min(longitude - west, east - longitude, 90))
+            gaps += [math.asin(math.cos(math.radians(latitude)) * math.sin(longitude_gap)),
+                     math.radians(90 - abs(latitude))]
+        return min(gaps) * EARTH_RADIUS_KM
+
+
+    def within_radius(self, latitude, longitude, radius_km):
+        """
+        Find the airports within a distance of a point.
+        :param latitude: Latitude in degrees.
+        :param longitude: Longitude in degrees.
+        :param radius_km: Radius in kilometres.
+        :return: List of airport dictionaries with DISTANCE_KM, nearest first.
+        """
+        angle = radius_km / EARTH_RADIUS_KM
+        south, north = latitude - math.degrees(angle), latitude + math.degrees(angle)
+        cos_latitude = math.cos(math.radians(latitude))
+        if angle < math.pi / 2 and math.sin(angle) < cos_latitude:
+            half_width = math.degrees(math.asin(math.sin(angle) / cos_latitude))
+        else:
+            half_width = 180
+        candidates = self._candidates(
+            int(self._cell_rows(max(south, -90))), int(self._cell_rows(min(north, 90))),
+            int(np.floor((longitude - half_width + 180) / self._cell_degrees)),
+            int(np.floor((longitude + half_width + 180) / self._cell_degrees)))
+        distances = haversine_km(latitude, longitude, self.latitudes[candidates],
+                                 self.longitudes[candidates])
+        inside = np.flatnonzero(distances <= radius_km)
+        inside = inside[np.argsort(distances[inside], kind='stable')]
+        return self._results(candidates[inside], distances[inside])
+
+
+    def within_bbox(self, south, west, north, east):
+        """
+        Find the airports inside a bounding box, e.g. a map viewport. Boxes
+        with west greater than east cross the antimeridian.
+        :param south: Southern latitude in degrees.
+        :param west: Western longitude in degrees.
+        :param north: Northern latitude in degrees.
+        :param east: Eastern longitude in degrees.
+        :return: List of airport dictionaries, ordered by IATA code.
+        """
+        first_column = int(np.floor((west + 180) / self._cell_degrees))
+        last_column = min(int(np.floor((east + 180) / self._cell_degrees)),
+                          self._columns - 1)
+        if west > east:
+            last_column += self._columns
+        candidates = self._candidates(int(self._cell_rows(south)), int(self._cell_rows(north)),
+                                      first_column, last_column)
+        latitudes = self.latitudes[candidates]
+        longitudes = self.longitudes[candidates]
+        inside = (latitudes >= south) & (latitudes <= north)
+        if west <= east:
+            inside &= (longitudes >= west) & (longitudes <= east)
+        else:
+            inside &= (longitudes >= west) | (longitudes <= east)
+        positions = sorted(candidates[inside], key=lambda position: self._codes[position])
+        return self._results(positions)
@@ -15,18 +15,570 @@ Dependencies:
 The application is configured to run on port 5000 by default with debugging enabled.
 """
 
-from flask import Flask, request, jsonify, render_template
+import hashlib
+import hmac
+import itertools
+import os
+import time
+from datetime import date
+from functools import wraps
+from flask import (Flask, Response, g, make_response, request, jsonify, render_template,
+                   send_from_directory)
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
-from data import FlightData
+import metrics
+import profiling
+from cache import LRUCache
+from data import DELAY_QUANTILES, QUANTILE_DIMENSIONS, TOP_K, Rows, create_flight_data
+from prerender import MANIFEST_NAME, PRERENDER_DIR
+
+
+class TimedJSONProvider(DefaultJSONProvider):
+    """
+    JSON provider reporting the time spent encoding to the request profile,
+    as its serialization phase.
+    """
+    def dumps(self, obj, **kwargs):
+        if not profiling.active():
+            return super().dumps(obj, **kwargs)
+        with profiling.phase('serialization'):
+            return super().dumps(obj, **kwargs)
 
 
 app = Flask(__name__)
+app.json = TimedJSONProvider(app)
 CORS(app)
 
 
 # Initialize FlightData
-DB_URI = 'sqlite:///data/flights.sqlite3'
-data_manager = FlightData(DB_URI)
+DB_URI = os.environ.get('FLIGHT_DATA_DB', 'sqlite:///data/flights.sqlite3')
+# 'sql' queries SQLite directly, 'columnar' serves from in-memory arrays,
+# 'partitioned' reads the monthly partitions built by partitions.py
+DATA_BACKEND = os.environ.get('FLIGHT_DATA_BACKEND', 'sql')
+# Connection profile from data.CONNECTION_PROFILES, e.g. 'read_heavy'
+CONNECTION_PROFILE = os.environ.get('FLIGHT_DATA_PROFILE', 'default')
+data_manager = create_flight_data(DB_URI, DATA_BACKEND, CONNECTION_PROFILE)
+
+# SQL statements slower than this are logged with their parameters, to the
+# file in FLIGHT_DATA_SLOW_QUERY_LOG if set
+SLOW_QUERY_MS = float(os.environ.get('FLIGHT_DATA_SLOW_QUERY_MS', metrics.SLOW_QUERY_MS))
+metrics.configure_slow_query_log(SLOW_QUERY_MS, os.environ.get('FLIGHT_DATA_SLOW_QUERY_LOG'))
+
+# Requests are profiled on demand, with the X-Profile header or the profile
+# query parameter, only when FLIGHT_DATA_PROFILING=1. If a token is set, the
+# request must also carry it in X-Profile-Token or profile_token.
+PROFILING_ENABLED = os.environ.get('FLIGHT_DATA_PROFILING') == '1'
+PROFILING_TOKEN = os.environ.get('FLIGHT_DATA_PROFILING_TOKEN')
+PROFILE_DIR = os.environ.get('FLIGHT_DATA_PROFILE_DIR', 'profiles')
+# 'save' (or '1') writes the stats to PROFILE_DIR and returns the normal
+# response; 'stats' also replaces the response with the stats summary
+PROFILE_MODES = ('1', 'save', 'stats')
+
+# Row-returning endpoints are paginated on flight ID
+DEFAULT_PAGE_SIZE = 500
+MAX_PAGE_SIZE = 5000
+MAX_BATCH_IDS = 50_000  # Flight IDs accepted by one /flights/batch request
+MAX_NEAREST_AIRPORTS = 100  # Largest count accepted by /airports/nearest
+MAX_QUANTILES = 20  # Quantiles accepted by one /stats/delay-quantiles request
+MAX_TOP_K = 1000  # Largest k accepted by the /top endpoints
+# Dimension of FlightData.get_top_delayed() served by each /top endpoint
+TOP_ENDPOINTS = {'routes': 'route', 'airports': 'airport', 'airlines': 'airline'}
+HEATMAP_FORMATS = ('records', 'matrix', 'columnar')  # Encodings of /heatmap
+# Charts rendered by prerender.py, served under /charts
+CHARTS_DIR = os.path.join(app.root_path,
+                          os.environ.get('FLIGHT_DATA_CHARTS', PRERENDER_DIR))
+
+# List responses are streamed as a chunked JSON array, or as newline-delimited
+# JSON when the client asks for it with the Accept header
+NDJSON_MIMETYPE = 'application/x-ndjson'
+# Separators of jsonify's compact output, so that streamed and buffered
+# bodies are encoded alike
+JSON_SEPARATORS = (',', ':')
+STREAM_CHUNK_ROWS = 200  # Rows serialized per chunk written to the client
+# Encodings of list responses: one object per row, or the column names once
+# and one array per row
+ROW_FORMATS = ('records', 'columnar')
+
+
+def wants_ndjson():
+    """
+    Check whether the client prefers NDJSON over JSON.
+
+    Returns:
+    bool: True if the Accept header ranks application/x-ndjson highest.
+    """
+    best = request.accept_mimetypes.best_match(['application/json', NDJSON_MIMETYPE])
+    return best == NDJSON_MIMETYPE
+
+
+def wants_columnar():
+    """
+    Check whether the client asked for rows in the columnar format.
+
+    Parameters:
+    format (str): 'records' (default) or 'columnar', passed as a query
+    parameter.
+
+    Returns:
+    bool: True if the format is 'columnar'.
+
+    Raises:
+    ValueError: If the format is not one of ROW_FORMATS.
+    """
+    output_format = request.args.get('format', 'records')
+    if output_format not in ROW_FORMATS:
+        raise ValueError(f"Unknown format: {output_format}")
+    return output_format == 'columnar'
+
+
+# Rendered responses are cached per URL and representation. Entries are
+# dropped when the database file changes, after CACHE_TTL seconds, or when
+# the cache outgrows its bounds.
+CACHE_MAX_ENTRIES = 256
+CACHE_MAX_BYTES = 64 * 1024 * 1024
+CACHE_MAX_ENTRY_BYTES = 4 * 1024 * 1024  # Larger bodies are sent but not cached
+CACHE_TTL = 3600  # Seconds
+AGGREGATE_MAX_AGE = 3600  # Cache-Control max-age of aggregate endpoints
+LOOKUP_MAX_AGE = 300  # Cache-Control max-age of row-returning endpoints
+
+response_cache = LRUCache(CACHE_MAX_ENTRIES, ttl=CACHE_TTL,
+                          max_size=CACHE_MAX_BYTES,
+                          sizeof=lambda entry: len(entry[0]))
+_cached_data_version = {'value': None}
+
+
+def cached(max_age, store=True):
+    """
+    Decorator adding HTTP caching to a route.
+
+    The ETag is derived from the database version and the request, so a
+    client revalidating with If-None-Match gets 304 Not Modified without
+    the route running at all. With store=True the rendered body is also
+    kept in response_cache, up to CACHE_MAX_ENTRY_BYTES; streamed bodies
+    are copied into the cache as their chunks are sent.
+
+    Parameters:
+    max_age (int): Cache-Control max-age in seconds.
+    store (bool): Keep rendered bodies in the server-side cache. Disable for
+    routes whose responses are large and rarely repeated.
+
+    Returns:
+    function: The decorator.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            version = data_manager.data_version()
+            if version != _cached_data_version['value']:
+                response_cache.clear()
+                _cached_data_version['value'] = version
+            key = (request.path, tuple(sorted(request.args.items(multi=True))),
+                   wants_ndjson())
+            etag = hashlib.sha1(repr((version, key)).encode()).hexdigest()
+            # A profiled request always runs the route, to measure it
+            profiled = 'profile' in g
+
+            if not profiled and request.if_none_match.contains(etag):
+                metrics.RESPONSE_CACHE.inc(request.url_rule.rule, 'not_modified')
+                response = Response(status=304)
+            elif store and not profiled and (entry := response_cache.get(key)) is not None:
+                metrics.RESPONSE_CACHE.inc(request.url_rule.rule, 'hit')
+                response = Response(entry[0], mimetype=entry[1])
+            else:
+                if store:
+                    metrics.RESPONSE_CACHE.inc(request.url_rule.rule, 'miss')
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+                if store and response.is_streamed:
+                    response.response = _cached_chunks(response.response, key,
+                                                       response.mimetype, version)
+                elif store and response.calculate_content_length() <= CACHE_MAX_ENTRY_BYTES:
+                    response_cache.set(key, (response.get_data(), response.mimetype))
+
+            response.set_etag(etag)
+            response.cache_control.public = True
+            response.cache_control.max_age = max_age
+            response.vary.add('Accept')
+            return response
+        return wrapper
+    return decorator
+
+
+def _cached_chunks(chunks, key, mimetype, version):
+    """
+    Pass the chunks of a streamed response through, storing the body in
+    response_cache once the last chunk has been sent. Bodies larger than
+    CACHE_MAX_ENTRY_BYTES, and responses the client did not read to the
+    end, are not stored.
+    """
+    parts, size = [], 0
+    try:
+        for chunk in chunks:
+            if parts is not None:
+                part = chunk.encode() if isinstance(chunk, str) else chunk
+                size += len(part)
+                if size <= CACHE_MAX_ENTRY_BYTES:
+                    parts.append(part)
+                else:
+                    parts = None
+            yield chunk
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+    # Not stored if the database changed while the body was generated
+    if parts is not None and _cached_data_version['value'] == version:
+        response_cache.set(key, (b''.join(parts), mimetype))
+
+
+@app.before_request
+def start_request_timer():
+    """Note when the request started, for the latency metrics."""
+    g.request_started = time.perf_counter()
+    metrics.start_request()
+
+
+def _record_request(route, method, started, status, size, query_methods):
+    """
+    Record the latency, status and response size of a request, and the
+    response size under the query methods it called.
+    """
+    metrics.REQUEST_SECONDS.observe(time.perf_counter() - started, route, method)
+    metrics.REQUESTS.inc(route, method, str(status))
+    metrics.RESPONSE_BYTES.inc(route, amount=size)
+    metrics.record_response(query_methods, size)
+
+
+def _measured_chunks(chunks, route, method, started, status, query_methods):
+    """
+    Pass the chunks of a streamed response through, recording the request
+    once the last chunk has been sent.
+    """
+    size = 0
+    try:
+        for chunk in chunks:
+            size += len(chunk) if isinstance(chunk, bytes) or chunk.isascii() \
+                else len(chunk.encode())
+            yield chunk
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+        _record_request(route, method, started, status, size, query_methods)
+
+
+@app.after_request
+def record_request_metrics(response):
+    """
+    Record the request in the metrics. Streamed responses are recorded
+    when their last chunk has been sent, so that the latency covers the
+    whole response.
+
+    Parameters:
+    response (flask.Response): The response.
+
+    Returns:
+    flask.Response: The same response.
+    """
+    started = g.get('request_started')
+    if started is None:
+        return response
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    query_methods = metrics.request_methods()
+    if response.is_streamed and response.content_length is None:
+        response.response = _measured_chunks(response.response, route, request.method,
+                                             started, response.status_code, query_methods)
+    else:
+        _record_request(route, request.method, started, response.status_code,
+                        response.content_length or response.calculate_content_length() or 0,
+                        query_methods)
+    return response
+
+
+@app.before_request
+def start_profile():
+    """
+    Start profiling the request if profiling is enabled and the request
+    asks for it. Only one request is profiled at a time; others run
+    unprofiled.
+    """
+    mode = request.headers.get('X-Profile') or request.args.get('profile')
+    if not PROFILING_ENABLED or mode not in PROFILE_MODES:
+        return
+    if PROFILING_TOKEN:
+        token = request.headers.get('X-Profile-Token') or request.args.get('profile_token', '')
+        if not hmac.compare_digest(token.encode(), PROFILING_TOKEN.encode()):
+            return
+    profile = profiling.RequestProfile()
+    if profile.start():
+        g.profile = profile
+        g.profile_mode = mode
+
+
+@app.after_request
+def finish_profile(response):
+    """
+    Stop the profile of a profiled request and save it. Streamed bodies
+    are generated first, so that the profile covers them. The phase
+    timings are sent in the Server-Timing header.
+
+    Parameters:
+    response (flask.Response): The response.
+
+    Returns:
+    flask.Response: The response, or the stats summary in 'stats' mode.
+    """
+    profile = g.pop('profile', None)
+    if profile is None:
+        return response
+    try:
+        response.get_data()
+    finally:
+        profile.stop()
+    path = profile.save(PROFILE_DIR, request.endpoint or 'unmatched')
+    if g.profile_mode == 'stats':
+        response = jsonify({'phases_ms': profile.breakdown_ms(),
+                            'top_functions': profile.top_functions(),
+                            'profile_file': path})
+    response.headers['Server-Timing'] = profile.server_timing()
+    response.headers['X-Profile-File'] = path
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+
+@app.teardown_request
+def stop_profile(_error):
+    """Stop the profile of a request that failed before after_request."""
+    profile = g.pop('profile', None)
+    if profile is not None:
+        profile.stop()
+
+
+def get_page_arguments():
+    """
+    Read the keyset pagination parameters from the query string.
+
+    Parameters:
+    limit (str): Page size, defaults to DEFAULT_PAGE_SIZE and is capped
+    at MAX_PAGE_SIZE. NDJSON responses are streamed, so for them the limit
+    is not capped and no limit means every matching flight.
+    after (str): Cursor returned as 'next_cursor' by the previous page.
+
+    Returns:
+    tuple: (limit, after), after is None for the first page.
+
+    Raises:
+    ValueError: If a parameter is not a valid integer or limit is not positive.
+    """
+    ndjson = wants_ndjson()
+    limit = request.args.get('limit')
+    if limit is None:
+        limit = None if ndjson else DEFAULT_PAGE_SIZE
+    else:
+        limit = int(limit)
+        if limit < 1:
+            raise ValueError("limit must be positive")
+        if not ndjson:
+            limit = min(limit, MAX_PAGE_SIZE)
+    after = request.args.get('after')
+    return limit, (int(after) if after else None)
+
+
+def get_date_range():
+    """
+    Read a range of dates from the query string.
+
+    Parameters:
+    from (str): First date, YYYY-MM-DD.
+    to (str): Last date, YYYY-MM-DD, included. Defaults to from.
+
+    Returns:
+    tuple: (start, end) dates, or None if from is not given.
+
+    Raises:
+    ValueError: If a date is invalid or to is before from.
+    """
+    if 'from' not in request.args:
+        return None
+    start = date.fromisoformat(request.args['from'])
+    end = date.fromisoformat(request.args.get('to', request.args['from']))
+    if end < start:
+        raise ValueError("to is before from")
+    return start, end
+
+
+def _chunked(pieces):
+    """
+    Join serialized rows into chunks of STREAM_CHUNK_ROWS rows so that each
+    write to the client carries more than one row.
+
+    Parameters:
+    pieces (iterable): Serialized rows.
+
+    Yields:
+    str: Joined chunks.
+    """
+    chunk = []
+    for piece in pieces:
+        chunk.append(piece)
+        if len(chunk) == STREAM_CHUNK_ROWS:
+            yield ''.join(chunk)
+            chunk = []
+    if chunk:
+        yield ''.join(chunk)
+
+
+def _to_json(value):
+    """Serialize a value for a streamed body, compact like jsonify."""
+    return app.json.dumps(value, separators=JSON_SEPARATORS)
+
+
+def _json_items(rows):
+    """Yield rows serialized as comma-separated JSON array items."""
+    for index, row in enumerate(rows):
+        yield (',' if index else '') + _to_json(row)
+
+
+def _json_array_chunks(rows):
+    """Yield rows as a JSON array."""
+    yield '['
+    yield from _chunked(_json_items(rows))
+    yield ']'
+
+
+def _ndjson_chunks(rows):
+    """Yield rows as newline-delimited JSON."""
+    return _chunked(_to_json(row) + '\n' for row in rows)
+
+
+def _page_chunks(rows, limit):
+    """
+    Yield one page of flights as a JSON object with the cursor for the next
+    page, which is only known once the last row has been written.
+    """
+    last = {'count': 0, 'flight_id': None}
+
+    def tracked(rows):
+        for row in rows:
+            last['count'] += 1
+            last['flight_id'] = row['FLIGHT_ID']
+            yield row
+
+    yield '{"results":['
+    yield from _chunked(_json_items(tracked(rows)))
+    next_cursor = last['flight_id'] if last['count'] == limit else None
+    yield '],"next_cursor":' + _to_json(next_cursor) + '}'
+
+
+def _as_columnar(rows):
+    """
+    Return rows as a Rows result, taking the column names of rows given as
+    dictionaries from the first row.
+    """
+    if isinstance(rows, Rows):
+        return rows
+    rows = iter(rows)
+    first = next(rows, None)
+    if first is None:
+        return Rows((), [])
+    columns = tuple(first)
+    return Rows(columns, (tuple(row[column] for column in columns)
+                          for row in itertools.chain([first], rows)))
+
+
+def _columnar_chunks(rows, limit=None, page=False):
+    """
+    Yield a Rows result as {"columns": [...], "rows": [[...], ...]}. A page
+    of flights also gets the cursor for the next page.
+    """
+    last = {'count': 0, 'row': None}
+
+    def tracked(rows):
+        for row in rows:
+            last['count'] += 1
+            last['row'] = row
+            yield row
+
+    yield '{"columns":' + _to_json(list(rows.columns)) + ',"rows":['
+    yield from _chunked(_json_items(tracked(rows)))
+    if not page:
+        yield ']}'
+        return
+    next_cursor = None
+    if last['count'] == limit:
+        next_cursor = last['row'][rows.columns.index('FLIGHT_ID')]
+    yield '],"next_cursor":' + _to_json(next_cursor) + '}'
+
+
+def _ndjson_columnar_chunks(rows):
+    """Yield the column names, then every row, as JSON arrays on their own lines."""
+    yield _to_json(list(rows.columns)) + '\n'
+    yield from _ndjson_chunks(rows)
+
+
+def _streamed(chunks, mimetype):
+    """Build a streaming response whose body depends on the Accept header."""
+    response = Response(chunks, mimetype=mimetype)
+    response.vary.add('Accept')
+    return response
+
+
+def rows_response(rows):
+    """
+    Stream a list of rows to the client while they are still being read
+    from the database.
+
+    Parameters:
+    rows (iterable): Rows as dictionaries, usually a FlightData generator,
+    or a Rows result.
+    format (str): Optional query parameter, 'records' (default) for one
+    object per row, or 'columnar' for
+    {"columns": [column_name, ...], "rows": [[value, ...], ...]}.
+
+    Returns:
+    flask.Response: A streamed JSON array, or NDJSON if the client
+    asked for application/x-ndjson; in the columnar format the first
+    NDJSON line is the array of column names. If the format is invalid,
+    an error message is returned with a 400 status code.
+    """
+    try:
+        columnar = wants_columnar() or isinstance(rows, Rows)
+    except ValueError:
+        return jsonify({'error': 'Invalid format'}), 400
+    if columnar:
+        rows = _as_columnar(rows)
+        if wants_ndjson():
+            return _streamed(_ndjson_columnar_chunks(rows), NDJSON_MIMETYPE)
+        return _streamed(_columnar_chunks(rows), 'application/json')
+    if wants_ndjson():
+        return _streamed(_ndjson_chunks(rows), NDJSON_MIMETYPE)
+    return _streamed(_json_array_chunks(rows), 'application/json')
+
+
+def page_response(rows, limit):
+    """
+    Stream one page of flights with the cursor for the next page.
+
+    Parameters:
+    rows (iterable): Flights of the current page, ordered by flight ID, as
+    dictionaries or as a Rows result for the columnar format.
+    limit (int): Requested page size, None if the page is unbounded.
+
+    Returns:
+    flask.Response: A streamed JSON response of the form
+    {"results": [...], "next_cursor": last_flight_id_or_null}, or
+    {"columns": [...], "rows": [[...], ...], "next_cursor": ...} for a Rows
+    result, or the flights as NDJSON if the client asked for
+    application/x-ndjson. NDJSON responses carry no cursor; the FLIGHT_ID
+    of the last line is the cursor for the next page.
+    """
+    if isinstance(rows, Rows):
+        if wants_ndjson():
+            return _streamed(_ndjson_columnar_chunks(rows), NDJSON_MIMETYPE)
+        return _streamed(_columnar_chunks(rows, limit, page=True), 'application/json')
+    if wants_ndjson():
+        return _streamed(_ndjson_chunks(rows), NDJSON_MIMETYPE)
+    return _streamed(_page_chunks(rows, limit), 'application/json')
+
 
 @app.route('/', methods=['GET'])
 def home():
@@ -44,6 +596,7 @@ def home():
     return render_template("Flight_Data_Portal.html")
 
 @app.route('/flight/<int:flight_id>', methods=['GET'])
+@cached(LOOKUP_MAX_AGE, store=False)
 def get_flight_by_id(flight_id):
     """
     Retrieves flight data by its unique identifier from the database.
@@ -59,46 +612,101 @@ def get_flight_by_id(flight_id):
     results = data_manager.get_flight_by_id(flight_id)
     return jsonify(results)
 
+@app.route('/flights/batch', methods=['POST'])
+def get_flights_by_ids():
+    """
+    Retrieves many flights at once by their unique identifiers.
+
+    Parameters:
+    ids (list): JSON request body of the form {"ids": [1, 2, 3]}, with at
+    most MAX_BATCH_IDS flight IDs.
+
+    Returns:
+    flask.Response: A JSON response with the flights keyed by ID under
+    'results' and the IDs that were not found under 'missing'. If the body
+    is not a list of integer IDs, an error message is returned with a
+    400 status code.
+    """
+    body = request.get_json(silent=True)
+    flight_ids = body.get('ids') if isinstance(body, dict) else None
+    if not isinstance(flight_ids, list) or not all(
+            isinstance(flight_id, int) and not isinstance(flight_id, bool)
+            for flight_id in flight_ids):
+        return jsonify({'error': 'Expected a JSON body with a list of integer ids'}), 400
+    if len(flight_ids) > MAX_BATCH_IDS:
+        return jsonify({'error': f'At most {MAX_BATCH_IDS} ids per request'}), 400
+
+    results = data_manager.get_flights_by_ids(flight_ids)
+    missing = [flight_id for flight_id in dict.fromkeys(flight_ids)
+               if flight_id not in results]
+    return jsonify({'results': {str(flight_id): row for flight_id, row in results.items()},
+                    'missing': missing})
+
 @app.route('/flights/date', methods=['GET'])
+@cached(LOOKUP_MAX_AGE, store=False)
 def get_flights_by_date():
     """
-    Retrieves flight data based on the specified date.
+    Retrieves flight data based on the specified date or range of dates.
 
     Parameters:
     day (str): The day of the month for which to retrieve flight data.
     month (str): The month for which to retrieve flight data.
     year (str): The year for which to retrieve flight data.
+    from (str): First date, YYYY-MM-DD, instead of day, month and year.
+    to (str): Last date, YYYY-MM-DD, included. Defaults to from. The
+        flights of a range are ordered by date and then by flight ID.
+    limit (str): Optional page size.
+    after (str): Optional cursor from the previous page.
+    format (str): Optional, 'columnar' for the column names once and one
+    array per flight instead of one object per flight.
 
     Returns:
-    flask.Response: A JSON response containing 
-    the flight data for the specified date.
-    If the required parameters are missing, 
+    flask.Response: A JSON response containing one page of
+    the flight data for the specified dates.
+    If the required parameters are missing or invalid,
     an error message is returned with a 400 status code.
     The JSON response is in the following format:
-    [
-        {
-            "flight_id": unique_flight_identifier,
-            "departure_time": departure_time,
-            "arrival_time": arrival_time,
-            "airline_name": airline_name,
-            "airport_code": airport_code,
+    {
+        "results": [
+            {
+                "FLIGHT_ID": unique_flight_identifier,
+                "DEPARTURE_TIME": departure_time,
+                "ARRIVAL_TIME": arrival_time,
+                "AIRLINE": airline_name,
+                "ORIGIN_AIRPORT": airport_code,
+                ...
+            },
             ...
-        },
-        ...
-    ]
+        ],
+        "next_cursor": flight_id_to_pass_as_after_or_null
+    }
+    With format=columnar, "results" is replaced by "columns", the list of
+    FLIGHT_COLUMNS, and "rows", one array of values per flight.
     """
     day = request.args.get('day')
     month = request.args.get('month')
     year = request.args.get('year')
 
+    try:
+        date_range = get_date_range()
+        limit, after = get_page_arguments()
+        columnar = wants_columnar()
+    except ValueError:
+        return jsonify({'error': 'Invalid parameters'}), 400
+    if date_range is not None:
+        results = data_manager.get_flights_by_date_range(*date_range, limit, after,
+                                                         stream=True, as_tuples=columnar)
+        return page_response(results, limit)
     if not (day and month and year):
         return jsonify({'error': 'Missing parameters'}), 400
 
-    results = data_manager.get_flights_by_date(day, month, year)
-    return jsonify(results)
+    results = data_manager.get_flights_by_date(day, month, year, limit, after,
+                                               stream=True, as_tuples=columnar)
+    return page_response(results, limit)
 
 
 @app.route('/delayed/airline/<string:airline_name>', methods=['GET'])
+@cached(LOOKUP_MAX_AGE, store=False)
 def get_delayed_flights_by_airline(airline_name):
     """
     Retrieves delayed flight data for a specific airline from the database.
@@ -106,30 +714,48 @@ def get_delayed_flights_by_airline(airline_name):
     Parameters:
     airline_name (str): The name of the airline for 
     which to retrieve delayed flight data.
+    limit (str): Optional page size, passed as a query parameter.
+    after (str): Optional cursor from the previous page.
+    format (str): Optional, 'columnar' for the column names once and one
+    array per flight instead of one object per flight.
 
     Returns:
-    flask.Response: A JSON response containing 
+    flask.Response: A JSON response containing one page of
     the delayed flight data for the specified airline.
     The JSON response is in the following format:
-    [
-        {
-            "flight_id": unique_flight_identifier,
-            "departure_time": departure_time,
-            "arrival_time": arrival_time,
-            "airline_name": airline_name,
-            "airport_code": airport_code,
+    {
+        "results": [
+            {
+                "FLIGHT_ID": unique_flight_identifier,
+                "DEPARTURE_TIME": departure_time,
+                "ARRIVAL_TIME": arrival_time,
+                "AIRLINE": airline_name,
+                "ORIGIN_AIRPORT": airport_code,
+                ...
+            },
             ...
-        },
-        ...
-    ]
-    If the airline with the specified name is not found, 
-    an empty JSON object is returned.
+        ],
+        "next_cursor": flight_id_to_pass_as_after_or_null
+    }
+    With format=columnar, "results" is replaced by "columns", the list of
+    FLIGHT_COLUMNS, and "rows", one array of values per flight.
+    If the airline with the specified name is not found,
+    the results list is empty.
     """
-    results = data_manager.get_delayed_flights_by_airline(airline_name)
-    return jsonify(results)
+    try:
+        limit, after = get_page_arguments()
+        columnar = wants_columnar()
+    except ValueError:
+        return jsonify({'error': 'Invalid parameters'}), 400
+
+    results = data_manager.get_delayed_flights_by_airline(airline_name, limit, after,
+                                                          stream=True,
+                                                          as_tuples=columnar)
+    return page_response(results, limit)
 
 
 @app.route('/delayed/airport/<string:airport_code>', methods=['GET'])
+@cached(LOOKUP_MAX_AGE, store=False)
 def get_delayed_flights_by_airport(airport_code):
     """
     Retrieves delayed flight data for a specific airport from the database.
@@ -137,30 +763,48 @@ def get_delayed_flights_by_airport(airport_code):
     Parameters:
     airport_code (str): The code of the airport 
     for which to retrieve delayed flight data.
+    limit (str): Optional page size, passed as a query parameter.
+    after (str): Optional cursor from the previous page.
+    format (str): Optional, 'columnar' for the column names once and one
+    array per flight instead of one object per flight.
 
     Returns:
-    flask.Response: A JSON response containing 
+    flask.Response: A JSON response containing one page of
     the delayed flight data for the specified airport.
     The JSON response is in the following format:
-    [
-        {
-            "flight_id": unique_flight_identifier,
-            "departure_time": departure_time,
-            "arrival_time": arrival_time,
-            "airline_name": airline_name,
-            "airport_code": airport_code,
+    {
+        "results": [
+            {
+                "FLIGHT_ID": unique_flight_identifier,
+                "DEPARTURE_TIME": departure_time,
+                "ARRIVAL_TIME": arrival_time,
+                "AIRLINE": airline_name,
+                "ORIGIN_AIRPORT": airport_code,
+                ...
+            },
             ...
-        },
-        ...
-    ]
-    If the airport with the specified code is not found, 
-    an empty JSON object is returned.
+        ],
+        "next_cursor": flight_id_to_pass_as_after_or_null
+    }
+    With format=columnar, "results" is replaced by "columns", the list of
+    FLIGHT_COLUMNS, and "rows", one array of values per flight.
+    If the airport with the specified code is not found,
+    the results list is empty.
     """
-    results = data_manager.get_delayed_flights_by_airport(airport_code)
-    return jsonify(results)
+    try:
+        limit, after = get_page_arguments()
+        columnar = wants_columnar()
+    except ValueError:
+        return jsonify({'error': 'Invalid parameters'}), 400
+
+    results = data_manager.get_delayed_flights_by_airport(airport_code, limit, after,
+                                                          stream=True,
+                                                          as_tuples=columnar)
+    return page_response(results, limit)
 
 
 @app.route('/delayed/airlines', methods=['GET'])
+@cached(AGGREGATE_MAX_AGE)
 def get_all_delayed_flights_grouped_by_airline():
     """
     Retrieves all delayed flight data grouped 
@@ -201,24 +845,28 @@ def get_all_delayed_flights_grouped_by_airline():
     If no delayed flights are found, 
     an empty JSON object is returned.
     """
-    results = data_manager.get_all_delayed_flights_grouped_by_airline()
-    return jsonify(results)
+    results = data_manager.get_all_delayed_flights_grouped_by_airline(stream=True)
+    return rows_response(results)
 
 @app.route('/delayed/hour', methods=['GET'])
+@cached(AGGREGATE_MAX_AGE)
 def get_delayed_flights_per_hour():
     """
-    Retrieves the number of delayed flights per hour for a specific date.
+    Retrieves the number of delayed flights per hour for a specific date,
+    or added up over a range of dates.
 
     Parameters:
     day (str): The day of the month for which to retrieve delayed flight data.
     month (str): The month for which to retrieve delayed flight data.
     year (str): The year for which to retrieve delayed flight data.
+    from (str): First date, YYYY-MM-DD, instead of day, month and year.
+    to (str): Last date, YYYY-MM-DD, included. Defaults to from.
 
     Returns:
     flask.Response: A JSON response containing the number of 
     delayed flights per hour for the specified date.
-    If the required parameters are missing, an error 
-    message is returned with a 400 status code.
+    If the required parameters are missing, or a date is invalid,
+    an error message is returned with a 400 status code.
     The JSON response is in the following format:
     [
         {
@@ -234,44 +882,207 @@ def get_delayed_flights_per_hour():
     month = request.args.get('month')
     year = request.args.get('year')
 
+    try:
+        date_range = get_date_range()
+    except ValueError:
+        return jsonify({'error': 'Invalid dates'}), 400
+    if date_range is not None:
+        return rows_response(data_manager.get_hourly_delays(*date_range, stream=True))
     if not (day and month and year):
         return jsonify({'error': 'Missing parameters'}), 400
 
-    results = data_manager.get_delayed_flights_per_hour(day, month, year)
-    return jsonify(results)
+    results = data_manager.get_delayed_flights_per_hour(day, month, year, stream=True)
+    return rows_response(results)
 
 
-@app.route('/heatmap', methods=['GET'])
-def get_flight_delays_heatmap():
+@app.route('/delayed/hourly', methods=['GET'])
+@cached(AGGREGATE_MAX_AGE)
+def get_hourly_delays():
     """
-    Retrieves flight delay data from the database and 
-    returns it in a format suitable for a heatmap visualization.
+    Retrieves the number of flights and delayed flights per hour of
+    departure over a range of dates, optionally of one airline at one
+    origin airport. Served from the delay cube when it has been built.
 
     Parameters:
-    None
+    from (str): First date, YYYY-MM-DD.
+    to (str): Last date, YYYY-MM-DD, included. Defaults to from.
+    airline (str): Optional airline name.
+    airport (str): Optional origin airport IATA code.
+
+    Returns:
+    flask.Response: A JSON response with one object per hour, in the
+    same format as /delayed/hour:
+    [
+        {
+            "hour": hour_of_day,
+            "delayed_count": number_of_delayed_flights,
+            "total_count": number_of_flights
+        },
+        ...
+    ]
+    If a date is missing or invalid, or to is before from, an error
+    message is returned with a 400 status code.
+    """
+    try:
+        date_range = get_date_range()
+    except ValueError:
+        return jsonify({'error': 'Invalid dates'}), 400
+    if date_range is None:
+        return jsonify({'error': 'Missing parameters'}), 400
+
+    results = data_manager.get_hourly_delays(*date_range, request.args.get('airline'),
+                                             request.args.get('airport'), stream=True)
+    return rows_response(results)
+
+
+@app.route('/stats/delay-quantiles', methods=['GET'])
+@cached(AGGREGATE_MAX_AGE)
+def get_delay_quantiles():
+    """
+    Retrieves quantiles of the departure delay in minutes, such as the
+    median and p99, of every route, airline or origin airport, or of all
+    flights. Served from the quantile sketches when they have been built,
+    within their rank error, and computed exactly otherwise.
+
+    Parameters:
+    by (str): Optional 'route', 'airline' or 'airport'; all flights
+    together if omitted.
+    key (str): Optional route as ORIGIN-DESTINATION (e.g. LAX-JFK),
+    airline name or origin airport code, to only return that one.
+    q (str): Optional comma-separated fractions between 0 and 1, defaults
+    to 0.5,0.9,0.99.
+
+    Returns:
+    flask.Response: A JSON response with one object per key:
+    [
+        {
+            "airline": airline_name,
+            "flights": number_of_flights_with_a_departure_delay,
+            "p50": median_delay,
+            "p90": delay,
+            "p99": delay,
+            "rank_error": largest_rank_error_as_a_fraction_of_the_flights
+        },
+        ...
+    ]
+    Routes have origin_airport and destination_airport, airports have
+    origin_airport, and all flights have no key. If a parameter is invalid,
+    or key is given without by, an error message is returned with a 400
+    status code.
+    """
+    dimension = request.args.get('by')
+    key = request.args.get('key')
+    try:
+        if dimension is not None and dimension not in QUANTILE_DIMENSIONS:
+            raise ValueError("Unknown dimension")
+        if key is not None and dimension is None:
+            raise ValueError("key needs by")
+        quantiles = DELAY_QUANTILES
+        if 'q' in request.args:
+            quantiles = tuple(float(value) for value in request.args['q'].split(','))
+        if not 0 < len(quantiles) <= MAX_QUANTILES or not all(
+                0 <= fraction <= 1 for fraction in quantiles):
+            raise ValueError("Invalid quantiles")
+    except ValueError:
+        return jsonify({'error': 'Invalid parameters'}), 400
+
+    results = data_manager.get_delay_quantiles(dimension, key, quantiles, stream=True)
+    return rows_response(results)
+
+
+@app.route('/top/<any(routes, airports, airlines):kind>', methods=['GET'])
+@cached(AGGREGATE_MAX_AGE)
+def get_top_delayed(kind):
+    """
+    Retrieves the k routes, origin airports or airlines with the highest
+    percentage of delayed flights, so that clients do not have to download
+    and sort every route of /heatmap or /average/routes.
+
+    Parameters:
+    kind (str): 'routes', 'airports' or 'airlines', part of the URL path.
+    k (int): Number of rows to return, 20 by default and at most MAX_TOP_K.
+    min_flights (int): Only rank keys with at least this many flights,
+    1 by default.
+    from (str): Optional first date, YYYY-MM-DD, to only count the flights
+    of a range of dates.
+    to (str): Last date, YYYY-MM-DD, included. Defaults to from.
 
     Returns:
-    flask.Response: A JSON response containing flight delay 
-    data in the following format:
+    flask.Response: A JSON response with the worst keys first:
     [
         {
-            "day": day_of_month,
-            "month": month,
-            "year": year,
-            "airport_code": airport_code,
-            "delay_time": average_delay_time
+            "origin_airport": origin_airport_code,
+            "destination_airport": destination_airport_code,
+            "flights": number_of_flights,
+            "delayed_flights": number_of_delayed_flights,
+            "percentage": percentage_of_delayed_flights
         },
         ...
     ]
-    The JSON response is a list of dictionaries, where each 
-    dictionary represents a day-airport combination.
-    The 'delay_time' field represents the average delay time 
-    for flights departing from the specified airport on the given day.
+    Airports have airport and airlines have airline instead of the route
+    columns. If a parameter is invalid, an error message is returned with a
+    400 status code.
+    """
+    try:
+        k = int(request.args.get('k', TOP_K))
+        min_flights = int(request.args.get('min_flights', 1))
+        if not 1 <= k <= MAX_TOP_K or min_flights < 1:
+            raise ValueError("k or min_flights out of range")
+        date_range = get_date_range() or (None, None)
+    except ValueError:
+        return jsonify({'error': 'Invalid parameters'}), 400
+
+    results = data_manager.get_top_delayed(TOP_ENDPOINTS[kind], k, min_flights,
+                                           *date_range, stream=True)
+    return rows_response(results)
+
+
+@app.route('/heatmap', methods=['GET'])
+@cached(AGGREGATE_MAX_AGE)
+def get_flight_delays_heatmap():
+    """
+    Retrieves the percentage of delayed flights of every route, for a
+    heatmap of origin against destination airports.
+
+    Parameters:
+    format (str): 'records' (default) for one object per route, or
+    'matrix' for the compact encoding:
+    {
+        "rows": [origin_airport, ...],
+        "columns": [destination_airport, ...],
+        "values": [[row_index, column_index, percentage], ...]
+    }
+    or 'columnar' for the records as column names and one array per route.
+    top_n (int): Only include routes between the top_n airports with the
+    most flights.
+    min_flights (int): Only include routes with at least this many flights.
+
+    Returns:
+    flask.Response: A JSON response with the routes. The records format is
+    a list of objects with 'origin_airport', 'destination_airport' and
+    'percentage'. If a parameter is invalid, an error message is returned
+    with a 400 status code.
     """
+    output_format = request.args.get('format', 'records')
+    try:
+        top_n = int(request.args['top_n']) if 'top_n' in request.args else None
+        min_flights = int(request.args.get('min_flights', 1))
+        if output_format not in HEATMAP_FORMATS or (top_n is not None and top_n < 1):
+            raise ValueError("Invalid heatmap parameters")
+    except ValueError:
+        return jsonify({'error': 'Invalid parameters'}), 400
+
+    if output_format == 'matrix':
+        matrix = data_manager.get_flight_delays_heatmap_matrix(top_n, min_flights)
+        return jsonify(matrix.to_dict())
+    if top_n is not None or min_flights > 1:
+        matrix = data_manager.get_flight_delays_heatmap_matrix(top_n, min_flights)
+        return rows_response(matrix.to_records())
     results = data_manager.get_flight_delays_heatmap()
-    return jsonify(results.to_dict(orient='records'))
+    return rows_response(results.to_dict(orient='records'))
 
 @app.route('/average/routes', methods=['GET'])
+@cached(AGGREGATE_MAX_AGE)
 def get_delayed_flights_average_per_route():
     """
     This function retrieves the average number of delayed flights per route 
@@ -290,10 +1101,11 @@ def get_delayed_flights_average_per_route():
         ...
     }
     """
-    results = data_manager.get_delayed_flights_average_per_route()
-    return jsonify(results)
+    results = data_manager.get_delayed_flights_average_per_route(stream=True)
+    return rows_response(results)
 
 @app.route('/route-map', methods=['GET'])
+@cached(AGGREGATE_MAX_AGE)
 def get_delayed_flights_per_route_map():
     """
     This function retrieves delayed flight data for a specific date 
@@ -303,21 +1115,185 @@ def get_delayed_flights_per_route_map():
     day (str): The day of the month for which to retrieve delayed flight data.
     month (str): The month for which to retrieve delayed flight data.
     year (str): The year for which to retrieve delayed flight data.
+    from (str): First date, YYYY-MM-DD, instead of day, month and year.
+    to (str): Last date, YYYY-MM-DD, included. Defaults to from.
 
     Returns:
     flask.Response: A JSON response containing the delayed 
-    flight data for the specified date. If the required parameters are missing,
-    an error message is returned with a 400 status code.
+    flight data for the specified dates. If the required parameters are
+    missing, or a date is invalid, an error message is returned with a 400
+    status code.
     """
     day = request.args.get('day')
     month = request.args.get('month')
     year = request.args.get('year')
 
+    try:
+        date_range = get_date_range()
+    except ValueError:
+        return jsonify({'error': 'Invalid dates'}), 400
+    if date_range is not None:
+        results = data_manager.get_delayed_flights_per_route_map_range(*date_range,
+                                                                       stream=True)
+        return rows_response(results)
     if not (day and month and year):
         return jsonify({'error': 'Missing parameters'}), 400
 
-    results = data_manager.get_delayed_flights_per_route_map(day, month, year)
-    return jsonify(results)
+    results = data_manager.get_delayed_flights_per_route_map(day, month, year,
+                                                             stream=True)
+    return rows_response(results)
+
+
+def get_float_arguments(*names):
+    """
+    Read required floating-point parameters from the query string.
+
+    Parameters:
+    names (str): Names of the parameters.
+
+    Returns:
+    list: The values, in the order of the names.
+
+    Raises:
+    ValueError: If a parameter is missing or not a finite number.
+    """
+    values = [float(request.args[name]) if name in request.args else float('nan')
+              for name in names]
+    if not all(abs(value) != float('inf') and value == value for value in values):
+        raise ValueError("Parameters must be finite numbers")
+    return values
+
+
+@app.route('/airports/nearest', methods=['GET'])
+@cached(AGGREGATE_MAX_AGE)
+def get_nearest_airports():
+    """
+    Retrieves the airports closest to a point.
+
+    Parameters:
+    lat (float): Latitude of the point.
+    lon (float): Longitude of the point.
+    count (int): Number of airports to return, 1 by default and at most
+    MAX_NEAREST_AIRPORTS.
+
+    Returns:
+    flask.Response: A JSON list of airports with their distance in
+    kilometres, nearest first. If a parameter is missing or invalid, an
+    error message is returned with a 400 status code.
+    """
+    try:
+        latitude, longitude = get_float_arguments('lat', 'lon')
+        count = int(request.args.get('count', 1))
+        if not 1 <= count <= MAX_NEAREST_AIRPORTS:
+            raise ValueError("count out of range")
+    except ValueError:
+        return jsonify({'error': 'Invalid parameters'}), 400
+    return jsonify(data_manager.get_nearest_airports(latitude, longitude, count))
+
+
+@app.route('/airports/radius', methods=['GET'])
+@cached(AGGREGATE_MAX_AGE)
+def get_airports_within_radius():
+    """
+    Retrieves the airports within a distance of a point.
+
+    Parameters:
+    lat (float): Latitude of the point.
+    lon (float): Longitude of the point.
+    radius_km (float): Radius in kilometres.
+
+    Returns:
+    flask.Response: A JSON list of airports with their distance in
+    kilometres, nearest first. If a parameter is missing or invalid, an
+    error message is returned with a 400 status code.
+    """
+    try:
+        latitude, longitude, radius_km = get_float_arguments('lat', 'lon', 'radius_km')
+        if radius_km < 0:
+            raise ValueError("radius_km must not be negative")
+    except ValueError:
+        return jsonify({'error': 'Invalid parameters'}), 400
+    return jsonify(data_manager.get_airports_within_radius(latitude, longitude, radius_km))
+
+
+@app.route('/airports/bbox', methods=['GET'])
+@cached(AGGREGATE_MAX_AGE)
+def get_airports_in_bbox():
+    """
+    Retrieves the airports inside a bounding box, such as the viewport of
+    a map.
+
+    Parameters:
+    south (float): Southern latitude.
+    west (float): Western longitude.
+    north (float): Northern latitude.
+    east (float): Eastern longitude; smaller than west for boxes crossing
+    the antimeridian.
+
+    Returns:
+    flask.Response: A JSON list of airports ordered by IATA code. If a
+    parameter is missing or invalid, an error message is returned with a
+    400 status code.
+    """
+    try:
+        south, west, north, east = get_float_arguments('south', 'west', 'north', 'east')
+    except ValueError:
+        return jsonify({'error': 'Invalid parameters'}), 400
+    return jsonify(data_manager.get_airports_in_bbox(south, west, north, east))
+
+
+@app.route('/charts', methods=['GET'])
+def get_prerendered_charts():
+    """
+    Returns the manifest of the charts rendered by prerender.py: the
+    global charts under 'charts' and the charts of every rendered date under
+    'dates', each with its file, the data version it was rendered from and
+    when. A file of null means there was no data to draw.
+
+    Parameters:
+    None
+
+    Returns:
+    flask.Response: The manifest as JSON, revalidated with its ETag. If no
+    charts have been rendered, an error message is returned with a 404
+    status code.
+    """
+    if not os.path.exists(os.path.join(CHARTS_DIR, MANIFEST_NAME)):
+        return jsonify({'error': 'No prerendered charts'}), 404
+    return send_from_directory(CHARTS_DIR, MANIFEST_NAME, max_age=0)
+
+
+@app.route('/charts/<path:filename>', methods=['GET'])
+def get_prerendered_chart(filename):
+    """
+    Serves a chart rendered by prerender.py.
+
+    Parameters:
+    filename (str): The file of the chart as listed in the manifest, e.g.
+    '2015-01-01/delayed_flights_per_hour.png'.
+
+    Returns:
+    flask.Response: The image or HTML map, or a 404 status code if it does
+    not exist.
+    """
+    return send_from_directory(CHARTS_DIR, filename, max_age=AGGREGATE_MAX_AGE)
+
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """
+    Exports the query and request metrics in the Prometheus text format:
+    latency histograms per route and per FlightData method, rows returned,
+    bytes sent, SQL time and statements, slow queries, and query and
+    response cache hits.
+
+    Parameters:
+    None
+
+    Returns:
+    flask.Response: The metrics as text/plain.
+    """
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
 
 
 # Run the Flask application
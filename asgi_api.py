@@ -0,0 +1,287 @@
+"""
+asgi_api.py
+This module serves the routes of api.py as an ASGI application. Requests are
+handled by the Flask application on bounded thread pools, so the event loop
+never waits on SQLite. Requests are classified by cost: global aggregates,
+batches of flights, ranges of dates and unlimited NDJSON streams run on their
+own small pool, and cheap lookups such as /flight/<id> or one page of flights
+keep a separate pool that the expensive requests cannot exhaust. Responses
+are streamed to the client chunk by chunk, with the same routes, headers and
+JSON shapes as api.py.
+Usage:
+    uvicorn asgi_api:app --host 0.0.0.0 --port 5000
+Dependencies:
+- uvicorn (or any other ASGI server)
+- api (Flask application and routes)
+"""
+
+import asyncio
+import io
+import logging
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+from werkzeug.exceptions import HTTPException
+import api
+
+HEAVY_WORKERS = 4  # Threads running aggregates, batches and ranges
+LIGHT_WORKERS = 16  # Threads running lookups and paginated row queries
+BODY_QUEUE_CHUNKS = 8  # Response chunks buffered ahead of a slow client
+# Largest request body read, enough for api.MAX_BATCH_IDS flight IDs; larger
+# bodies get 413 Payload Too Large
+MAX_BODY_BYTES = 2 * 1024 * 1024
+
+# Endpoints whose cost grows with the flights table or the request: global
+# aggregates, aggregates over a range of dates, and batches of up to
+# api.MAX_BATCH_IDS flights
+HEAVY_ENDPOINTS = {view.__name__ for view in (
+    api.get_flights_by_ids,
+    api.get_all_delayed_flights_grouped_by_airline,
+    api.get_hourly_delays,
+    api.get_delay_quantiles,
+    api.get_top_delayed,
+    api.get_flight_delays_heatmap,
+    api.get_delayed_flights_average_per_route,
+)}
+# Endpoints that read one day or one page of flights, unless the request asks
+# for a range of dates (from=...) or for more than a page as NDJSON
+BOUNDED_ENDPOINTS = {view.__name__ for view in (
+    api.get_flights_by_date,
+    api.get_delayed_flights_per_hour,
+    api.get_delayed_flights_by_airline,
+    api.get_delayed_flights_by_airport,
+    api.get_delayed_flights_per_route_map,
+)}
+
+
+class PooledWsgiApp:
+    """
+    ASGI application running a WSGI application on thread pools chosen
+    per endpoint.
+    """
+    def __init__(self, wsgi_app, url_map, heavy_endpoints, bounded_endpoints=(),
+                 heavy_workers=HEAVY_WORKERS, light_workers=LIGHT_WORKERS,
+                 max_body_bytes=MAX_BODY_BYTES):
+        """
+        Initialize the application.
+
+        :param wsgi_app: WSGI application handling the requests.
+        :param url_map: Werkzeug URL map used to find the endpoint of a request.
+        :param heavy_endpoints: Endpoint names that run on the heavy pool.
+        :param bounded_endpoints: Endpoint names that run on the heavy pool
+                                  only for unbounded requests.
+        :param heavy_workers: Number of threads of the heavy pool.
+        :param light_workers: Number of threads of the light pool.
+        :param max_body_bytes: Largest request body accepted.
+        """
+        self._wsgi_app = wsgi_app
+        self._url_map = url_map
+        self._heavy_endpoints = heavy_endpoints
+        self._bounded_endpoints = bounded_endpoints
+        self._max_body_bytes = max_body_bytes
+        self._heavy_pool = ThreadPoolExecutor(heavy_workers, thread_name_prefix='heavy')
+        self._light_pool = ThreadPoolExecutor(light_workers, thread_name_prefix='light')
+
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self._http(scope, receive, send)
+
+
+    async def _lifespan(self, receive, send):
+        """Acknowledge startup and shut the pools down with the server."""
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self._heavy_pool.shutdown(wait=False)
+                self._light_pool.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+
+    def _pool_for(self, scope):
+        """
+        Choose the thread pool of a request.
+        :param scope: ASGI connection scope.
+        :return: ThreadPoolExecutor.
+        """
+        try:
+            endpoint, _ = self._url_map.bind('localhost').match(scope['path'],
+                                                                method=scope['method'])
+        except HTTPException:
+            return self._light_pool
+        if endpoint in self._heavy_endpoints or \
+                (endpoint in self._bounded_endpoints and _is_unbounded(scope)):
+            return self._heavy_pool
+        return self._light_pool
+
+
+    async def _http(self, scope, receive, send):
+        """Handle an HTTP request on a pool thread and stream the response."""
+        body = await self._read_body(scope, receive)
+        if body is None:
+            await send({'type': 'http.response.start', 'status': 413,
+                        'headers': [(b'content-type', b'text/plain')]})
+            await send({'type': 'http.response.body', 'body': b'Payload Too Large'})
+            return
+
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(BODY_QUEUE_CHUNKS)
+        cancelled = threading.Event()
+
+        def emit(message):
+            asyncio.run_coroutine_threadsafe(queue.put(message), loop).result()
+
+        pool = self._pool_for(scope)
+        worker = loop.run_in_executor(pool, self._run, scope, body, emit, cancelled)
+        try:
+            while (message := await queue.get())[0] != 'end':
+                if message[0] == 'start':
+                    await send({'type': 'http.response.start',
+                                'status': message[1], 'headers': message[2]})
+                else:
+                    await send({'type': 'http.response.body',
+                                'body': message[1], 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            # If the client went away, let the worker stop at the next chunk
+            cancelled.set()
+            while not worker.done():
+                if queue.empty():
+                    await asyncio.sleep(0.01)
+                else:
+                    queue.get_nowait()
+
+
+    async def _read_body(self, scope, receive):
+        """
+        Read the body of a request, up to the largest size accepted.
+        :param scope: ASGI connection scope.
+        :param receive: ASGI receive callable.
+        :return: Body bytes, or None if it is larger than max_body_bytes.
+        """
+        for name, value in scope.get('headers', ()):
+            if name.lower() == b'content-length' and value.isdigit() \
+                    and int(value) > self._max_body_bytes:
+                return None
+        chunks, size = [], 0
+        more_body = True
+        while more_body:
+            message = await receive()
+            chunk = message.get('body', b'')
+            size += len(chunk)
+            if size > self._max_body_bytes:
+                return None
+            chunks.append(chunk)
+            more_body = message.get('more_body', False)
+        return b''.join(chunks)
+
+
+    def _run(self, scope, body, emit, cancelled):
+        """
+        Run the WSGI application and pass the response to the event loop.
+        Executed on a pool thread, so the response iterator, and with it
+        any open database cursor, stays on one thread.
+        :param scope: ASGI connection scope.
+        :param body: Request body.
+        :param emit: Function queueing a message for the event loop.
+        :param cancelled: Event set when the client is gone.
+        """
+        status = []
+
+        def start_response(status_line, headers, exc_info=None):  # pylint: disable=unused-argument
+            status[:] = [int(status_line.split(' ', 1)[0]),
+                         [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                          for name, value in headers]]
+
+        started = False
+        try:
+            chunks = self._wsgi_app(_wsgi_environ(scope, body), start_response)
+            try:
+                for chunk in chunks:
+                    if cancelled.is_set():
+                        break
+                    if not started:
+                        emit(('start', *status))
+                        started = True
+                    if chunk:
+                        emit(('body', chunk))
+            finally:
+                if hasattr(chunks, 'close'):
+                    chunks.close()
+            if not started:
+                emit(('start', *status))
+                started = True
+        except Exception:  # pylint: disable=broad-except
+            logging.exception("Error handling %s", scope['path'])
+            if not started:
+                emit(('start', 500, [(b'content-type', b'text/plain')]))
+                emit(('body', b'Internal Server Error'))
+        finally:
+            emit(('end',))
+
+
+def _is_unbounded(scope):
+    """
+    Check whether a request asks for a range of dates, or for NDJSON without
+    a limit or with one above api.MAX_PAGE_SIZE, as NDJSON is not paginated.
+    :param scope: ASGI connection scope.
+    :return: True if the request may read more than a page of flights.
+    """
+    args = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+    if 'from' in args:
+        return True
+    accept = b','.join(value for name, value in scope.get('headers', ())
+                       if name.lower() == b'accept')
+    if api.NDJSON_MIMETYPE.encode() not in accept:
+        return False
+    try:
+        return int(args['limit'][0]) > api.MAX_PAGE_SIZE
+    except (KeyError, ValueError):
+        return True
+
+
+def _wsgi_environ(scope, body):
+    """
+    Build the WSGI environ of an ASGI HTTP request.
+    :param scope: ASGI connection scope.
+    :param body: Request body.
+    :return: WSGI environ dictionary.
+    """
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', ''),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        # The whole body is buffered, so it can be read to the end also
+        # without a Content-Length, e.g. after a chunked upload
+        'wsgi.input_terminated': True,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = f"HTTP_{name}"
+        environ[name] = f"{environ[name]},{value}" if name in environ else value
+    return environ
+
+
+app = PooledWsgiApp(api.app, api.app.url_map, HEAVY_ENDPOINTS, BOUNDED_ENDPOINTS)
@@ -0,0 +1,517 @@
+"""
+benchmark.py
+This module benchmarks the API with the response cache and query
+memoization disabled, so that every request reaches SQLite.
+- profiles: throughput of every endpoint for every connection profile in
+  data.CONNECTION_PROFILES, through the Flask test client from a pool of
+  threads.
+- load: the Flask server and the ASGI server (asgi_api.py) under the same
+  mixed load, with clients running full-table aggregates while other
+  clients look up single flights. Reports the lookup latency next to the
+  throughput of both kinds of request.
+- suite: every FlightData query method and every API route, called one at
+  a time. Reports the p50/p95/p99 latency and the peak Python memory of
+  each, and compares them with a saved baseline. With --synthetic the
+  database is generated by synthetic.py, so runs are reproducible. The
+  cold import time of the entry points is measured too.
+- imports: the cold import time of main, api and data only, like
+  python -X importtime, in fresh interpreters. Fails if an entry point
+  loads the plotting or DataFrame stacks at import.
+Usage:
+    python benchmark.py profiles [--db URI] [--threads 8] [--requests 200]
+    python benchmark.py load [--db URI] [--duration 10]
+                             [--heavy-clients 8] [--light-clients 4]
+    python benchmark.py suite [--db URI | --synthetic ROWS] [--repeat 20]
+                              [--baseline FILE] [--save-baseline FILE]
+    python benchmark.py imports [--repeat 5] [--baseline FILE]
+"""
+
+import argparse
+import functools
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+from sqlalchemy.engine import make_url
+import synthetic
+from cache import LRUCache
+from data import CONNECTION_PROFILES, DEFAULT_DB_URI, FlightData, database_path
+
+LOAD_SERVERS = ('flask', 'asgi')
+SERVER_START_TIMEOUT = 60  # Seconds to wait for a server to accept requests
+HEAVY_URLS = ('delayed_airlines', 'heatmap', 'average_routes')
+SUITE_REPEAT = 20  # Timed calls per method and route
+# A p50 this much slower than the baseline, by at least REGRESSION_MIN_MS, is
+# reported as a regression
+REGRESSION_FACTOR = 1.2
+REGRESSION_MIN_MS = 1.0
+# Entry points whose cold import is timed, and the modules they must not load
+# until a feature needs them
+IMPORT_TARGETS = ('main', 'api', 'data')
+LAZY_MODULES = ('pandas', 'matplotlib', 'seaborn', 'folium')
+IMPORT_REPEAT = 5  # Fresh interpreters per entry point
+
+
+def endpoint_urls(data_manager):
+    """
+    Build one URL per API endpoint from the first flight in the database.
+    :param data_manager: FlightData instance.
+    :return: Dictionary mapping endpoint names to URLs.
+    """
+    arguments = data_manager._sample_arguments()  # pylint: disable=protected-access
+    if not arguments:
+        return {}
+    day, month, year = arguments['get_flights_by_date']
+    date = f"day={day}&month={month}&year={year}"
+    urls = {
+        'flight': f"/flight/{arguments['get_flight_by_id'][0]}",
+        'flights_by_date': f"/flights/date?{date}",
+        'delayed_by_airline':
+            f"/delayed/airline/{quote(arguments['get_delayed_flights_by_airline'][0])}",
+        'delayed_by_airport':
+            f"/delayed/airport/{arguments['get_delayed_flights_by_airport'][0]}",
+        'delayed_airlines': "/delayed/airlines",
+        'delayed_per_hour': f"/delayed/hour?{date}",
+        'heatmap': "/heatmap",
+        'average_routes': "/average/routes",
+        'route_map': f"/route-map?{date}",
+        'heatmap_matrix': "/heatmap?format=matrix",
+        'flights_columnar': f"/flights/date?{date}&format=columnar",
+    }
+    start, end, airline, airport = arguments['get_hourly_delays']
+    urls['hourly_delays'] = (f"/delayed/hourly?from={start}&to={end}"
+                             f"&airline={quote(airline)}&airport={airport}")
+    start, end = arguments['get_flights_by_date_range']
+    urls['flights_by_date_range'] = f"/flights/date?from={start}&to={end}"
+    urls['route_map_range'] = f"/route-map?from={start}&to={end}"
+    dimension, k, min_flights, start, end = arguments['get_top_delayed']
+    urls['top_routes'] = (f"/top/{dimension}s?k={k}&min_flights={min_flights}"
+                          f"&from={start}&to={end}")
+    dimension, key = arguments['get_delay_quantiles']
+    urls['delay_quantiles'] = f"/stats/delay-quantiles?by={dimension}&key={quote(key)}"
+    if 'get_nearest_airports' in arguments:
+        latitude, longitude, count = arguments['get_nearest_airports']
+        _, _, radius_km = arguments['get_airports_within_radius']
+        south, west, north, east = arguments['get_airports_in_bbox']
+        urls.update({
+            'nearest_airports': f"/airports/nearest?lat={latitude}&lon={longitude}"
+                                f"&count={count}",
+            'airports_radius': f"/airports/radius?lat={latitude}&lon={longitude}"
+                               f"&radius_km={radius_km}",
+            'airports_bbox': f"/airports/bbox?south={south}&west={west}"
+                             f"&north={north}&east={east}",
+        })
+    return urls
+
+
+def measure(app, url, threads, requests):
+    """
+    Request a URL concurrently and measure the throughput.
+    :param app: Flask application.
+    :param url: URL to request.
+    :param threads: Number of client threads.
+    :param requests: Total number of requests.
+    :return: Requests per second.
+    """
+    def fetch(_):
+        with app.test_client() as client:
+            response = client.get(url)
+            response.get_data()
+            return response.status_code
+
+    with ThreadPoolExecutor(threads) as executor:
+        started = time.perf_counter()
+        statuses = list(executor.map(fetch, range(requests)))
+        elapsed = time.perf_counter() - started
+    if any(status != 200 for status in statuses):
+        raise RuntimeError(f"{url} failed: {sorted(set(statuses))}")
+    return requests / elapsed
+
+
+def run(db_uri, threads, requests):
+    """
+    Benchmark every endpoint with every connection profile and print a table
+    of requests per second.
+    :param db_uri: Database URI.
+    :param threads: Number of client threads.
+    :param requests: Requests per endpoint and profile.
+    """
+    os.environ['FLIGHT_DATA_DB'] = db_uri
+    import api  # pylint: disable=import-outside-toplevel
+    # Every request has to reach the database
+    api.response_cache = LRUCache(0)
+
+    profiles = list(CONNECTION_PROFILES)
+    managers = {name: FlightData(db_uri, query_cache_size=0, connection_profile=name)
+                for name in profiles}
+    urls = endpoint_urls(managers[profiles[0]])
+    print(f"{threads} threads, {requests} requests per endpoint (requests/s)")
+    print(f"{'endpoint':<20}" + ''.join(f"{name:>14}" for name in profiles))
+    for endpoint, url in urls.items():
+        rates = []
+        for name in profiles:
+            api.data_manager = managers[name]
+            measure(api.app, url, threads, threads)  # Warm up the connections
+            rates.append(measure(api.app, url, threads, requests))
+        print(f"{endpoint:<20}" + ''.join(f"{rate:>14.1f}" for rate in rates))
+
+
+def serve(server, db_uri, port):
+    """
+    Run the API without caching, for the load benchmark.
+    :param server: 'flask' for the threaded Flask server, 'asgi' for uvicorn
+                   serving asgi_api.
+    :param db_uri: Database URI.
+    :param port: Port to listen on.
+    """
+    # pylint: disable=import-outside-toplevel
+    os.environ['FLIGHT_DATA_DB'] = db_uri
+    import api
+    api.response_cache = LRUCache(0)
+    api.data_manager = FlightData(db_uri, query_cache_size=0)
+    if server == 'flask':
+        api.app.run(host='127.0.0.1', port=port, threaded=True)
+    else:
+        import uvicorn
+        import asgi_api
+        uvicorn.run(asgi_api.app, host='127.0.0.1', port=port, log_level='warning')
+
+
+def _free_port():
+    """Return a TCP port that is free on localhost."""
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _wait_for_server(base_url, process):
+    """Wait until a server subprocess answers HTTP requests."""
+    deadline = time.monotonic() + SERVER_START_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("Server exited during startup")
+        try:
+            with urllib.request.urlopen(f"{base_url}/delayed/airlines", timeout=60):
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError("Server did not start in time")
+
+
+def _client(base_url, urls, stop, latencies):
+    """
+    Request URLs in turn until stop is set, recording the latencies.
+    :param base_url: Server address.
+    :param urls: URLs to cycle through.
+    :param stop: Event ending the run.
+    :param latencies: List collecting the latencies in seconds.
+    """
+    index = 0
+    while not stop.is_set():
+        started = time.perf_counter()
+        with urllib.request.urlopen(f"{base_url}{urls[index % len(urls)]}",
+                                    timeout=300) as response:
+            response.read()
+        latencies.append(time.perf_counter() - started)
+        index += 1
+
+
+def load(db_uri, duration, heavy_clients, light_clients):
+    """
+    Put the Flask and ASGI servers under the same mixed load and print the
+    lookup latency and the throughput of both kinds of request.
+    :param db_uri: Database URI.
+    :param duration: Seconds of load per server.
+    :param heavy_clients: Clients requesting full-table aggregates.
+    :param light_clients: Clients looking up single flights.
+    """
+    urls = endpoint_urls(FlightData(db_uri, query_cache_size=0))
+    heavy_urls = [urls[name] for name in HEAVY_URLS]
+    light_urls = [urls['flight']]
+    print(f"{heavy_clients} aggregate clients, {light_clients} lookup clients, "
+          f"{duration}s per server")
+    print(f"{'server':<8}{'lookups/s':>12}{'p50 ms':>10}{'p95 ms':>10}"
+          f"{'aggregates/s':>14}")
+    for server in LOAD_SERVERS:
+        port = _free_port()
+        base_url = f"http://127.0.0.1:{port}"
+        process = subprocess.Popen([sys.executable, os.path.abspath(__file__), 'serve',  # pylint: disable=consider-using-with
+                                    server, '--db', db_uri, '--port', str(port)],
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            _wait_for_server(base_url, process)
+            stop = threading.Event()
+            heavy, light = [], []
+            threads = [threading.Thread(target=_client, args=(base_url, heavy_urls, stop, heavy))
+                       for _ in range(heavy_clients)]
+            threads += [threading.Thread(target=_client, args=(base_url, light_urls, stop, light))
+                        for _ in range(light_clients)]
+            for thread in threads:
+                thread.start()
+            time.sleep(duration)
+            stop.set()
+            for thread in threads:
+                thread.join()
+        finally:
+            process.terminate()
+            process.wait()
+        percentiles = statistics.quantiles(light, n=20) if len(light) > 1 else [0] * 19
+        print(f"{server:<8}{len(light) / duration:>12.1f}{percentiles[9] * 1000:>10.1f}"
+              f"{percentiles[18] * 1000:>10.1f}{len(heavy) / duration:>14.1f}")
+
+
+def time_call(function, repeat):
+    """
+    Time a function and measure the peak Python memory of one call.
+    :param function: Function without arguments.
+    :param repeat: Number of timed calls, after one warm-up call.
+    :return: Dictionary with the p50, p95 and p99 latency in milliseconds
+             and the peak memory in KiB.
+    """
+    function()
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        samples.append((time.perf_counter() - started) * 1000)
+    # Traced separately, as tracing slows the calls down
+    tracemalloc.start()
+    try:
+        function()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    percentiles = (statistics.quantiles(samples, n=100, method='inclusive')
+                   if len(samples) > 1 else samples * 99)
+    return {'p50': percentiles[49], 'p95': percentiles[94], 'p99': percentiles[98],
+            'peak_kib': peak / 1024}
+
+
+def time_import(module, repeat, db_uri):
+    """
+    Measure the cold import time of a module in fresh interpreters, from
+    the cumulative time reported by python -X importtime.
+    :param module: Module name.
+    :param repeat: Number of interpreters.
+    :param db_uri: Database URI for modules that open it at import.
+    :return: Dictionary with the p50, p95 and p99 import time in
+             milliseconds and the LAZY_MODULES that were loaded.
+    """
+    code = (f"import sys, {module}; "
+            f"print(','.join(name for name in {LAZY_MODULES!r} if name in sys.modules))")
+    environment = dict(os.environ, FLIGHT_DATA_DB=db_uri)
+    samples = []
+    for _ in range(repeat):
+        process = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                                 cwd=os.path.dirname(os.path.abspath(__file__)),
+                                 env=environment, capture_output=True, text=True, check=True)
+        # Lines are "import time: self [us] | cumulative | imported package"
+        for line in process.stderr.splitlines():
+            fields = line.split('|')
+            if len(fields) == 3 and fields[2].rstrip() == f" {module}":
+                samples.append(int(fields[1]) / 1000)
+    percentiles = (statistics.quantiles(samples, n=100, method='inclusive')
+                   if len(samples) > 1 else samples * 99)
+    return {'p50': percentiles[49], 'p95': percentiles[94], 'p99': percentiles[98],
+            'loaded': [name for name in process.stdout.strip().split(',') if name]}
+
+
+def _regressed(result, previous):
+    """Check whether a p50 regressed against a baseline result."""
+    return (result['p50'] / max(previous['p50'], 1e-9) > REGRESSION_FACTOR
+            and result['p50'] - previous['p50'] > REGRESSION_MIN_MS)
+
+
+def imports(db_uri, repeat, previous):
+    """
+    Time the cold import of every IMPORT_TARGETS entry point and print a
+    table, comparing it with the results of a baseline.
+    :param db_uri: Database URI.
+    :param repeat: Fresh interpreters per entry point.
+    :param previous: Results of a baseline run, by target name.
+    :return: Tuple of the results by target name and the names of the
+             targets that regressed or loaded one of LAZY_MODULES.
+    """
+    print(f"Cold imports, {repeat} interpreters each (milliseconds)")
+    results, regressions = {}, []
+    for module in IMPORT_TARGETS:
+        name = f"import.{module}"
+        result = results[name] = time_import(module, repeat, db_uri)
+        line = (f"{name:<50}{result['p50']:>9.2f}{result['p95']:>9.2f}"
+                f"{result['p99']:>9.2f}")
+        if name in previous:
+            line += f"{result['p50'] / max(previous[name]['p50'], 1e-9):>19.2f}x"
+            if _regressed(result, previous[name]):
+                line += " REGRESSED"
+                regressions.append(name)
+        if result['loaded']:
+            line += f" LOADS {', '.join(result['loaded'])}"
+            regressions.append(name)
+        print(line)
+    return results, regressions
+
+
+def suite_targets(data_manager, app):
+    """
+    Build the functions timed by the suite: one per FlightData query
+    method and one per API route.
+    :param data_manager: FlightData instance, also used by the API.
+    :param app: Flask application.
+    :return: Dictionary mapping names to functions without arguments.
+    """
+    def call(method, args):
+        result = method(*args)
+        if hasattr(result, '__next__'):
+            for _ in result:
+                pass
+
+    def fetch(method, url, body=None):
+        response = client.open(url, method=method, json=body)
+        response.get_data()
+        if response.status_code != 200:
+            raise RuntimeError(f"{method} {url} failed: {response.status_code}")
+
+    client = app.test_client()
+    arguments = data_manager._sample_arguments()  # pylint: disable=protected-access
+    targets = {f"data.{name}": functools.partial(call, getattr(data_manager, name), args)
+               for name, args in arguments.items()}
+    targets.update({f"api.{name}": functools.partial(fetch, 'GET', url)
+                    for name, url in endpoint_urls(data_manager).items()})
+    if 'get_flights_by_ids' in arguments:
+        targets['api.flights_batch'] = functools.partial(
+            fetch, 'POST', '/flights/batch', {'ids': arguments['get_flights_by_ids'][0]})
+    return targets
+
+
+def suite(db_uri, repeat, baseline=None, save_baseline=None):
+    """
+    Time every FlightData query method and every API route, print a table
+    of latencies and peak memory, and compare it with a baseline.
+    :param db_uri: Database URI.
+    :param repeat: Timed calls per method and route.
+    :param baseline: JSON file of an earlier run to compare with.
+    :param save_baseline: JSON file to save the results to.
+    :return: Names of the targets whose p50 regressed against the baseline.
+    """
+    os.environ['FLIGHT_DATA_DB'] = db_uri
+    import api  # pylint: disable=import-outside-toplevel
+    api.response_cache = LRUCache(0)
+    api.data_manager = FlightData(db_uri, query_cache_size=0)
+    flights = api.data_manager._execute_query(  # pylint: disable=protected-access
+        "SELECT COUNT(*) AS count FROM flights")[0]['count']
+
+    previous = {}
+    if baseline:
+        with open(baseline, encoding='utf-8') as file:
+            previous = json.load(file)
+        if previous.get('flights') != flights:
+            print(f"Warning: the baseline was measured on {previous.get('flights')} "
+                  f"flights, this database has {flights}")
+        previous = previous.get('results', {})
+
+    print(f"{flights:,} flights, {repeat} calls per target (milliseconds)")
+    print(f"{'target':<50}{'p50':>9}{'p95':>9}{'p99':>9}{'peak KiB':>11}"
+          + (f"{'vs base':>9}" if previous else ''))
+    results, regressions = {}, []
+    for name, function in suite_targets(api.data_manager, api.app).items():
+        result = results[name] = time_call(function, repeat)
+        line = (f"{name:<50}{result['p50']:>9.2f}{result['p95']:>9.2f}"
+                f"{result['p99']:>9.2f}{result['peak_kib']:>11.0f}")
+        if name in previous:
+            ratio = result['p50'] / max(previous[name]['p50'], 1e-9)
+            line += f"{ratio:>8.2f}x"
+            if _regressed(result, previous[name]):
+                line += " REGRESSED"
+                regressions.append(name)
+        print(line)
+    print()
+    import_results, import_regressions = imports(db_uri, IMPORT_REPEAT, previous)
+    results.update(import_results)
+    regressions += import_regressions
+
+    if save_baseline:
+        os.makedirs(os.path.dirname(os.path.abspath(save_baseline)), exist_ok=True)
+        with open(save_baseline, 'w', encoding='utf-8') as file:
+            json.dump({'database': db_uri, 'flights': flights, 'repeat': repeat,
+                       'python': sys.version.split()[0], 'results': results},
+                      file, indent=2, sort_keys=True)
+        print(f"Saved the baseline to {save_baseline}")
+    return regressions
+
+
+def main():
+    """
+    Command-line entry point.
+    """
+    parser = argparse.ArgumentParser(description="Benchmark the API endpoints")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    profiles = commands.add_parser('profiles', help="Compare connection profiles")
+    profiles.add_argument('--threads', type=int, default=8, help="Client threads")
+    profiles.add_argument('--requests', type=int, default=200,
+                          help="Requests per endpoint and profile")
+
+    load_parser = commands.add_parser('load', help="Compare the Flask and ASGI servers")
+    load_parser.add_argument('--duration', type=float, default=10,
+                             help="Seconds of load per server")
+    load_parser.add_argument('--heavy-clients', type=int, default=8,
+                             help="Clients requesting aggregates")
+    load_parser.add_argument('--light-clients', type=int, default=4,
+                             help="Clients looking up single flights")
+
+    serve_parser = commands.add_parser('serve', help="Run a server for the load benchmark")
+    serve_parser.add_argument('server', choices=LOAD_SERVERS)
+    serve_parser.add_argument('--port', type=int, required=True)
+
+    suite_parser = commands.add_parser('suite', help="Time every query method and route")
+    suite_parser.add_argument('--synthetic', type=int, metavar='ROWS',
+                              help="Benchmark a synthetic database of this many flights, "
+                                   "generated by synthetic.py unless it exists")
+    suite_parser.add_argument('--repeat', type=int, default=SUITE_REPEAT,
+                              help="Timed calls per target")
+    suite_parser.add_argument('--baseline', help="Baseline JSON file to compare with")
+    suite_parser.add_argument('--save-baseline', help="Save the results as a baseline")
+
+    imports_parser = commands.add_parser('imports',
+                                         help="Time the cold import of the entry points")
+    imports_parser.add_argument('--repeat', type=int, default=IMPORT_REPEAT,
+                                help="Fresh interpreters per entry point")
+    imports_parser.add_argument('--baseline', help="Baseline JSON file to compare with")
+
+    for command in (profiles, load_parser, serve_parser, suite_parser, imports_parser):
+        command.add_argument('--db', default=DEFAULT_DB_URI, help="Database URI")
+    args = parser.parse_args()
+
+    if args.command == 'profiles':
+        run(args.db, args.threads, args.requests)
+    elif args.command == 'load':
+        load(args.db, args.duration, args.heavy_clients, args.light_clients)
+    elif args.command == 'suite':
+        db_uri = args.db
+        if args.synthetic:
+            db_uri = f"sqlite:///data/synthetic_{args.synthetic}.sqlite3"
+            if not os.path.exists(database_path(make_url(db_uri))):
+                synthetic.generate(db_uri, args.synthetic)
+        if suite(db_uri, args.repeat, args.baseline, args.save_baseline):
+            sys.exit(1)
+    elif args.command == 'imports':
+        previous = {}
+        if args.baseline:
+            with open(args.baseline, encoding='utf-8') as file:
+                previous = json.load(file).get('results', {})
+        if imports(args.db, args.repeat, previous)[1]:
+            sys.exit(1)
+    else:
+        serve(args.server, args.db, args.port)
+
+
+if __name__ == "__main__":
+    main()
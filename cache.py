@@ -0,0 +1,104 @@
+"""
+cache.py
+This module provides a small thread-safe LRU cache with optional expiry,
+used to keep rendered API responses and query results in memory.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    Least-recently-used cache bounded by entry count and, optionally,
+    by the total size of the cached values.
+    """
+    def __init__(self, max_entries=128, ttl=None, max_size=None, sizeof=None):
+        """
+        Initialize the cache.
+
+        :param max_entries: Maximum number of entries kept.
+        :param ttl: Seconds after which an entry expires, or None to keep
+                    entries until they are evicted.
+        :param max_size: Maximum total size of the values, or None.
+        :param sizeof: Function returning the size of a value; required
+                       when max_size is set.
+        """
+        self._max_entries = max_entries
+        self._ttl = ttl
+        self._max_size = max_size
+        self._sizeof = sizeof
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+
+    def get(self, key, default=None):
+        """
+        Look up a key and mark it as recently used.
+        :param key: Cache key.
+        :param default: Value returned when the key is missing or expired.
+        :return: Cached value or default.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self._ttl is not None \
+                    and time.monotonic() - entry[1] > self._ttl:
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+
+    def set(self, key, value):
+        """
+        Store a value, evicting the least recently used entries if needed.
+        Values larger than max_size on their own are not stored.
+        :param key: Cache key.
+        :param value: Value to store.
+        """
+        size = self._sizeof(value) if self._max_size is not None else 0
+        if self._max_size is not None and size > self._max_size:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, time.monotonic(), size)
+            self._size += size
+            while len(self._entries) > self._max_entries or (
+                    self._max_size is not None and self._size > self._max_size):
+                self._remove(next(iter(self._entries)))
+
+
+    def clear(self):
+        """Remove all entries."""
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+
+    def stats(self):
+        """
+        Report cache usage.
+        :return: Dictionary with hits, misses, entries and size.
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'entries': len(self._entries), 'size': self._size}
+
+
+    def __len__(self):
+        return len(self._entries)
+
+
+    def _remove(self, key):
+        """Remove an entry; the caller must hold the lock."""
+        _, _, size = self._entries.pop(key)
+        self._size -= size
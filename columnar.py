@@ -0,0 +1,430 @@
+"""
+columnar.py
+This module provides an in-memory columnar backend for flight data.
+The flights, airlines and airports tables are loaded once into NumPy arrays
+with dictionary-encoded airline and airport codes. The FlightData queries
+are then answered with vectorized masks and bincount reductions instead of
+scanning the SQLite table on every call.
+Dependencies:
+- numpy
+- pandas
+- data (FlightData class)
+"""
+
+import logging
+import time
+import numpy as np
+import pandas as pd
+from data import FlightData, Rows, FLIGHT_COLUMNS, date_ordinal
+from heatmap import RouteMatrix
+
+LOAD_BATCH_SIZE = 100_000
+ROWID_CHUNK_SIZE = 500
+DATE_ORDER = 'flights.YEAR, flights.MONTH, flights.DAY, flights.ID'  # Order of date ranges
+
+
+class ColumnarFlightData(FlightData):
+    """
+    FlightData backend that answers queries from NumPy column arrays.
+    Aggregates are computed entirely in memory; row-returning methods
+    select the matching rowids with masks and fetch only those rows.
+    """
+    def __init__(self, db_uri, connection_profile=None):
+        """
+        Initialize the backend and load the column arrays.
+
+        :param db_uri: Database URI.
+        :param connection_profile: Connection profile passed to FlightData.
+        """
+        super().__init__(db_uri, connection_profile=connection_profile)
+        self._load()
+
+
+    def _load(self):
+        """
+        Load the flights, airlines and airports tables into column arrays.
+        Airport codes are dictionary-encoded in sorted order so that grouped
+        results come out in the same order as SQLite's GROUP BY.
+        """
+        started = time.perf_counter()
+        self._load_airlines()
+
+        chunks = {name: [] for name in ('rowid', 'id', 'year', 'month', 'day',
+                                        'airline', 'delayed', 'completed')}
+        origin_chunks, destination_chunks = [], []
+        # Flights count as delayed by the condition of the SQL queries, which
+        # also covers delays that are not numbers
+        query = f"""
+        SELECT rowid, ID, YEAR, MONTH, DAY, AIRLINE,
+               ORIGIN_AIRPORT, DESTINATION_AIRPORT,
+               COALESCE({self._delayed_expr()}, 0),
+               CANCELLED = 0 AND DIVERTED = 0
+        FROM flights
+        ORDER BY rowid
+        """
+        vocabulary = {}
+        connection = self._engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            cursor.execute(query)
+            while True:
+                batch = cursor.fetchmany(LOAD_BATCH_SIZE)
+                if not batch:
+                    break
+                columns = list(zip(*batch))
+                chunks['rowid'].append(np.array(columns[0], dtype=np.int64))
+                chunks['id'].append(np.array(columns[1], dtype=np.int64))
+                chunks['year'].append(np.array(columns[2], dtype=np.int16))
+                chunks['month'].append(np.array(columns[3], dtype=np.int8))
+                chunks['day'].append(np.array(columns[4], dtype=np.int8))
+                chunks['airline'].append(np.array(columns[5], dtype=np.int32))
+                origin_chunks.append(_encode(columns[6], vocabulary))
+                destination_chunks.append(_encode(columns[7], vocabulary))
+                chunks['delayed'].append(np.array(columns[8], dtype=bool))
+                chunks['completed'].append(np.array(columns[9], dtype=bool))
+        finally:
+            connection.close()
+
+        for name, parts in chunks.items():
+            setattr(self, f'_{name}', np.concatenate(parts) if parts
+                    else np.empty(0, dtype=np.int64))
+
+        # Re-number the airport codes so that code order is label order
+        labels = sorted(vocabulary, key=vocabulary.get)
+        order = np.argsort(np.array(labels, dtype=object))
+        remap = np.empty(len(labels), dtype=np.int32)
+        remap[order] = np.arange(len(labels), dtype=np.int32)
+        self._airport_labels = np.array(labels, dtype=object)[order]
+        self._origin = _remap(origin_chunks, remap)
+        self._destination = _remap(destination_chunks, remap)
+        self._flight_date = (self._year.astype(np.int32) * 10000
+                             + self._month.astype(np.int32) * 100 + self._day)
+        self._airline_code = np.where(
+            (self._airline >= 0) & (self._airline < len(self._airline_lookup)),
+            self._airline_lookup[np.clip(self._airline, 0,
+                                         len(self._airline_lookup) - 1)],
+            -1
+        )
+        self._load_airports()
+        logging.info("Loaded %d flights into columnar backend in %.2fs",
+                     len(self._rowid), time.perf_counter() - started)
+
+
+    def _load_airlines(self):
+        """
+        Load the airlines table and build a lookup from airline ID to
+        a dictionary-encoded airline name.
+        """
+        rows = self._execute_query("SELECT ID, AIRLINE FROM airlines")
+        names = sorted({row['AIRLINE'] for row in rows})
+        name_codes = {name: code for code, name in enumerate(names)}
+        max_id = max((int(row['ID']) for row in rows), default=0)
+        self._airline_names = np.array(names, dtype=object)
+        self._airline_lookup = np.full(max_id + 1, -1, dtype=np.int32)
+        for row in rows:
+            self._airline_lookup[int(row['ID'])] = name_codes[row['AIRLINE']]
+
+
+    def _load_airports(self):
+        """
+        Load airport coordinates aligned with the airport code dictionary.
+        Airports that do not appear in the airports table are flagged so
+        that route averages drop them like the SQL inner join does.
+        """
+        rows = self._execute_query("""
+        SELECT IATA_CODE, CAST(LATITUDE AS REAL) AS LATITUDE,
+               CAST(LONGITUDE AS REAL) AS LONGITUDE
+        FROM airports
+        """)
+        positions = {code: index for index, code in enumerate(self._airport_labels)}
+        size = len(self._airport_labels)
+        self._airport_known = np.zeros(size, dtype=bool)
+        self._latitude = np.full(size, np.nan)
+        self._longitude = np.full(size, np.nan)
+        for row in rows:
+            index = positions.get(row['IATA_CODE'])
+            if index is None:
+                continue
+            self._airport_known[index] = True
+            if row['LATITUDE'] is not None:
+                self._latitude[index] = row['LATITUDE']
+            if row['LONGITUDE'] is not None:
+                self._longitude[index] = row['LONGITUDE']
+
+
+    def _fetch_flights(self, mask, limit=None, after=None, stream=False,
+                       as_tuples=False, by_date=False):
+        """
+        Fetch the full flight rows selected by a mask over the columns,
+        ordered by flight ID.
+        :param mask: Boolean array over the loaded flights.
+        :param limit: Maximum number of flights to return, or None for all.
+        :param after: Only return flights with an ID greater than this cursor.
+        :param stream: If True, return a generator instead of a list.
+        :param as_tuples: If True, return a Rows result of FLIGHT_COLUMNS
+                          tuples instead of dictionaries.
+        :param by_date: If True, order by date and then by flight ID, and
+                        return the flights after the cursor flight in that
+                        order.
+        :return: List of dictionaries containing flight details.
+        """
+        # Flights without a known airline are dropped by the SQL join
+        mask = mask & (self._airline_code >= 0)
+        if after is not None and by_date:
+            cursor = np.flatnonzero(self._id == int(after))
+            cursor_date = self._flight_date[cursor[0]] if len(cursor) else np.iinfo(np.int32).max
+            mask &= ((self._flight_date > cursor_date)
+                     | ((self._flight_date == cursor_date) & (self._id > int(after))))
+        elif after is not None:
+            mask &= self._id > int(after)
+        selected = np.flatnonzero(mask)
+        if by_date:
+            selected = selected[np.lexsort((self._id[selected], self._flight_date[selected]))]
+        else:
+            selected = selected[np.argsort(self._id[selected], kind='stable')]
+        if limit is not None:
+            selected = selected[:int(limit)]
+        rows = self._iter_flights(self._rowid[selected], as_tuples,
+                                  DATE_ORDER if by_date else 'flights.ID')
+        if not stream:
+            rows = list(rows)
+        return Rows(FLIGHT_COLUMNS, rows) if as_tuples else rows
+
+
+    def _iter_flights(self, rowids, as_tuples=False, order='flights.ID'):
+        """
+        Yield the full flight rows for the given rowids, one chunk of
+        rowids per query.
+        :param rowids: Array of flight rowids, in the order to return them.
+        :param as_tuples: If True, yield FLIGHT_COLUMNS tuples instead of
+                          dictionaries.
+        :param order: ORDER BY clause of the chunks, matching the order of
+                      the rowids.
+        :return: Generator of dictionaries containing flight details.
+        """
+        for start in range(0, len(rowids), ROWID_CHUNK_SIZE):
+            chunk = rowids[start:start + ROWID_CHUNK_SIZE]
+            params = {f'r{index}': int(rowid) for index, rowid in enumerate(chunk)}
+            placeholders = ', '.join(f':{name}' for name in params)
+            query = f"""
+            SELECT {self._flight_columns()}
+            FROM flights
+            JOIN airlines ON flights.airline = airlines.id
+            WHERE flights.rowid IN ({placeholders})
+            ORDER BY {order}
+            """
+            yield from self._execute_query(query, params, as_tuples=as_tuples)
+
+
+    def _route_keys(self, mask):
+        """
+        Combine origin and destination codes into a single group key.
+        :param mask: Boolean array selecting the flights to group.
+        :return: Array of route keys for the selected flights.
+        """
+        size = len(self._airport_labels)
+        return self._origin[mask].astype(np.int64) * size + self._destination[mask]
+
+
+    def _split_route_key(self, keys):
+        """
+        Split combined route keys back into origin and destination codes.
+        :param keys: Array of route keys.
+        :return: Tuple of (origin codes, destination codes).
+        """
+        return np.divmod(keys, len(self._airport_labels))
+
+
+    def get_flights_by_date(self, day, month, year, limit=None, after=None,
+                            stream=False, as_tuples=False):
+        """
+        Retrieve flights for a specific date, ordered by flight ID.
+        :param day: Day of the flight.
+        :param month: Month of the flight.
+        :param year: Year of the flight.
+        :param limit: Maximum number of flights to return, or None for all.
+        :param after: Only return flights with an ID greater than this cursor.
+        :param stream: If True, return a generator instead of a list.
+        :param as_tuples: If True, return a Rows result of FLIGHT_COLUMNS
+                          tuples instead of dictionaries.
+        :return: List of dictionaries containing flight details.
+        """
+        try:
+            day, month, year = int(day), int(month), int(year)
+        except ValueError:
+            return Rows(FLIGHT_COLUMNS, []) if as_tuples else []
+        mask = (self._day == day) & (self._month == month) & (self._year == year)
+        return self._fetch_flights(mask, limit, after, stream, as_tuples)
+
+
+    def get_flights_by_date_range(self, start, end, limit=None, after=None,
+                                  stream=False, as_tuples=False):
+        """
+        Retrieve the flights of a range of dates, ordered by date and then
+        by flight ID.
+        :param start: First date.
+        :param end: Last date, included.
+        :param limit: Maximum number of flights to return, or None for all.
+        :param after: Only return the flights after this cursor, the flight
+                      ID of the last flight of the previous page.
+        :param stream: If True, return a generator instead of a list.
+        :param as_tuples: If True, return a Rows result of FLIGHT_COLUMNS
+                          tuples instead of dictionaries.
+        :return: List of dictionaries containing flight details.
+        """
+        mask = ((self._flight_date >= date_ordinal(start))
+                & (self._flight_date <= date_ordinal(end)))
+        return self._fetch_flights(mask, limit, after, stream, as_tuples, by_date=True)
+
+
+    def get_delayed_flights_by_airline(self, airline_name, limit=None, after=None,
+                                       stream=False, as_tuples=False):
+        """
+        Retrieve delayed flights for a specific airline, ordered by flight ID.
+        :param airline_name: Name of the airline.
+        :param limit: Maximum number of flights to return, or None for all.
+        :param after: Only return flights with an ID greater than this cursor.
+        :param stream: If True, return a generator instead of a list.
+        :param as_tuples: If True, return a Rows result of FLIGHT_COLUMNS
+                          tuples instead of dictionaries.
+        :return: List of dictionaries containing delayed flights.
+        """
+        codes = np.flatnonzero(self._airline_names == airline_name)
+        if len(codes) == 0:
+            return Rows(FLIGHT_COLUMNS, []) if as_tuples else []
+        mask = self._delayed & (self._airline_code == codes[0])
+        return self._fetch_flights(mask, limit, after, stream, as_tuples)
+
+
+    def get_all_delayed_flights_grouped_by_airline(self, stream=False):
+        """
+        Retrieve all delayed flights grouped by airline.
+        :param stream: If True, return a generator instead of a list.
+        :return: List of dictionaries containing delayed flights by airline.
+        """
+        codes = self._airline_code[self._delayed & (self._airline_code >= 0)]
+        counts = np.bincount(codes, minlength=len(self._airline_names))
+        results = [
+            {'AIRLINE': self._airline_names[code], 'delay_count': int(counts[code])}
+            for code in np.flatnonzero(counts)
+        ]
+        return iter(results) if stream else results
+
+
+    def get_delayed_flights_by_airport(self, airport_code, limit=None, after=None,
+                                       stream=False, as_tuples=False):
+        """
+        Retrieve delayed flights for a specific airport, ordered by flight ID.
+        :param airport_code: Code of the airport.
+        :param limit: Maximum number of flights to return, or None for all.
+        :param after: Only return flights with an ID greater than this cursor.
+        :param stream: If True, return a generator instead of a list.
+        :param as_tuples: If True, return a Rows result of FLIGHT_COLUMNS
+                          tuples instead of dictionaries.
+        :return: List of dictionaries containing delayed flights.
+        """
+        index = np.searchsorted(self._airport_labels, airport_code)
+        if (index >= len(self._airport_labels)
+                or self._airport_labels[index] != airport_code):
+            return Rows(FLIGHT_COLUMNS, []) if as_tuples else []
+        return self._fetch_flights(self._delayed & (self._origin == index),
+                                   limit, after, stream, as_tuples)
+
+
+    def get_flight_delays_heatmap(self):
+        """
+        Retrieve a heatmap of flight delays between airports.
+        :return: DataFrame with origin, destination, and percentage of
+                delayed flights.
+        """
+        keys = self._route_keys(self._completed)
+        delayed = self._delayed[self._completed]
+        size = len(self._airport_labels) ** 2
+        totals = np.bincount(keys, minlength=size)
+        delays = np.bincount(keys, weights=delayed, minlength=size)
+        routes = np.flatnonzero(totals)
+        origins, destinations = self._split_route_key(routes)
+        return pd.DataFrame({
+            'origin_airport': self._airport_labels[origins],
+            'destination_airport': self._airport_labels[destinations],
+            'percentage': delays[routes] / totals[routes] * 100,
+        })
+
+
+    def get_flight_delays_heatmap_matrix(self, top_n=None, min_flights=1):
+        """
+        Retrieve the heatmap of flight delays between airports as a sparse
+        matrix, optionally limited to the busiest airports.
+        :param top_n: Only keep routes between the top_n airports with the
+                      most flights.
+        :param min_flights: Only keep routes with at least this many flights.
+        :return: RouteMatrix.
+        """
+        keys = self._route_keys(self._completed)
+        delayed = self._delayed[self._completed]
+        size = len(self._airport_labels) ** 2
+        totals = np.bincount(keys, minlength=size)
+        delays = np.bincount(keys, weights=delayed, minlength=size)
+        routes = np.flatnonzero(totals)
+        origins, destinations = self._split_route_key(routes)
+        return RouteMatrix.from_counts(self._airport_labels[origins],
+                                       self._airport_labels[destinations],
+                                       totals[routes], delays[routes], top_n, min_flights)
+
+
+    def get_delayed_flights_average_per_route(self, stream=False):
+        """
+        Retrieve average percentage of delayed flights per route.
+        :param stream: If True, return a generator instead of a list.
+        :return: List of dictionaries containing average delay percentages.
+        """
+        mask = (self._airport_known[self._origin]
+                & self._airport_known[self._destination])
+        keys = self._route_keys(mask)
+        size = len(self._airport_labels) ** 2
+        totals = np.bincount(keys, minlength=size)
+        delays = np.bincount(keys, weights=self._delayed[mask], minlength=size)
+        routes = np.flatnonzero(totals)
+        origins, destinations = self._split_route_key(routes)
+        percentages = delays[routes] * 100.0 / totals[routes]
+        results = [
+            {
+                'origin_latitude': _to_float(self._latitude[origin]),
+                'origin_longitude': _to_float(self._longitude[origin]),
+                'destination_latitude': _to_float(self._latitude[destination]),
+                'destination_longitude': _to_float(self._longitude[destination]),
+                'avg_percentage': float(percentage),
+            }
+            for origin, destination, percentage
+            in zip(origins, destinations, percentages)
+        ]
+        return iter(results) if stream else results
+
+
+def _encode(values, vocabulary):
+    """
+    Dictionary-encode a batch of strings against a growing vocabulary.
+    :param values: Sequence of string values.
+    :param vocabulary: Dictionary mapping labels to codes, updated in place.
+    :return: Array of integer codes.
+    """
+    uniques, inverse = np.unique(
+        np.array(['' if value is None else str(value) for value in values],
+                 dtype=object),
+        return_inverse=True
+    )
+    codes = np.array([vocabulary.setdefault(label, len(vocabulary))
+                      for label in uniques], dtype=np.int32)
+    return codes[inverse]
+
+
+def _remap(chunks, remap):
+    """Concatenate encoded chunks and translate them to sorted codes."""
+    if not chunks:
+        return np.empty(0, dtype=np.int32)
+    return remap[np.concatenate(chunks)]
+
+
+def _to_float(value):
+    """Convert a NumPy float to a Python float, mapping NaN to None."""
+    return None if np.isnan(value) else float(value)
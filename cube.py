@@ -0,0 +1,272 @@
+"""
+cube.py
+This module precomputes the delay cube: the number of flights and of
+delayed flights per day, hour of departure, airline and origin airport,
+stored as a NumPy array that is memory-mapped when read. Per-hour counts of
+a date, or of one airline at one airport across a month, are then sums over
+a slice of the cube instead of SQL queries grouping the flights.
+Usage:
+    python cube.py [--db sqlite:///data/flights.sqlite3]
+The cube is written next to the database, e.g. data/flights_cube/, and is
+used by FlightData as long as the database has not changed since it was
+built. Rebuild it after loading new data.
+Dependencies:
+- numpy
+- sqlalchemy
+- data (FlightData class)
+"""
+
+import argparse
+import json
+import os
+import sqlite3
+import time
+from datetime import date
+import numpy as np
+from sqlalchemy.engine import make_url
+from data import FlightData, DEFAULT_DB_URI, DEPARTURE_HOUR, database_path
+
+METADATA_NAME = 'cube.json'
+COUNTS_NAME = 'counts.npy'
+# Sums of the counts over airports, over airlines and over both, so that
+# slices not filtered on both only read the cells they need
+MARGINAL_NAMES = {'airline': 'by_airline.npy', 'airport': 'by_airport.npy',
+                  'total': 'by_hour.npy'}
+HOURS = 24
+# Flights and delayed flights per cell; no airline runs 65,535 departures
+# from one airport in one hour
+COUNT_DTYPE = np.uint16
+BUILD_BATCH_ROWS = 100_000  # Grouped rows converted to arrays at a time
+
+
+def cube_directory(db_uri):
+    """
+    Return the directory holding the cube of a database.
+    :param db_uri: Database URI or SQLAlchemy URL.
+    :return: Directory path, e.g. data/flights_cube for
+             sqlite:///data/flights.sqlite3.
+    """
+    path = database_path(make_url(db_uri))
+    return f"{os.path.splitext(path)[0]}_cube"
+
+
+class DelayCube:
+    """
+    Flight counts indexed by (day, hour, airline, origin airport, count),
+    where day is the number of days since the first date in the database
+    and count is 0 for all flights and 1 for delayed flights.
+    """
+    def __init__(self, counts, marginals, start, airlines, airports, data_version):
+        """
+        Initialize the cube. Use load() to read a built cube.
+
+        :param counts: Array of shape (days, 24, airlines, airports, 2).
+        :param marginals: Dictionary with the sums of counts over airports
+                          ('airline'), over airlines ('airport') and over
+                          both ('total').
+        :param start: Date of the first day.
+        :param airlines: Airline names, in the order of the airline axis.
+        :param airports: Origin airport codes, in the order of the airport axis.
+        :param data_version: FlightData.data_version() of the database the
+                             cube was built from.
+        """
+        self.counts = counts
+        self.marginals = marginals
+        self.start = start
+        self.airlines = list(airlines)
+        self.airports = list(airports)
+        self.data_version = data_version
+        self._airline_index = {name: index for index, name in enumerate(self.airlines)}
+        self._airport_index = {code: index for index, code in enumerate(self.airports)}
+
+
+    @classmethod
+    def load(cls, directory):
+        """
+        Memory-map a cube written by build_cube().
+        :param directory: Directory of the cube.
+        :return: DelayCube.
+        :raises OSError: If the cube has not been built.
+        :raises ValueError: If the files do not belong together, e.g. while
+                            the cube is being rebuilt.
+        """
+        with open(os.path.join(directory, METADATA_NAME), encoding='utf-8') as file:
+            metadata = json.load(file)
+        counts = np.load(os.path.join(directory, COUNTS_NAME), mmap_mode='r')
+        shape = (metadata['days'], HOURS, len(metadata['airlines']),
+                 len(metadata['airports']), 2)
+        marginals = {name: np.load(os.path.join(directory, file), mmap_mode='r')
+                     for name, file in MARGINAL_NAMES.items()}
+        if counts.shape != shape or any(
+                marginal.shape != _marginal_shape(shape, name)
+                for name, marginal in marginals.items()):
+            raise ValueError(f"Cube files do not match the shape {shape}")
+        return cls(counts, marginals, date.fromisoformat(metadata['start']),
+                   metadata['airlines'], metadata['airports'], metadata['data_version'])
+
+
+    @property
+    def days(self):
+        """Number of days covered."""
+        return self.counts.shape[0]
+
+
+    def hourly_counts(self, start, end, airline=None, airport=None):
+        """
+        Add up the flights per hour of departure over a range of dates.
+        :param start: First date.
+        :param end: Last date, included.
+        :param airline: Only count this airline (name), or None for all.
+        :param airport: Only count flights from this origin airport, or None
+                        for all.
+        :return: Array of shape (24, 2) with the flights and the delayed
+                 flights of every hour.
+        """
+        first = max(start.toordinal() - self.start.toordinal(), 0)
+        last = min(end.toordinal() - self.start.toordinal(), self.days - 1)
+        days = slice(first, last + 1) if first <= last else slice(0, 0)
+        airline_index = self._airline_index.get(airline, -1) if airline is not None else None
+        airport_index = self._airport_index.get(airport, -1) if airport is not None else None
+        if airline_index == -1 or airport_index == -1:
+            return np.zeros((HOURS, 2), dtype=np.int64)
+        if airline_index is not None and airport_index is not None:
+            cells = self.counts[days, :, airline_index, airport_index]
+        elif airline_index is not None:
+            cells = self.marginals['airline'][days, :, airline_index]
+        elif airport_index is not None:
+            cells = self.marginals['airport'][days, :, airport_index]
+        else:
+            cells = self.marginals['total'][days]
+        return cells.sum(axis=0, dtype=np.int64)
+
+
+def _marginal_shape(shape, name):
+    """Return the shape of a marginal of counts of the given shape."""
+    days, hours, airlines, airports, counts = shape
+    return {'airline': (days, hours, airlines, counts),
+            'airport': (days, hours, airports, counts),
+            'total': (days, hours, counts)}[name]
+
+
+def build_cube(db_uri):
+    """
+    Count the flights of every day, hour, airline and origin airport in one
+    grouped pass over the flights table and write the cube.
+    :param db_uri: Database URI.
+    :return: The built DelayCube.
+    """
+    data_manager = FlightData(db_uri, query_cache_size=0)
+    # Recorded once the log is checkpointed, as that changes the version
+    data_manager.checkpoint()
+    version = data_manager.data_version()
+    delayed = data_manager._delayed_expr()  # pylint: disable=protected-access
+    directory = cube_directory(db_uri)
+    os.makedirs(directory, exist_ok=True)
+
+    path = database_path(make_url(db_uri))
+    with sqlite3.connect(f"file:{path}?mode=ro", uri=True) as connection:
+        first, last = connection.execute("""
+        SELECT MIN(printf('%04d-%02d-%02d', YEAR, MONTH, DAY)),
+               MAX(printf('%04d-%02d-%02d', YEAR, MONTH, DAY))
+        FROM flights
+        """).fetchone()
+        if first is None:
+            raise ValueError("The flights table is empty")
+        start = date.fromisoformat(first)
+        days = date.fromisoformat(last).toordinal() - start.toordinal() + 1
+        airline_ids = np.array([row[0] for row in connection.execute(
+            "SELECT DISTINCT AIRLINE FROM flights ORDER BY AIRLINE")])
+        names = dict(connection.execute("SELECT ID, AIRLINE FROM airlines"))
+        airlines = [names.get(airline, str(airline)) for airline in airline_ids.tolist()]
+        airports = np.array([row[0] for row in connection.execute(
+            "SELECT DISTINCT ORIGIN_AIRPORT FROM flights ORDER BY ORIGIN_AIRPORT")])
+
+        counts_path = os.path.join(directory, COUNTS_NAME)
+        counts = np.lib.format.open_memmap(
+            counts_path + '.tmp', mode='w+', dtype=COUNT_DTYPE,
+            shape=(days, HOURS, len(airline_ids), len(airports), 2))
+        # Hours outside '00'-'23' are left out, as by the per-hour query
+        cursor = connection.execute(f"""
+        SELECT CAST(julianday(printf('%04d-%02d-%02d', YEAR, MONTH, DAY))
+                    - julianday(:start) AS INTEGER),
+               CAST({DEPARTURE_HOUR} AS INTEGER), AIRLINE, ORIGIN_AIRPORT,
+               COUNT(*), SUM(CASE WHEN {delayed} THEN 1 ELSE 0 END)
+        FROM flights
+        WHERE {DEPARTURE_HOUR} GLOB '[0-2][0-9]' AND {DEPARTURE_HOUR} <= '23'
+        GROUP BY YEAR, MONTH, DAY, {DEPARTURE_HOUR}, AIRLINE, ORIGIN_AIRPORT
+        """, {'start': start.isoformat()})
+        while rows := cursor.fetchmany(BUILD_BATCH_ROWS):
+            day, hour, airline, airport, total, delayed_count = zip(*rows)
+            if max(total) > np.iinfo(COUNT_DTYPE).max:
+                raise ValueError("Too many flights in one cell for COUNT_DTYPE")
+            cell = (np.array(day), np.array(hour),
+                    np.searchsorted(airline_ids, np.array(airline)),
+                    np.searchsorted(airports, np.array(airport)))
+            counts[cell + (0,)] = total
+            counts[cell + (1,)] = delayed_count
+        counts.flush()
+
+        marginals = {'airline': counts.sum(axis=3, dtype=np.uint32),
+                     'airport': counts.sum(axis=2, dtype=np.uint32)}
+        marginals['total'] = marginals['airline'].sum(axis=2, dtype=np.uint32)
+        del counts
+    os.replace(counts_path + '.tmp', counts_path)
+    for name, marginal in marginals.items():
+        marginal_path = os.path.join(directory, MARGINAL_NAMES[name])
+        np.save(marginal_path + '.tmp.npy', marginal)
+        os.replace(marginal_path + '.tmp.npy', marginal_path)
+
+    # Written last and atomically: readers check the counts against it
+    metadata_path = os.path.join(directory, METADATA_NAME)
+    with open(metadata_path + '.tmp', 'w', encoding='utf-8') as file:
+        json.dump({'data_version': version, 'start': start.isoformat(), 'days': days,
+                   'airlines': airlines, 'airports': airports.tolist()}, file)
+    os.replace(metadata_path + '.tmp', metadata_path)
+    return DelayCube.load(directory)
+
+
+def cube_version(db_uri):
+    """
+    Return a token that changes whenever the cube of a database is rebuilt.
+    :param db_uri: Database URI or SQLAlchemy URL.
+    :return: Version string, '-' if the cube has not been built.
+    """
+    try:
+        stat = os.stat(os.path.join(cube_directory(db_uri), METADATA_NAME))
+    except OSError:
+        return '-'
+    return f"{stat.st_mtime_ns}-{stat.st_size}"
+
+
+def load_cube(db_uri, data_version):
+    """
+    Memory-map the cube of a database if it is up to date.
+    :param db_uri: Database URI or SQLAlchemy URL.
+    :param data_version: Current FlightData.data_version() of the database.
+    :return: DelayCube, or None if it is missing or was built from an
+             older version of the database.
+    """
+    try:
+        cube = DelayCube.load(cube_directory(db_uri))
+    except (OSError, ValueError):
+        return None
+    return cube if cube.data_version == data_version else None
+
+
+def main():
+    """
+    Command-line entry point.
+    """
+    parser = argparse.ArgumentParser(description="Build the delay cube of a database")
+    parser.add_argument('--db', default=DEFAULT_DB_URI, help="Database URI")
+    args = parser.parse_args()
+    started = time.perf_counter()
+    cube = build_cube(args.db)
+    size = cube.counts.nbytes + sum(marginal.nbytes for marginal in cube.marginals.values())
+    print(f"Wrote a cube of {cube.days} days, {len(cube.airlines)} airlines and "
+          f"{len(cube.airports)} airports ({size / 2**20:,.0f} MiB) to "
+          f"{cube_directory(args.db)} in {time.perf_counter() - started:.1f}s.")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,42 +3,554 @@ This module provides functionality for retrieving and analyzing flight data
 from a SQL database.
 """
 
+import argparse
+import heapq
+import json
 import logging
-import pandas as pd
-from sqlalchemy import create_engine, text
+import math
+import os
+import sqlite3
+import time
+from datetime import date, timedelta
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.engine import make_url
 from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.pool import QueuePool
+import metrics
+import profiling
+from cache import LRUCache
+
+DEFAULT_DB_URI = 'sqlite:///data/flights.sqlite3'
+DELAY_THRESHOLD = 20  # Minutes of departure delay for a flight to count as delayed
+STREAM_BATCH_SIZE = 1000  # Rows fetched per round trip when streaming
+# Hour of the day ('00' to '23') of a flight, from its HHMM departure time
+DEPARTURE_HOUR = "substr('00' || DEPARTURE_TIME, -4, 2)"
+# Date of a flight as an ordinal YYYYMMDD integer, stored in the FLIGHT_DATE
+# column by optimize_schema() so that date ranges are index range scans
+FLIGHT_DATE = "YEAR * 10000 + MONTH * 100 + DAY"
+QUERY_CACHE_SIZE = 256  # Memoized query results kept per FlightData instance
+QUERY_CACHE_MAX_ROWS = 500_000  # Total rows held by the query cache
+ID_BATCH_SIZE = 500  # Flight IDs bound per IN list, well below SQLite's variable limit
+# Delay quantiles are reported per route, airline or origin airport, over
+# the flights that have a departure delay
+QUANTILE_DIMENSIONS = ('route', 'airline', 'airport')
+DELAY_QUANTILES = (0.5, 0.9, 0.99)  # Default quantiles: median, p90 and p99
+VALID_DELAY = "typeof(DEPARTURE_DELAY) IN ('integer', 'real')"
+# Key of the get_delay_quantiles() dimensions, on the flights joined with the airlines
+QUANTILE_KEYS = {
+    'route': "ORIGIN_AIRPORT || '-' || DESTINATION_AIRPORT",
+    'airline': "COALESCE(airlines.AIRLINE, CAST(flights.AIRLINE AS TEXT))",
+    'airport': "ORIGIN_AIRPORT",
+    None: "''",
+}
+# Key columns of the get_top_delayed() dimensions, selected from the flights
+# or a rollup table as source, and the columns they are grouped by
+TOP_DIMENSIONS = {
+    'route': ("source.ORIGIN_AIRPORT AS origin_airport, "
+              "source.DESTINATION_AIRPORT AS destination_airport",
+              "source.ORIGIN_AIRPORT, source.DESTINATION_AIRPORT"),
+    'airport': ("source.ORIGIN_AIRPORT AS airport", "source.ORIGIN_AIRPORT"),
+    'airline': ("COALESCE(airlines.AIRLINE, CAST(source.AIRLINE AS TEXT)) AS airline",
+                "source.AIRLINE"),
+}
+TOP_K = 20  # Default number of rows returned by get_top_delayed()
+
+# Columns of the flight rows returned by the lookup methods: the ones shown
+# by main.print_results and static/JS/script.js
+FLIGHT_COLUMNS = ('FLIGHT_ID', 'YEAR', 'MONTH', 'DAY', 'AIRLINE', 'FLIGHT_NUMBER',
+                  'ORIGIN_AIRPORT', 'DESTINATION_AIRPORT', 'SCHEDULED_DEPARTURE',
+                  'DEPARTURE_TIME', 'DEPARTURE_DELAY', 'ARRIVAL_TIME', 'ARRIVAL_DELAY',
+                  'DELAY')
+
+# Public query methods, instrumented by metrics.py in FlightData and in every
+# subclass that overrides them
+QUERY_METHODS = (
+    'get_flight_by_id', 'get_flights_by_ids', 'get_flights_by_date',
+    'get_delayed_flights_by_airline', 'get_all_delayed_flights_grouped_by_airline',
+    'get_delayed_flights_by_airport', 'get_delayed_flights_per_hour',
+    'get_flight_delays_heatmap', 'get_flight_delays_heatmap_matrix',
+    'get_delayed_flights_average_per_route', 'get_delayed_flights_per_route_map',
+    'get_airport_coordinates', 'get_nearest_airports', 'get_airports_within_radius',
+    'get_airports_in_bbox', 'get_hourly_delays', 'get_delay_quantiles',
+    'get_flights_by_date_range', 'get_delayed_flights_per_route_map_range',
+    'get_top_delayed',
+)
+
+# Connection profiles for FlightData(connection_profile=...). 'read_heavy'
+# suits the API: read-only connections with a large page cache and
+# memory-mapped I/O, kept open in a fixed-size pool and handed out most
+# recently used first so that request threads get a warm connection.
+CONNECTION_PROFILES = {
+    'default': {},
+    'read_heavy': {
+        'read_only': True,
+        'journal_mode': 'WAL',
+        'mmap_size': 256 * 1024 * 1024,
+        'cache_size': -64 * 1024,  # Negative values are KiB: 64 MiB per connection
+        'temp_store': 'MEMORY',
+        'pool_size': 16,  # Connections kept open and shared by the threads
+    },
+}
+CONNECTION_PRAGMAS = ('mmap_size', 'cache_size', 'temp_store')
+
+# Indexes created by FlightData.optimize_schema(); the route index covers the
+# heatmap and route aggregates so they never touch the table itself.
+SCHEMA_INDEXES = {
+    'idx_flights_date': 'flights (YEAR, MONTH, DAY, DEPARTURE_TIME, IS_DELAYED)',
+    'idx_flights_date_id': 'flights (YEAR, MONTH, DAY, ID)',
+    'idx_flights_flight_date': 'flights (FLIGHT_DATE, ID, DEPARTURE_TIME, IS_DELAYED)',
+    'idx_flights_origin': 'flights (ORIGIN_AIRPORT, IS_DELAYED, ID)',
+    'idx_flights_airline': 'flights (AIRLINE, IS_DELAYED, ID)',
+    'idx_flights_id': 'flights (ID)',
+    'idx_flights_route': ('flights (ORIGIN_AIRPORT, DESTINATION_AIRPORT, '
+                          'CANCELLED, DIVERTED, IS_DELAYED)'),
+    'idx_airports_iata': 'airports (IATA_CODE)',
+    'idx_airlines_id': 'airlines (ID)',
+}
+# Normalized columns of the flights table, filled by optimize_schema() and
+# kept filled by SCHEMA_TRIGGERS for rows written by other tools afterwards
+NORMALIZED_VALUES = f"""
+    DELAY_MINUTES = COALESCE(NULLIF(DEPARTURE_DELAY, ''), 0),
+    IS_DELAYED = COALESCE(NULLIF(DEPARTURE_DELAY, ''), 0) > {DELAY_THRESHOLD},
+    FLIGHT_DATE = {FLIGHT_DATE}
+"""
+SCHEMA_TRIGGERS = {
+    'trg_flights_normalize_insert': f"""
+    AFTER INSERT ON flights
+    WHEN NEW.DELAY_MINUTES IS NULL OR NEW.IS_DELAYED IS NULL OR NEW.FLIGHT_DATE IS NULL
+    BEGIN UPDATE flights SET {NORMALIZED_VALUES} WHERE rowid = NEW.rowid; END
+    """,
+    'trg_flights_normalize_update': f"""
+    AFTER UPDATE OF DEPARTURE_DELAY, YEAR, MONTH, DAY ON flights
+    BEGIN UPDATE flights SET {NORMALIZED_VALUES} WHERE rowid = NEW.rowid; END
+    """,
+}
+# Rollup tables maintained by FlightData.refresh_rollups(). route_day_rollup
+# holds per-day counts and route_rollup the running totals over all days.
+ROLLUP_COUNTS = ('total_count', 'delayed_count', 'cancelled_count',
+                 'diverted_count', 'delay_sum', 'completed_count',
+                 'completed_delayed_count')
+ROLLUP_SCHEMA = (
+    f"""
+    CREATE TABLE IF NOT EXISTS route_day_rollup (
+        YEAR INTEGER, MONTH INTEGER, DAY INTEGER,
+        ORIGIN_AIRPORT TEXT, DESTINATION_AIRPORT TEXT, AIRLINE INTEGER,
+        {', '.join(f'{name} INTEGER' for name in ROLLUP_COUNTS)},
+        PRIMARY KEY (YEAR, MONTH, DAY, ORIGIN_AIRPORT,
+                     DESTINATION_AIRPORT, AIRLINE)
+    )
+    """,
+    f"""
+    CREATE TABLE IF NOT EXISTS route_rollup (
+        ORIGIN_AIRPORT TEXT, DESTINATION_AIRPORT TEXT, AIRLINE INTEGER,
+        {', '.join(f'{name} INTEGER' for name in ROLLUP_COUNTS)},
+        PRIMARY KEY (ORIGIN_AIRPORT, DESTINATION_AIRPORT, AIRLINE)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS rollup_days (
+        YEAR INTEGER, MONTH INTEGER, DAY INTEGER,
+        PRIMARY KEY (YEAR, MONTH, DAY)
+    )
+    """,
+)
+# File next to the database recording the data_version() that the rollup
+# tables were last brought up to date with, e.g. data/flights_rollups.json
+ROLLUP_METADATA_SUFFIX = '_rollups.json'
+# Every hour of the day, so that hours without flights are reported as zero
+HOURS_CTE = """
+        all_hours AS (
+            SELECT '00' AS hour UNION ALL SELECT '01' UNION ALL SELECT '02'
+            UNION ALL SELECT '03' UNION ALL SELECT '04' UNION ALL SELECT '05'
+            UNION ALL SELECT '06' UNION ALL SELECT '07' UNION ALL SELECT '08'
+            UNION ALL SELECT '09' UNION ALL SELECT '10' UNION ALL SELECT '11'
+            UNION ALL SELECT '12' UNION ALL SELECT '13' UNION ALL SELECT '14'
+            UNION ALL SELECT '15' UNION ALL SELECT '16' UNION ALL SELECT '17'
+            UNION ALL SELECT '18' UNION ALL SELECT '19' UNION ALL SELECT '20'
+            UNION ALL SELECT '21' UNION ALL SELECT '22' UNION ALL SELECT '23'
+        )"""
+# Plan lines produced by the hour list CTE that carry no information
+PLAN_NOISE = {'COMPOUND QUERY', 'LEFT-MOST SUBQUERY', 'UNION ALL',
+              'SCAN CONSTANT ROW'}
+
+
+class Rows:
+    """
+    Compact query result: the column names once and every row as a tuple,
+    instead of one dictionary per row repeating the column names.
+    """
+    __slots__ = ('columns', 'rows')
+
+    def __init__(self, columns, rows):
+        """
+        Initialize the result.
+
+        :param columns: Column names.
+        :param rows: List of tuples, or an iterator of tuples for a
+                     streamed result.
+        """
+        self.columns = tuple(columns)
+        self.rows = rows
+
+
+    def __iter__(self):
+        return iter(self.rows)
+
+
+    def __len__(self):
+        return len(self.rows)
+
+
+    def close(self):
+        """
+        Stop reading a streamed result, releasing its database connection.
+        """
+        if hasattr(self.rows, 'close'):
+            self.rows.close()
+
+
+    def records(self):
+        """
+        Convert the rows to dictionaries, for code that expects them.
+        :return: Generator of dictionaries.
+        """
+        columns = self.columns
+        return (dict(zip(columns, row)) for row in self.rows)
 
 
 class FlightData:
     """
     Class for handling flight data operations with a database.
     """
-    def __init__(self, db_uri):
+    def __init__(self, db_uri, query_cache_size=QUERY_CACHE_SIZE,
+                 connection_profile=None):
         """
         Initialize the FlightData object with a database URI.
 
         :param db_uri: Database URI.
+        :param query_cache_size: Number of query results to memoize,
+                                 0 to disable memoization.
+        :param connection_profile: Name of an entry in CONNECTION_PROFILES or
+                                   a dictionary with the same keys; None uses
+                                   SQLAlchemy's defaults. Read-only profiles
+                                   cannot run optimize_schema() or
+                                   refresh_rollups().
         """
         logging.basicConfig(level=logging.INFO)
-        self._engine = create_engine(db_uri)
+        self._engine = create_sqlite_engine(db_uri, connection_profile)
+        self._plan_capture = None
+        # Entries are (columns, rows) tuples, sized by their number of rows
+        self._query_cache = LRUCache(query_cache_size, max_size=QUERY_CACHE_MAX_ROWS,
+                                     sizeof=lambda entry: len(entry[1])) \
+            if query_cache_size else None
+        self._query_cache_version = None
+        self._airport_registry = (None, None)  # (data version, registry)
+        self._delay_cube = (None, None)  # (data version, cube)
+        self._quantile_sketches = (None, None)  # (data version, sketches)
+        self._optimized = self._has_optimized_schema()
+        self._has_flight_date = self._optimized
+        self._has_rollups = self._has_table('rollup_days')
+        self._rollup_state = (None, False)  # (data version, rollups up to date)
+
+
+    def data_version(self):
+        """
+        Return a token that changes whenever the database file changes,
+        based on the modification time and size of the SQLite file and its
+        write-ahead log. An empty log holds no changes and is ignored, as
+        readers create and remove it when they connect and disconnect.
+        :return: Version string.
+        """
+        path = database_path(self._engine.url)
+        if not path or path == ':memory:':
+            return '0'
+        parts = []
+        for suffix in ('', '-wal'):
+            try:
+                stat = os.stat(path + suffix)
+            except OSError:
+                stat = None
+            parts.append(f"{stat.st_mtime_ns}-{stat.st_size}" if stat and stat.st_size
+                         else '-')
+        return ':'.join(parts)
 
 
-    def _execute_query(self, query, params=None):
+    def checkpoint(self):
+        """
+        Close the pooled connections, then copy the write-ahead log into the
+        database file and truncate it. data_version() then no longer changes
+        when the last connection closes and SQLite removes the log, so files
+        built from the database, such as the delay cube, record a version
+        that the next process still sees.
+        """
+        self._engine.dispose()
+        path = database_path(self._engine.url)
+        if not path or path == ':memory:':
+            return
+        connection = sqlite3.connect(path)
+        try:
+            connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        except sqlite3.Error as ex:
+            logging.warning("Could not checkpoint %s: %s", path, ex)
+        finally:
+            connection.close()
+
+
+    def _has_table(self, name):
+        """
+        Check whether a table exists in the database.
+        :param name: Table name.
+        :return: True if the table exists.
+        """
+        return bool(self._execute_query(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name = :name",
+            {'name': name}
+        ))
+
+
+    def _has_flight_column(self, name):
+        """
+        Check whether the flights table has a column.
+        :param name: Column name.
+        :return: True if the column exists.
+        """
+        columns = self._execute_query("PRAGMA table_info(flights)")
+        return any(column['name'] == name for column in columns)
+
+
+    def _has_optimized_schema(self):
+        """
+        Check whether optimize_schema() has added the normalized columns and
+        the triggers that keep them filled. Databases optimized before the
+        triggers existed may hold unfilled rows, so they are read with the
+        raw expressions until optimize_schema() runs again.
+        :return: True if the flights table has the DELAY_MINUTES column and
+                 every trigger of SCHEMA_TRIGGERS.
+        """
+        triggers = {row['name'] for row in self._execute_query(
+            "SELECT name FROM sqlite_master WHERE type = 'trigger' AND tbl_name = 'flights'")}
+        return self._has_flight_column('DELAY_MINUTES') and triggers >= set(SCHEMA_TRIGGERS)
+
+
+    def _delay_expr(self, table='flights'):
+        """
+        SQL expression for the departure delay in minutes, with missing
+        delays counted as zero.
+        :param table: Table name or alias of the flights table.
+        :return: SQL expression string.
+        """
+        if self._optimized:
+            return f"{table}.DELAY_MINUTES"
+        return f"COALESCE(NULLIF({table}.DEPARTURE_DELAY, ''), 0)"
+
+
+    def _delayed_expr(self, table='flights'):
+        """
+        SQL condition that is true for flights delayed by more than
+        DELAY_THRESHOLD minutes.
+        :param table: Table name or alias of the flights table.
+        :return: SQL expression string.
+        """
+        if self._optimized:
+            return f"{table}.IS_DELAYED = 1"
+        return f"{self._delay_expr(table)} > {DELAY_THRESHOLD}"
+
+
+    @staticmethod
+    def _keyset_clauses(params, limit=None, after=None):
+        """
+        Build the clauses for keyset pagination on flight ID.
+        :param params: Query parameters, updated in place.
+        :param limit: Maximum number of rows to return, or None for all.
+        :param after: Only return flights with an ID greater than this.
+        :return: Tuple of (WHERE condition, ORDER BY/LIMIT clause).
+        """
+        condition = ''
+        if after is not None:
+            params['after'] = int(after)
+            condition = 'AND flights.ID > :after'
+        params['limit'] = -1 if limit is None else int(limit)
+        return condition, 'ORDER BY flights.ID LIMIT :limit'
+
+
+    def _flight_date_expr(self, table='flights'):
+        """
+        SQL expression for the FLIGHT_DATE of a flight, read from the
+        indexed column once optimize_schema() has added it.
+        :param table: Table name or alias of the flights table.
+        :return: SQL expression string.
+        """
+        if self._has_flight_date:
+            return f"{table}.FLIGHT_DATE"
+        return f"({table}.YEAR * 10000 + {table}.MONTH * 100 + {table}.DAY)"
+
+
+    def _date_range_condition(self, params, start, end, table='flights'):
+        """
+        Build the condition selecting the flights of a range of dates.
+        :param params: Query parameters, updated in place.
+        :param start: First date.
+        :param end: Last date, included.
+        :param table: Table name or alias of the flights table.
+        :return: SQL condition string.
+        """
+        params['start'], params['end'] = date_ordinal(start), date_ordinal(end)
+        return f"{self._flight_date_expr(table)} BETWEEN :start AND :end"
+
+
+    def _flight_columns(self):
+        """
+        SQL select list of the FLIGHT_COLUMNS, for queries joining the
+        flights table with airlines.
+        :return: SQL string.
+        """
+        expressions = {'FLIGHT_ID': 'flights.ID', 'AIRLINE': 'airlines.AIRLINE',
+                       'DELAY': self._delay_expr()}
+        return ', '.join(f"{expressions.get(name, f'flights.{name}')} AS {name}"
+                         for name in FLIGHT_COLUMNS)
+
+
+    def _execute_query(self, query, params=None, stream=False, as_tuples=False):
         """
         Execute a SQL query with optional parameters and return the
         results as a list of dictionaries.
         :param query: SQL query to execute.
         :param params: Parameters for the SQL query.
-        :return: List of dictionaries representing the query result.
+        :param stream: If True, return a generator that fetches the rows
+                       in batches instead of a list.
+        :param as_tuples: If True, return the rows as tuples in a Rows
+                          result instead of dictionaries. A streamed Rows
+                          result runs the query when it is returned, as its
+                          columns are only known then.
+        :return: List of dictionaries representing the query result, or Rows.
         """
+        if self._plan_capture is not None:
+            self._plan_capture.append(self._explain_query(query, params))
+            return Rows((), []) if as_tuples else []
+        method = metrics.current_method()
+        key = (' '.join(query.split()), tuple(sorted((params or {}).items())))
+        # Profiled requests always run their queries, to measure them
+        use_cache = self._query_cache is not None and not profiling.active()
+        cached = self._cached_result(key) if use_cache else None
+        if use_cache:
+            metrics.record_cache(method, cached is not None)
+        if cached is not None:
+            # The cache holds immutable rows; every caller gets its own copies
+            columns, cached_rows = cached
+            if as_tuples:
+                rows = (tuple(row) for row in cached_rows)
+                return Rows(columns, rows if stream else list(rows))
+            rows = (dict(zip(columns, row)) for row in cached_rows)
+            return rows if stream else list(rows)
+        if stream:
+            rows = self._iter_query(query, params, cache_key=key, method=method,
+                                    as_tuples=as_tuples)
+            if as_tuples:
+                return Rows(next(rows, ()), rows)
+            return _skip_header(rows)
+        started = time.perf_counter()
         try:
             with self._engine.connect() as connection:
                 result = connection.execute(text(query), params or {})
-                columns = result.keys()
-                return [dict(zip(columns, row)) for row in result.fetchall()]
+                columns = tuple(result.keys())
+                fetched_rows = result.fetchall()
+                fetched = time.perf_counter()
+                if as_tuples:
+                    rows = Rows(columns, [tuple(row) for row in fetched_rows])
+                else:
+                    rows = [dict(zip(columns, row)) for row in fetched_rows]
         except SQLAlchemyError as ex:
             logging.error("SQLAlchemy Error: %s", ex)
-            return []
+            return Rows((), []) if as_tuples else []
+        metrics.record_query(method, query, params, fetched - started)
+        profiling.add_phase('query', fetched - started)
+        profiling.add_phase('materialization', time.perf_counter() - fetched)
+        if self._query_cache is not None:
+            self._query_cache.set(key, (columns, tuple(fetched_rows)))
+        return rows
+
+
+    def _iter_query(self, query, params=None, batch_size=STREAM_BATCH_SIZE,
+                    cache_key=None, method=None, as_tuples=False):
+        """
+        Execute a SQL query and yield its column names, then its rows,
+        fetching them from SQLite in batches so that only one batch is held
+        in memory. Results small enough for the query cache are memoized
+        once fully read.
+        :param query: SQL query to execute.
+        :param params: Parameters for the SQL query.
+        :param batch_size: Number of rows fetched per batch.
+        :param cache_key: Query cache key, or None to skip memoization.
+        :param method: Name of the query method for the metrics; defaults
+                       to the method running when the generator starts.
+        :param as_tuples: If True, yield the rows as tuples instead of
+                          dictionaries.
+        :return: Generator of the tuple of column names followed by the rows.
+        """
+        method = method or metrics.current_method()
+        collected = [] if cache_key is not None and self._query_cache is not None else None
+        # Only the time spent in SQLite counts, not the time the caller
+        # spends between batches
+        sql_seconds = 0.0
+        try:
+            with self._engine.connect() as connection:
+                started = time.perf_counter()
+                result = connection.execution_options(stream_results=True).execute(
+                    text(query), params or {})
+                columns = tuple(result.keys())
+                sql_seconds += time.perf_counter() - started
+                yield columns
+                while True:
+                    started = time.perf_counter()
+                    rows = result.fetchmany(batch_size)
+                    fetched = time.perf_counter()
+                    sql_seconds += fetched - started
+                    if not rows:
+                        break
+                    if collected is not None:
+                        collected.extend(rows)
+                        if len(collected) > QUERY_CACHE_MAX_ROWS:
+                            collected = None
+                    if as_tuples:
+                        records = [tuple(row) for row in rows]
+                    else:
+                        records = [dict(zip(columns, row)) for row in rows]
+                    profiling.add_phase('materialization', time.perf_counter() - fetched)
+                    yield from records
+        except SQLAlchemyError as ex:
+            logging.error("SQLAlchemy Error: %s", ex)
+            return
+        finally:
+            metrics.record_query(method, query, params, sql_seconds)
+            profiling.add_phase('query', sql_seconds)
+        if collected is not None:
+            self._query_cache.set(cache_key, (columns, tuple(collected)))
+
+
+    def _cached_result(self, key):
+        """
+        Look up a memoized query result. The whole cache is dropped when
+        the database file has changed since it was filled.
+        :param key: Tuple of normalized SQL and sorted parameters.
+        :return: Tuple of the column names and the result rows, or None on
+                 a miss.
+        """
+        if self._query_cache is None:
+            return None
+        version = self.data_version()
+        if version != self._query_cache_version:
+            self._query_cache.clear()
+            self._query_cache_version = version
+        return self._query_cache.get(key)
+
+
+    def query_cache_stats(self):
+        """
+        Report the hit and miss counts of the query memoization.
+        :return: Dictionary with hits, misses, entries and size (rows),
+                 or None if memoization is disabled.
+        """
+        return self._query_cache.stats() if self._query_cache is not None else None
 
 
     def get_flight_by_id(self, flight_id):
@@ -48,120 +560,200 @@ class FlightData:
         :return: List of dictionaries containing flight details.
         """
         params = {'id': flight_id}
-        query = """
-        SELECT flights.*, airlines.airline, flights.ID AS FLIGHT_ID, 
-               COALESCE(NULLIF(flights.DEPARTURE_DELAY,''), 0) AS DELAY 
-        FROM flights 
-        JOIN airlines ON flights.airline = airlines.id 
+        query = f"""
+        SELECT {self._flight_columns()}
+        FROM flights
+        JOIN airlines ON flights.airline = airlines.id
         WHERE flights.ID = :id
         """
         return self._execute_query(query, params)
 
 
-    def get_flights_by_date(self, day, month, year):
+    def get_flights_by_ids(self, flight_ids):
+        """
+        Retrieve the details of many flights, ID_BATCH_SIZE IDs per query.
+        :param flight_ids: Iterable of flight IDs.
+        :return: Dictionary mapping the IDs that were found to dictionaries
+                 containing flight details.
+        """
+        flight_ids = list(dict.fromkeys(int(flight_id) for flight_id in flight_ids))
+        results = {}
+        for start in range(0, len(flight_ids), ID_BATCH_SIZE):
+            batch = flight_ids[start:start + ID_BATCH_SIZE]
+            params = {f'id_{index}': flight_id for index, flight_id in enumerate(batch)}
+            query = f"""
+            SELECT {self._flight_columns()}
+            FROM flights
+            JOIN airlines ON flights.airline = airlines.id
+            WHERE flights.ID IN ({', '.join(f':{name}' for name in params)})
+            """
+            for row in self._execute_query(query, params):
+                results.setdefault(row['FLIGHT_ID'], row)
+        return results
+
+
+    def get_flights_by_date(self, day, month, year, limit=None, after=None,
+                            stream=False, as_tuples=False):
         """
-        Retrieve flights for a specific date.
+        Retrieve flights for a specific date, ordered by flight ID.
         :param day: Day of the flight.
         :param month: Month of the flight.
         :param year: Year of the flight.
+        :param limit: Maximum number of flights to return, or None for all.
+        :param after: Only return flights with an ID greater than this cursor.
+        :param stream: If True, return a generator instead of a list.
+        :param as_tuples: If True, return a Rows result of FLIGHT_COLUMNS
+                          tuples instead of dictionaries.
         :return: List of dictionaries containing flight details.
         """
         params = {'day': day, 'month': month, 'year': year}
-        query = """
-        SELECT flights.*, airlines.airline, flights.ID AS FLIGHT_ID,
-               COALESCE(NULLIF(flights.DEPARTURE_DELAY,''), 0) AS DELAY  
-        FROM flights 
-        JOIN airlines ON flights.airline = airlines.id 
-        WHERE flights.DAY = :day 
-              AND flights.MONTH = :month 
+        after_condition, page = self._keyset_clauses(params, limit, after)
+        query = f"""
+        SELECT {self._flight_columns()}
+        FROM flights
+        JOIN airlines ON flights.airline = airlines.id
+        WHERE flights.DAY = :day
+              AND flights.MONTH = :month
               AND flights.YEAR = :year
+              {after_condition}
+        {page}
         """
-        return self._execute_query(query, params)
+        return self._execute_query(query, params, stream, as_tuples)
 
 
-    def get_delayed_flights_by_airline(self, airline_name):
+    def get_flights_by_date_range(self, start, end, limit=None, after=None,
+                                  stream=False, as_tuples=False):
+        """
+        Retrieve the flights of a range of dates, ordered by date and then
+        by flight ID, so that a page is one scan of the FLIGHT_DATE index.
+        :param start: First date.
+        :param end: Last date, included.
+        :param limit: Maximum number of flights to return, or None for all.
+        :param after: Only return the flights after this cursor, the flight
+                      ID of the last flight of the previous page.
+        :param stream: If True, return a generator instead of a list.
+        :param as_tuples: If True, return a Rows result of FLIGHT_COLUMNS
+                          tuples instead of dictionaries.
+        :return: List of dictionaries containing flight details.
+        """
+        params = {'limit': -1 if limit is None else int(limit)}
+        flight_date = self._flight_date_expr()
+        after_condition = ''
+        if after is not None:
+            params['after'] = int(after)
+            after_condition = f"""
+              AND ({flight_date}, flights.ID) > (
+                  (SELECT {self._flight_date_expr('cursor')} FROM flights AS cursor
+                   WHERE cursor.ID = :after), :after)"""
+        query = f"""
+        SELECT {self._flight_columns()}
+        FROM flights
+        JOIN airlines ON flights.airline = airlines.id
+        WHERE {self._date_range_condition(params, start, end)}{after_condition}
+        ORDER BY {flight_date}, flights.ID
+        LIMIT :limit
         """
-        Retrieve delayed flights for a specific airline.
+        return self._execute_query(query, params, stream, as_tuples)
+
+
+    def get_delayed_flights_by_airline(self, airline_name, limit=None, after=None,
+                                       stream=False, as_tuples=False):
+        """
+        Retrieve delayed flights for a specific airline, ordered by flight ID.
         :param airline_name: Name of the airline.
+        :param limit: Maximum number of flights to return, or None for all.
+        :param after: Only return flights with an ID greater than this cursor.
+        :param stream: If True, return a generator instead of a list.
+        :param as_tuples: If True, return a Rows result of FLIGHT_COLUMNS
+                          tuples instead of dictionaries.
         :return: List of dictionaries containing delayed flights.
         """
         params = {'airline_name': airline_name}
-        query = """
-        SELECT flights.*, airlines.airline, flights.ID AS FLIGHT_ID,
-               COALESCE(NULLIF(flights.DEPARTURE_DELAY,''), 0) AS DELAY 
-        FROM flights 
-        JOIN airlines ON flights.airline = airlines.id 
-        WHERE airlines.airline = :airline_name 
-              AND COALESCE(NULLIF(flights.DEPARTURE_DELAY, ''), 0) > 20 
-              AND flights.DEPARTURE_DELAY IS NOT NULL
+        after_condition, page = self._keyset_clauses(params, limit, after)
+        # Resolving the airline ID first lets SQLite walk the airline index
+        # in ID order and stop after one page
+        query = f"""
+        SELECT {self._flight_columns()}
+        FROM flights
+        JOIN airlines ON flights.airline = airlines.id
+        WHERE flights.AIRLINE = (SELECT ID FROM airlines
+                                 WHERE airline = :airline_name)
+              AND {self._delayed_expr()}
+              {after_condition}
+        {page}
         """
-        return self._execute_query(query, params)
+        return self._execute_query(query, params, stream, as_tuples)
 
 
-    def get_all_delayed_flights_grouped_by_airline(self):
+    def get_all_delayed_flights_grouped_by_airline(self, stream=False):
         """
         Retrieve all delayed flights grouped by airline.
+        :param stream: If True, return a generator instead of a list.
         :return: List of dictionaries containing delayed flights by airline.
         """
-        query = """
-        SELECT airlines.airline, 
+        query = f"""
+        SELECT airlines.airline,
                COUNT(*) AS delay_count
         FROM flights
         JOIN airlines ON flights.airline = airlines.id
-        WHERE COALESCE(NULLIF(flights.DEPARTURE_DELAY, ''), 0) > 20 
-              GROUP BY airlines.airline
+        WHERE {self._delayed_expr()}
+        GROUP BY airlines.airline
         """
-        return self._execute_query(query)
+        return self._execute_query(query, stream=stream)
 
 
-    def get_delayed_flights_by_airport(self, airport_code):
+    def get_delayed_flights_by_airport(self, airport_code, limit=None, after=None,
+                                       stream=False, as_tuples=False):
         """
-        Retrieve delayed flights for a specific airport.
+        Retrieve delayed flights for a specific airport, ordered by flight ID.
         :param airport_code: Code of the airport.
+        :param limit: Maximum number of flights to return, or None for all.
+        :param after: Only return flights with an ID greater than this cursor.
+        :param stream: If True, return a generator instead of a list.
+        :param as_tuples: If True, return a Rows result of FLIGHT_COLUMNS
+                          tuples instead of dictionaries.
         :return: List of dictionaries containing delayed flights.
         """
         params = {'airport_code': airport_code}
-        query = """
-        SELECT flights.*, airlines.airline, flights.ID AS FLIGHT_ID, 
-               COALESCE(NULLIF(flights.DEPARTURE_DELAY,''), 0) AS DELAY 
-        FROM flights 
-        JOIN airlines ON flights.airline = airlines.id 
-        WHERE flights.ORIGIN_AIRPORT = :airport_code 
-              AND COALESCE(NULLIF(flights.DEPARTURE_DELAY, ''), 0) > 20 
-              AND flights.DEPARTURE_DELAY IS NOT NULL
+        after_condition, page = self._keyset_clauses(params, limit, after)
+        query = f"""
+        SELECT {self._flight_columns()}
+        FROM flights
+        JOIN airlines ON flights.airline = airlines.id
+        WHERE flights.ORIGIN_AIRPORT = :airport_code
+              AND {self._delayed_expr()}
+              {after_condition}
+        {page}
         """
-        return self._execute_query(query, params)
+        return self._execute_query(query, params, stream, as_tuples)
 
 
-    def get_delayed_flights_per_hour(self, day, month, year):
+    def get_delayed_flights_per_hour(self, day, month, year, stream=False):
         """
-        Retrieve delayed flights grouped by hour for a specific date.
+        Retrieve delayed flights grouped by hour for a specific date, from
+        the delay cube when it is up to date.
         :param day: Day of the flights.
         :param month: Month of the flights.
         :param year: Year of the flights.
+        :param stream: If True, return a generator instead of a list.
         :return: List of dictionaries containing delayed flights per hour.
         """
+        results = self._cube_per_hour(day, month, year)
+        if results is not None:
+            return iter(results) if stream else results
+
         params = {'day': day, 'month': month, 'year': year}
-        query = """
-        WITH all_hours AS (
-            SELECT '00' AS hour UNION ALL SELECT '01' UNION ALL SELECT '02'
-            UNION ALL SELECT '03' UNION ALL SELECT '04' UNION ALL SELECT '05'
-            UNION ALL SELECT '06' UNION ALL SELECT '07' UNION ALL SELECT '08'
-            UNION ALL SELECT '09' UNION ALL SELECT '10' UNION ALL SELECT '11'
-            UNION ALL SELECT '12' UNION ALL SELECT '13' UNION ALL SELECT '14'
-            UNION ALL SELECT '15' UNION ALL SELECT '16' UNION ALL SELECT '17'
-            UNION ALL SELECT '18' UNION ALL SELECT '19' UNION ALL SELECT '20'
-            UNION ALL SELECT '21' UNION ALL SELECT '22' UNION ALL SELECT '23'
-        ),
+        query = f"""
+        WITH {HOURS_CTE},
 
         hourly_stats AS (
             SELECT 
                 -- Extract the hour from the departure time (assuming it's in HHMM format)
-                substr('00' || DEPARTURE_TIME, -4, 2) AS hour,
+                {DEPARTURE_HOUR} AS hour,
                 COUNT(*) AS total_count,
-                SUM(CASE WHEN COALESCE(NULLIF(DEPARTURE_DELAY, ''), 0) > 20 THEN 1 ELSE 0 END) AS delayed_count
+                SUM(CASE WHEN {self._delayed_expr()} THEN 1 ELSE 0 END) AS delayed_count
             FROM flights
-            WHERE YEAR = 2015 AND MONTH = 1 AND DAY = 1
+            WHERE YEAR = :year AND MONTH = :month AND DAY = :day
             GROUP BY hour
         )
 
@@ -172,96 +764,536 @@ class FlightData:
         LEFT JOIN hourly_stats s ON h.hour = s.hour
         ORDER BY h.hour;
         """
-        return self._execute_query(query, params)
+        return self._execute_query(query, params, stream)
+
+
+    @staticmethod
+    def _hourly_rows(counts):
+        """
+        Format hourly counts of the delay cube like the per-hour query.
+        :param counts: Array of shape (24, 2) with the flights and the
+                       delayed flights of every hour.
+        :return: List of dictionaries with hour, delayed_count and total_count.
+        """
+        return [{'hour': f"{hour:02d}", 'delayed_count': int(delayed),
+                 'total_count': int(total)}
+                for hour, (total, delayed) in enumerate(counts.tolist())]
+
+
+    def _cube_per_hour(self, day, month, year):
+        """
+        Read the delayed flights per hour of a date from the delay cube.
+        :param day: Day of the flights.
+        :param month: Month of the flights.
+        :param year: Year of the flights.
+        :return: List like get_delayed_flights_per_hour(), or None if the
+                 cube is not available or the date is not valid.
+        """
+        try:
+            when = date(int(year), int(month), int(day))
+        except (TypeError, ValueError):
+            return None
+        cube = self.get_delay_cube()
+        return self._hourly_rows(cube.hourly_counts(when, when)) if cube else None
+
+
+    def get_hourly_delays(self, start, end, airline_name=None, airport_code=None,
+                          stream=False):
+        """
+        Retrieve the flights and delayed flights per hour of departure over
+        a range of dates, optionally of one airline and one origin airport.
+        Served from the delay cube when it is up to date.
+        :param start: First date.
+        :param end: Last date, included.
+        :param airline_name: Only count flights of this airline.
+        :param airport_code: Only count flights from this origin airport.
+        :param stream: If True, return a generator instead of a list.
+        :return: List of dictionaries with hour, delayed_count and total_count.
+        """
+        cube = self.get_delay_cube()
+        if cube is not None:
+            results = self._hourly_rows(
+                cube.hourly_counts(start, end, airline_name, airport_code))
+            return iter(results) if stream else results
+
+        params = {}
+        conditions = self._date_range_condition(params, start, end)
+        if airline_name is not None:
+            params['airline_name'] = airline_name
+            conditions += """
+              AND AIRLINE = (SELECT ID FROM airlines WHERE airline = :airline_name)"""
+        if airport_code is not None:
+            params['airport_code'] = airport_code
+            conditions += " AND ORIGIN_AIRPORT = :airport_code"
+        query = f"""
+        WITH {HOURS_CTE},
+
+        hourly_stats AS (
+            SELECT {DEPARTURE_HOUR} AS hour,
+                COUNT(*) AS total_count,
+                SUM(CASE WHEN {self._delayed_expr()} THEN 1 ELSE 0 END) AS delayed_count
+            FROM flights
+            WHERE {conditions}
+            GROUP BY hour
+        )
+
+        SELECT h.hour,
+            COALESCE(s.delayed_count, 0) AS delayed_count,
+            COALESCE(s.total_count, 0) AS total_count
+        FROM all_hours h
+        LEFT JOIN hourly_stats s ON h.hour = s.hour
+        ORDER BY h.hour;
+        """
+        return self._execute_query(query, params, stream)
 
 
+    def get_delay_quantiles(self, dimension=None, key=None, quantiles=DELAY_QUANTILES,
+                            stream=False):
+        """
+        Retrieve quantiles of the departure delay of every route, airline or
+        origin airport, or of all flights. Served from the sketches of
+        sketches.py when they are up to date, within their rank error, and
+        computed exactly in SQL otherwise.
+        :param dimension: One of QUANTILE_DIMENSIONS, or None for all flights.
+        :param key: Only this route ('ORIGIN-DESTINATION'), airline name or
+                    origin airport code, or None for every one.
+        :param quantiles: Fractions between 0 and 1.
+        :param stream: If True, return a generator instead of a list.
+        :return: List of dictionaries with the key columns, flights, one
+                 pNN entry per quantile (e.g. p50) and rank_error, the
+                 largest error of the ranks as a fraction of the flights.
+        """
+        sketches = self.get_quantile_sketches()
+        if sketches is not None:
+            from sketches import rank_error  # pylint: disable=import-outside-toplevel
+            if dimension is None:
+                # The airlines are the fewest sketches to merge
+                found = [(None, sketches.merged('airline'))]
+            else:
+                keys = sketches.keys(dimension) if key is None else [key]
+                found = [(name, sketches.sketch(dimension, name)) for name in keys]
+            results = [
+                self._quantile_row(dimension, name, sketch.count,
+                                   sketch.quantiles(quantiles), quantiles,
+                                   0.0 if sketch.exact else rank_error(sketches.k))
+                for name, sketch in found if sketch is not None
+            ]
+            return iter(results) if stream else results
+
+        params = {}
+        key_expr = QUANTILE_KEYS[dimension]
+        condition = self._quantile_key_condition(params, dimension, key)
+        # Only the flights at the rank of a quantile, ceil(fraction * flights),
+        # leave SQLite, instead of every delay
+        params.update((f'q{index}', fraction) for index, fraction in enumerate(quantiles))
+        ranks = ' OR '.join(
+            f"position = MAX(CAST(:q{index} * flights AS INTEGER)"
+            f" + (:q{index} * flights > CAST(:q{index} * flights AS INTEGER)), 1)"
+            for index in range(len(quantiles)))
+        query = f"""
+        WITH ranked AS (
+            SELECT {key_expr} AS key, DEPARTURE_DELAY AS delay,
+                   ROW_NUMBER() OVER keys AS position,
+                   COUNT(*) OVER (keys ROWS BETWEEN UNBOUNDED PRECEDING
+                                  AND UNBOUNDED FOLLOWING) AS flights
+            FROM flights
+            LEFT JOIN airlines ON flights.airline = airlines.id
+            WHERE {VALID_DELAY} {condition}
+            -- One sort by key and delay serves both window functions
+            WINDOW keys AS (PARTITION BY {key_expr} ORDER BY DEPARTURE_DELAY)
+        )
+        SELECT key, flights, position, delay
+        FROM ranked
+        WHERE {ranks}
+        ORDER BY key, position
+        """
+        ranked = {}
+        for name, count, position, delay in self._execute_query(query, params,
+                                                                 as_tuples=True):
+            ranked.setdefault(name, (count, {}))[1][position] = delay
+        with profiling.phase('materialization'):
+            # The same definition as the sketches: the smallest delay whose
+            # rank reaches the fraction
+            results = [
+                self._quantile_row(
+                    dimension, None if dimension is None else name, count,
+                    [delays[max(math.ceil(fraction * count), 1)] for fraction in quantiles],
+                    quantiles, 0.0)
+                for name, (count, delays) in ranked.items()
+            ]
+        return iter(results) if stream else results
+
+
+    @staticmethod
+    def _quantile_key_condition(params, dimension, key):
+        """
+        Build the condition selecting the flights of one quantile key.
+        :param params: Query parameters, updated in place.
+        :param dimension: One of QUANTILE_DIMENSIONS, or None for all flights.
+        :param key: Route, airline name or origin airport code, or None.
+        :return: SQL condition string starting with AND, or an empty string.
+        """
+        if key is None or dimension is None:
+            return ''
+        if dimension == 'route':
+            params['origin'], _, params['destination'] = key.partition('-')
+            return "AND ORIGIN_AIRPORT = :origin AND DESTINATION_AIRPORT = :destination"
+        params['key'] = key
+        if dimension == 'airline':
+            return "AND flights.AIRLINE = (SELECT ID FROM airlines WHERE airline = :key)"
+        return "AND ORIGIN_AIRPORT = :key"
+
+
+    @staticmethod
+    def _quantile_row(dimension, key, count, values, quantiles, error):
+        """
+        Format the delay quantiles of one key.
+        :param dimension: One of QUANTILE_DIMENSIONS, or None for all flights.
+        :param key: Key of the dimension.
+        :param count: Number of flights.
+        :param values: Delay of every quantile.
+        :param quantiles: Fractions of the quantiles.
+        :param error: Rank error of the values.
+        :return: Dictionary.
+        """
+        if dimension == 'route':
+            origin, _, destination = key.partition('-')
+            row = {'origin_airport': origin, 'destination_airport': destination}
+        elif dimension == 'airline':
+            row = {'airline': key}
+        elif dimension == 'airport':
+            row = {'origin_airport': key}
+        else:
+            row = {}
+        row['flights'] = count
+        row.update((f"p{fraction * 100:g}", None if value is None else float(value))
+                   for fraction, value in zip(quantiles, values))
+        row['rank_error'] = round(error, 4)
+        return row
+
+
+    def _route_delay_counts(self):
+        """
+        Count the completed and delayed flights of every route, from the
+        rollup when it exists.
+        :return: List of dictionaries with origin_airport,
+                 destination_airport, total_flights and delayed_flights.
+        """
+        if self._rollups_current():
+            query = """
+            SELECT ORIGIN_AIRPORT AS origin_airport,
+                   DESTINATION_AIRPORT AS destination_airport,
+                   SUM(completed_count) AS total_flights,
+                   SUM(completed_delayed_count) AS delayed_flights
+            FROM route_rollup
+            GROUP BY ORIGIN_AIRPORT, DESTINATION_AIRPORT
+            HAVING SUM(completed_count) > 0
+            """
+        else:
+            query = f"""
+            SELECT f.ORIGIN_AIRPORT AS origin_airport,
+                   f.DESTINATION_AIRPORT AS destination_airport,
+                   COUNT(*) AS total_flights,
+                   SUM(CASE WHEN {self._delayed_expr('f')}
+                            THEN 1 ELSE 0 END) AS delayed_flights
+            FROM flights f
+            WHERE f.CANCELLED = 0 AND f.DIVERTED = 0
+            GROUP BY f.ORIGIN_AIRPORT, f.DESTINATION_AIRPORT
+            """
+        return self._execute_query(query)
+
     def get_flight_delays_heatmap(self):
         """
         Retrieve a heatmap of flight delays between airports.
         :return: DataFrame with origin, destination, and percentage of
                 delayed flights.
         """
-        query = """
-        SELECT f.ORIGIN_AIRPORT AS origin_airport,
-               f.DESTINATION_AIRPORT AS destination_airport,
-               COUNT(*) AS total_flights,
-               SUM(CASE WHEN COALESCE(NULLIF(f.DEPARTURE_DELAY, ''), 0) > 20
-                        THEN 1 ELSE 0 END) AS delayed_flights
-        FROM flights f
-        WHERE f.CANCELLED = 0 AND f.DIVERTED = 0
-        GROUP BY f.ORIGIN_AIRPORT, f.DESTINATION_AIRPORT
-        """
-        results = self._execute_query(query)
-        new_data_frame = pd.DataFrame(results)
-        new_data_frame['percentage'] = (
-            (new_data_frame['delayed_flights'] / new_data_frame['total_flights']) * 100
-        )
-        return new_data_frame[['origin_airport', 'destination_airport', 'percentage']]
+        # pandas is only needed here, so it is not loaded at startup
+        import pandas as pd  # pylint: disable=import-outside-toplevel
+        results = self._route_delay_counts()
+        if not results:
+            return pd.DataFrame(
+                columns=['origin_airport', 'destination_airport', 'percentage']
+            )
+        with profiling.phase('materialization'):
+            new_data_frame = pd.DataFrame(results)
+            new_data_frame['percentage'] = (
+                (new_data_frame['delayed_flights'] / new_data_frame['total_flights']) * 100
+            )
+            return new_data_frame[['origin_airport', 'destination_airport', 'percentage']]
 
-    def get_delayed_flights_average_per_route(self):
+    def get_flight_delays_heatmap_matrix(self, top_n=None, min_flights=1):
+        """
+        Retrieve the heatmap of flight delays between airports as a sparse
+        matrix, optionally limited to the busiest airports.
+        :param top_n: Only keep routes between the top_n airports with the
+                      most flights.
+        :param min_flights: Only keep routes with at least this many flights.
+        :return: RouteMatrix.
+        """
+        from heatmap import RouteMatrix  # pylint: disable=import-outside-toplevel
+        results = self._route_delay_counts()
+        with profiling.phase('materialization'):
+            return RouteMatrix.from_counts(
+                [row['origin_airport'] for row in results],
+                [row['destination_airport'] for row in results],
+                [row['total_flights'] for row in results],
+                [row['delayed_flights'] for row in results],
+                top_n, min_flights)
+
+    def get_delayed_flights_average_per_route(self, stream=False):
         """
         Retrieve average percentage of delayed flights per route.
+        :param stream: If True, return a generator instead of a list.
         :return: List of dictionaries containing average delay percentages.
         """
-        query = """
-        WITH flight_data AS (
-            SELECT f.ORIGIN_AIRPORT,
-                   f.DESTINATION_AIRPORT,
-                   COUNT(*) AS total_count,
-                   SUM(CASE WHEN COALESCE(NULLIF(f.DEPARTURE_DELAY, ''), 0) > 20 
-                            THEN 1 ELSE 0 END) AS delay_count,
-                   (SUM(CASE WHEN f.DEPARTURE_DELAY >= 20 
-                             THEN 1 ELSE 0 END) * 100.0 / COUNT(*)) AS percentage,
-                   ao.LATITUDE AS origin_latitude,
-                   ao.LONGITUDE AS origin_longitude,
-                   ad.LATITUDE AS destination_latitude,
-                   ad.LONGITUDE AS destination_longitude
-            FROM flights f
-            JOIN airports ao ON f.ORIGIN_AIRPORT = ao.IATA_CODE
-            JOIN airports ad ON f.DESTINATION_AIRPORT = ad.IATA_CODE
-            GROUP BY f.ORIGIN_AIRPORT, f.DESTINATION_AIRPORT
-        ),
-        average_percentage AS (
-            SELECT ORIGIN_AIRPORT,
-                   DESTINATION_AIRPORT,
-                   AVG(percentage) AS avg_percentage,
-                   AVG(origin_latitude) AS origin_latitude,
-                   AVG(origin_longitude) AS origin_longitude,
-                   AVG(destination_latitude) AS destination_latitude,
-                   AVG(destination_longitude) AS destination_longitude
-            FROM flight_data
-            GROUP BY ORIGIN_AIRPORT, DESTINATION_AIRPORT
-        )
-        SELECT origin_latitude,
-               origin_longitude,
-               destination_latitude,
-               destination_longitude,
-               avg_percentage
-        FROM average_percentage
-        """
-        return self._execute_query(query)
+        if self._rollups_current():
+            query = """
+            SELECT AVG(ao.LATITUDE) AS origin_latitude,
+                   AVG(ao.LONGITUDE) AS origin_longitude,
+                   AVG(ad.LATITUDE) AS destination_latitude,
+                   AVG(ad.LONGITUDE) AS destination_longitude,
+                   SUM(r.delayed_count) * 100.0 / SUM(r.total_count) AS avg_percentage
+            FROM route_rollup r
+            JOIN airports ao ON r.ORIGIN_AIRPORT = ao.IATA_CODE
+            JOIN airports ad ON r.DESTINATION_AIRPORT = ad.IATA_CODE
+            GROUP BY r.ORIGIN_AIRPORT, r.DESTINATION_AIRPORT
+            HAVING SUM(r.total_count) > 0
+            """
+        else:
+            query = f"""
+            WITH flight_data AS (
+                SELECT f.ORIGIN_AIRPORT,
+                       f.DESTINATION_AIRPORT,
+                       COUNT(*) AS total_count,
+                       SUM(CASE WHEN {self._delayed_expr('f')}
+                                THEN 1 ELSE 0 END) AS delay_count,
+                       (SUM(CASE WHEN {self._delayed_expr('f')}
+                                 THEN 1 ELSE 0 END) * 100.0 / COUNT(*)) AS percentage,
+                       ao.LATITUDE AS origin_latitude,
+                       ao.LONGITUDE AS origin_longitude,
+                       ad.LATITUDE AS destination_latitude,
+                       ad.LONGITUDE AS destination_longitude
+                FROM flights f
+                JOIN airports ao ON f.ORIGIN_AIRPORT = ao.IATA_CODE
+                JOIN airports ad ON f.DESTINATION_AIRPORT = ad.IATA_CODE
+                GROUP BY f.ORIGIN_AIRPORT, f.DESTINATION_AIRPORT
+            ),
+            average_percentage AS (
+                SELECT ORIGIN_AIRPORT,
+                       DESTINATION_AIRPORT,
+                       AVG(percentage) AS avg_percentage,
+                       AVG(origin_latitude) AS origin_latitude,
+                       AVG(origin_longitude) AS origin_longitude,
+                       AVG(destination_latitude) AS destination_latitude,
+                       AVG(destination_longitude) AS destination_longitude
+                FROM flight_data
+                GROUP BY ORIGIN_AIRPORT, DESTINATION_AIRPORT
+            )
+            SELECT origin_latitude,
+                   origin_longitude,
+                   destination_latitude,
+                   destination_longitude,
+                   avg_percentage
+            FROM average_percentage
+            """
+        return self._execute_query(query, stream=stream)
 
 
-    def get_delayed_flights_per_route_map(self, day, month, year):
+    def get_delayed_flights_per_route_map(self, day, month, year, stream=False):
         """
         Retrieve delayed flights per route with percentage of
         delays for a specific date.
         :param day: Day of the flights.
         :param month: Month of the flights.
         :param year: Year of the flights.
+        :param stream: If True, return a generator instead of a list.
         :return: List of dictionaries containing percentage of
         delayed flights per route.
         """
         params = {'day': day, 'month': month, 'year': year}
-        query = """
-        SELECT ORIGIN_AIRPORT AS origin_airport,
-               DESTINATION_AIRPORT AS destination_airport,
-               (SUM(CASE WHEN COALESCE(NULLIF(DEPARTURE_DELAY, ''), 0) > 20
-                        THEN 1 ELSE 0 END) * 100.0 / COUNT(*)) AS percentage
-        FROM flights
-        GROUP BY ORIGIN_AIRPORT, DESTINATION_AIRPORT
+        if self._rollups_current():
+            query = """
+            SELECT ORIGIN_AIRPORT AS origin_airport,
+                   DESTINATION_AIRPORT AS destination_airport,
+                   SUM(delayed_count) * 100.0 / SUM(total_count) AS percentage
+            FROM route_day_rollup
+            WHERE YEAR = :year AND MONTH = :month AND DAY = :day
+            GROUP BY ORIGIN_AIRPORT, DESTINATION_AIRPORT
+            """
+        else:
+            query = f"""
+            SELECT ORIGIN_AIRPORT AS origin_airport,
+                   DESTINATION_AIRPORT AS destination_airport,
+                   (SUM(CASE WHEN {self._delayed_expr()}
+                            THEN 1 ELSE 0 END) * 100.0 / COUNT(*)) AS percentage
+            FROM flights
+            WHERE YEAR = :year AND MONTH = :month AND DAY = :day
+            GROUP BY ORIGIN_AIRPORT, DESTINATION_AIRPORT
+            """
+        return self._execute_query(query, params, stream)
+
+
+    def get_delayed_flights_per_route_map_range(self, start, end, stream=False):
         """
-        return self._execute_query(query, params)
+        Retrieve delayed flights per route with percentage of delays over a
+        range of dates.
+        :param start: First date.
+        :param end: Last date, included.
+        :param stream: If True, return a generator instead of a list.
+        :return: List of dictionaries containing percentage of
+        delayed flights per route.
+        """
+        params = {}
+        if self._rollups_current():
+            query = f"""
+            SELECT ORIGIN_AIRPORT AS origin_airport,
+                   DESTINATION_AIRPORT AS destination_airport,
+                   SUM(delayed_count) * 100.0 / SUM(total_count) AS percentage
+            FROM route_day_rollup
+            WHERE {self._rollup_range_condition(params, start, end)}
+            GROUP BY ORIGIN_AIRPORT, DESTINATION_AIRPORT
+            """
+        else:
+            query = f"""
+            SELECT ORIGIN_AIRPORT AS origin_airport,
+                   DESTINATION_AIRPORT AS destination_airport,
+                   (SUM(CASE WHEN {self._delayed_expr()}
+                            THEN 1 ELSE 0 END) * 100.0 / COUNT(*)) AS percentage
+            FROM flights
+            WHERE {self._date_range_condition(params, start, end)}
+            GROUP BY ORIGIN_AIRPORT, DESTINATION_AIRPORT
+            """
+        return self._execute_query(query, params, stream)
+
+
+    @staticmethod
+    def _rollup_range_condition(params, start, end):
+        """
+        Build the condition selecting the days of a range of dates from
+        route_day_rollup.
+        :param params: Query parameters, updated in place.
+        :param start: First date.
+        :param end: Last date, included.
+        :return: SQL condition string.
+        """
+        params.update({'start_year': start.year, 'start_month': start.month,
+                       'start_day': start.day, 'end_year': end.year,
+                       'end_month': end.month, 'end_day': end.day})
+        # The row values compare in date order on the rollup's key
+        return ("(YEAR, MONTH, DAY) BETWEEN (:start_year, :start_month, :start_day) "
+                "AND (:end_year, :end_month, :end_day)")
+
+
+    def get_top_delayed(self, dimension, k=TOP_K, min_flights=1, start=None, end=None,
+                        stream=False):
+        """
+        Retrieve the k routes, origin airports or airlines with the highest
+        share of delayed flights. The flights are counted per key from the
+        rollup tables when they exist, keys under the volume threshold are
+        left out by SQLite, and a heap of k rows picks the worst of the
+        remaining counts as they are read, instead of sorting all of them.
+        :param dimension: One of TOP_DIMENSIONS.
+        :param k: Number of rows to return.
+        :param min_flights: Only rank keys with at least this many flights.
+        :param start: Optional first date of the flights counted.
+        :param end: Last date, included; required with start.
+        :param stream: If True, return a generator instead of a list.
+        :return: List of dictionaries with the key columns, flights,
+                 delayed_flights and percentage, worst first; ties go to
+                 the key with more flights.
+        """
+        key_columns, group_columns = TOP_DIMENSIONS[dimension]
+        params = {'min_flights': max(int(min_flights), 1)}
+        if self._rollups_current():
+            table = 'route_rollup' if start is None else 'route_day_rollup'
+            total, delayed = "SUM(source.total_count)", "SUM(source.delayed_count)"
+            condition = '' if start is None else \
+                f"WHERE {self._rollup_range_condition(params, start, end)}"
+        else:
+            table = 'flights'
+            total = "COUNT(*)"
+            delayed = f"SUM(CASE WHEN {self._delayed_expr('source')} THEN 1 ELSE 0 END)"
+            condition = '' if start is None else \
+                f"WHERE {self._date_range_condition(params, start, end, 'source')}"
+        join = ("LEFT JOIN airlines ON source.AIRLINE = airlines.ID"
+                if dimension == 'airline' else '')
+        query = f"""
+        SELECT {key_columns}, {total} AS flights, {delayed} AS delayed_flights
+        FROM {table} AS source
+        {join}
+        {condition}
+        GROUP BY {group_columns}
+        HAVING {total} >= :min_flights
+        """
+        counted = self._execute_query(query, params, stream=True, as_tuples=True)
+        try:
+            # Rows end with the flights and the delayed flights of the key
+            worst = heapq.nlargest(int(k), counted,
+                                   key=lambda row: (row[-1] / row[-2], row[-2]))
+        finally:
+            counted.close()
+        with profiling.phase('materialization'):
+            results = []
+            for row in worst:
+                result = dict(zip(counted.columns, row))
+                result['percentage'] = row[-1] * 100.0 / row[-2]
+                results.append(result)
+        return iter(results) if stream else results
+
+
+    def get_airport_registry(self):
+        """
+        Return the airports with valid coordinates as an AirportRegistry.
+        The registry is built once and rebuilt when the database changes.
+        :return: AirportRegistry instance.
+        """
+        version, registry = self._airport_registry
+        current = self.data_version()
+        if registry is None or version != current:
+            from airports import AirportRegistry  # pylint: disable=import-outside-toplevel
+            registry = AirportRegistry(self._execute_query("""
+            SELECT IATA_CODE, AIRPORT, CITY, STATE, LATITUDE, LONGITUDE
+            FROM airports
+            """))
+            self._airport_registry = (current, registry)
+        return registry
+
+
+    def get_delay_cube(self):
+        """
+        Return the delay cube built by cube.py, memory-mapped once and
+        looked up again when the database or the cube changes.
+        :return: DelayCube, or None if it is missing or out of date.
+        """
+        # pylint: disable=import-outside-toplevel
+        from cube import cube_version, load_cube
+        # The cube is built from the database file, also for subclasses
+        # whose data_version() tracks other files
+        database_version = FlightData.data_version(self)
+        current = (database_version, cube_version(self._engine.url))
+        version, cube = self._delay_cube
+        if version != current:
+            cube = load_cube(self._engine.url, database_version)
+            self._delay_cube = (current, cube)
+        return cube
+
+
+    def get_quantile_sketches(self):
+        """
+        Return the delay quantile sketches built by sketches.py, read once
+        and looked up again when the database or the sketches change.
+        :return: QuantileSketches, or None if they are missing or out of date.
+        """
+        # pylint: disable=import-outside-toplevel
+        from sketches import load_sketches, sketches_version
+        database_version = FlightData.data_version(self)
+        current = (database_version, sketches_version(self._engine.url))
+        version, sketches = self._quantile_sketches
+        if version != current:
+            sketches = load_sketches(self._engine.url, database_version)
+            self._quantile_sketches = (current, sketches)
+        return sketches
 
 
     def get_airport_coordinates(self):
@@ -270,31 +1302,478 @@ class FlightData:
         :return: Dictionary with airport IATA codes as keys and
                 tuples of (latitude, longitude) as values.
         """
-        query = """
-        SELECT IATA_CODE, LATITUDE, LONGITUDE 
-        FROM airports
-        """
-        results = self._execute_query(query)
-        coordinates = {}
-        for row in results:
-            iata_code = row['IATA_CODE']
-            latitude = row['LATITUDE']
-            longitude = row['LONGITUDE']
-            if latitude and longitude:
-                try:
-                    latitude = float(latitude)
-                    longitude = float(longitude)
-                    coordinates[iata_code] = (latitude, longitude)
-                except ValueError:
-                    logging.warning(
-                        "Invalid coordinate values for %s: %s, %s",
-                        iata_code, latitude, longitude
-                    )
+        return self.get_airport_registry().as_dict()
+
+
+    def get_nearest_airports(self, latitude, longitude, count=1):
+        """
+        Retrieve the airports closest to a point.
+        :param latitude: Latitude in degrees.
+        :param longitude: Longitude in degrees.
+        :param count: Number of airports to return.
+        :return: List of dictionaries with airport details and DISTANCE_KM,
+                 nearest first.
+        """
+        return self.get_airport_registry().nearest(latitude, longitude, count)
+
+
+    def get_airports_within_radius(self, latitude, longitude, radius_km):
+        """
+        Retrieve the airports within a distance of a point.
+        :param latitude: Latitude in degrees.
+        :param longitude: Longitude in degrees.
+        :param radius_km: Radius in kilometres.
+        :return: List of dictionaries with airport details and DISTANCE_KM,
+                 nearest first.
+        """
+        return self.get_airport_registry().within_radius(latitude, longitude, radius_km)
+
+
+    def get_airports_in_bbox(self, south, west, north, east):
+        """
+        Retrieve the airports inside a bounding box such as a map viewport.
+        :param south: Southern latitude in degrees.
+        :param west: Western longitude in degrees.
+        :param north: Northern latitude in degrees.
+        :param east: Eastern longitude in degrees; smaller than west for
+                     boxes crossing the antimeridian.
+        :return: List of dictionaries with airport details.
+        """
+        return self.get_airport_registry().within_bbox(south, west, north, east)
+
+
+    def optimize_schema(self):
+        """
+        Add the normalized DELAY_MINUTES, IS_DELAYED and FLIGHT_DATE columns
+        to the flights table, with triggers that fill them for rows inserted
+        or updated later, and build the indexes used by the queries. Rows
+        left unfilled are normalized, so it is safe to run again.
+        """
+        with self._engine.begin() as connection:
+            if not self._has_flight_column('DELAY_MINUTES'):
+                connection.execute(text(
+                    "ALTER TABLE flights ADD COLUMN DELAY_MINUTES INTEGER"))
+                connection.execute(text(
+                    "ALTER TABLE flights ADD COLUMN IS_DELAYED INTEGER"))
+            if not self._has_flight_column('FLIGHT_DATE'):
+                connection.execute(text(
+                    "ALTER TABLE flights ADD COLUMN FLIGHT_DATE INTEGER"))
+            connection.execute(text(f"""
+            UPDATE flights SET {NORMALIZED_VALUES}
+            WHERE DELAY_MINUTES IS NULL OR IS_DELAYED IS NULL OR FLIGHT_DATE IS NULL
+            """))
+            for name, definition in SCHEMA_TRIGGERS.items():
+                connection.execute(text(
+                    f"CREATE TRIGGER IF NOT EXISTS {name} {definition}"))
+            for name, definition in SCHEMA_INDEXES.items():
+                connection.execute(text(
+                    f"CREATE INDEX IF NOT EXISTS {name} ON {definition}"))
+            connection.execute(text("ANALYZE"))
+        self._optimized = True
+        self._has_flight_date = True
+
+
+    def _recorded_rollup_version(self):
+        """
+        Return the data_version() recorded by the last refresh_rollups().
+        :return: Version string, or None if none was recorded.
+        """
+        path = rollup_metadata_path(self._engine.url)
+        if path is None:
+            return FlightData.data_version(self)
+        try:
+            with open(path, encoding='utf-8') as file:
+                return json.load(file)['data_version']
+        except (OSError, ValueError, KeyError):
+            return None
+
+
+    def _rollups_current(self):
+        """
+        Check whether the rollup tables can answer queries: they exist and
+        no flights were written since refresh_rollups() last ran. Queries
+        read the flights table otherwise.
+        :return: True if the rollup tables are up to date.
+        """
+        if not self._has_rollups:
+            return False
+        # The rollups are in the database file, also for subclasses whose
+        # data_version() tracks other files
+        current = FlightData.data_version(self)
+        version, up_to_date = self._rollup_state
+        if version != current:
+            up_to_date = self._recorded_rollup_version() == current
+            self._rollup_state = (current, up_to_date)
+        return up_to_date
+
+
+    def refresh_rollups(self, days=None):
+        """
+        Bring the rollup tables up to date with the flights table. Only days
+        that have not been rolled up yet are aggregated, unless the database
+        was written since the last refresh: the rollups are then rebuilt
+        from all flights, as the writes may have changed days already rolled
+        up. Days passed in explicitly are recomputed, e.g. after loading or
+        correcting their flights, and the rollups then count as up to date.
+        :param days: Optional iterable of (day, month, year) tuples.
+        :return: Number of days aggregated.
+        """
+        rebuild = days is None and (
+            self._recorded_rollup_version() != FlightData.data_version(self))
+        counts = ', '.join(ROLLUP_COUNTS)
+        totals = ', '.join(f'SUM({name})' for name in ROLLUP_COUNTS)
+        negated = ', '.join(f'-SUM({name})' for name in ROLLUP_COUNTS)
+        accumulate = ', '.join(f'{name} = {name} + excluded.{name}'
+                               for name in ROLLUP_COUNTS)
+        upsert = f"""
+        INSERT INTO route_rollup
+            (ORIGIN_AIRPORT, DESTINATION_AIRPORT, AIRLINE, {counts})
+        SELECT ORIGIN_AIRPORT, DESTINATION_AIRPORT, AIRLINE, {{}}
+        FROM route_day_rollup
+        WHERE (YEAR, MONTH, DAY) IN (SELECT YEAR, MONTH, DAY FROM pending_days)
+        GROUP BY ORIGIN_AIRPORT, DESTINATION_AIRPORT, AIRLINE
+        ON CONFLICT (ORIGIN_AIRPORT, DESTINATION_AIRPORT, AIRLINE)
+        DO UPDATE SET {accumulate}
+        """
+        delay = self._delay_expr()
+        delayed = f"CASE WHEN {self._delayed_expr()} THEN 1 ELSE 0 END"
+        completed = "(flights.CANCELLED = 0 AND flights.DIVERTED = 0)"
+
+        with self._engine.begin() as connection:
+            for statement in ROLLUP_SCHEMA:
+                connection.execute(text(statement))
+            connection.execute(text("DROP TABLE IF EXISTS temp.pending_days"))
+            connection.execute(text(
+                "CREATE TEMP TABLE pending_days (YEAR, MONTH, DAY)"))
+            if rebuild:
+                for table in ('route_rollup', 'route_day_rollup', 'rollup_days'):
+                    connection.execute(text(f"DELETE FROM {table}"))
+            if days is None:
+                connection.execute(text("""
+                INSERT INTO pending_days
+                SELECT DISTINCT YEAR, MONTH, DAY FROM flights
+                EXCEPT SELECT YEAR, MONTH, DAY FROM rollup_days
+                """))
             else:
-                logging.warning("Missing coordinate values for %s", iata_code)
-        return coordinates
+                connection.execute(
+                    text("INSERT INTO pending_days VALUES (:year, :month, :day)"),
+                    [{'day': int(day), 'month': int(month), 'year': int(year)}
+                     for day, month, year in days]
+                )
+            pending = connection.execute(
+                text("SELECT COUNT(*) FROM pending_days")).scalar()
+
+            # Back out any previous totals of recomputed days
+            connection.execute(text(upsert.format(negated)))
+            connection.execute(text("""
+            DELETE FROM route_day_rollup
+            WHERE (YEAR, MONTH, DAY) IN (SELECT YEAR, MONTH, DAY FROM pending_days)
+            """))
+            connection.execute(text(f"""
+            INSERT INTO route_day_rollup
+            SELECT flights.YEAR, flights.MONTH, flights.DAY,
+                   flights.ORIGIN_AIRPORT, flights.DESTINATION_AIRPORT,
+                   flights.AIRLINE,
+                   COUNT(*),
+                   SUM({delayed}),
+                   SUM(flights.CANCELLED = 1),
+                   SUM(flights.DIVERTED = 1),
+                   SUM({delay}),
+                   SUM({completed}),
+                   SUM({completed} AND {self._delayed_expr()})
+            FROM flights
+            JOIN pending_days p ON flights.YEAR = p.YEAR
+                 AND flights.MONTH = p.MONTH AND flights.DAY = p.DAY
+            GROUP BY flights.YEAR, flights.MONTH, flights.DAY,
+                     flights.ORIGIN_AIRPORT, flights.DESTINATION_AIRPORT,
+                     flights.AIRLINE
+            """))
+            connection.execute(text(upsert.format(totals)))
+            connection.execute(text("""
+            INSERT OR IGNORE INTO rollup_days
+            SELECT YEAR, MONTH, DAY FROM pending_days
+            """))
+            connection.execute(text("DROP TABLE temp.pending_days"))
+        self._has_rollups = True
+        path = rollup_metadata_path(self._engine.url)
+        if path is not None:
+            # Recorded once the log is checkpointed, as that changes the version
+            self.checkpoint()
+            with open(path + '.tmp', 'w', encoding='utf-8') as file:
+                json.dump({'data_version': FlightData.data_version(self)}, file)
+            os.replace(path + '.tmp', path)
+        self._rollup_state = (None, False)
+        return pending
+
+
+    def _explain_query(self, query, params=None):
+        """
+        Run EXPLAIN QUERY PLAN for a query.
+        :param query: SQL query to explain.
+        :param params: Parameters for the SQL query.
+        :return: List of plan detail strings.
+        """
+        try:
+            with self._engine.connect() as connection:
+                result = connection.execute(
+                    text(f"EXPLAIN QUERY PLAN {query}"), params or {})
+                return [row.detail for row in result]
+        except SQLAlchemyError as ex:
+            logging.error("SQLAlchemy Error: %s", ex)
+            return []
+
+
+    def _sample_arguments(self):
+        """
+        Pick arguments for every public query method from the first flight.
+        :return: Dictionary mapping method names to argument tuples.
+        """
+        rows = self._execute_query("""
+        SELECT flights.ID, flights.DAY, flights.MONTH, flights.YEAR,
+               flights.ORIGIN_AIRPORT, airlines.airline
+        FROM flights JOIN airlines ON flights.airline = airlines.id
+        LIMIT 1
+        """)
+        if not rows:
+            return {}
+        row = rows[0]
+        day = (row['DAY'], row['MONTH'], row['YEAR'])
+        first_date = date(row['YEAR'], row['MONTH'], row['DAY'])
+        arguments = {
+            'get_flight_by_id': (row['ID'],),
+            'get_flights_by_ids': (list(range(row['ID'], row['ID'] + 2 * ID_BATCH_SIZE)),),
+            'get_flights_by_date': day,
+            'get_delayed_flights_by_airline': (row['AIRLINE'],),
+            'get_all_delayed_flights_grouped_by_airline': (),
+            'get_delayed_flights_by_airport': (row['ORIGIN_AIRPORT'],),
+            'get_delayed_flights_per_hour': day,
+            'get_hourly_delays': (first_date, first_date + timedelta(days=30),
+                                  row['AIRLINE'], row['ORIGIN_AIRPORT']),
+            'get_flight_delays_heatmap': (),
+            'get_flight_delays_heatmap_matrix': (),
+            'get_delayed_flights_average_per_route': (),
+            'get_delayed_flights_per_route_map': day,
+            'get_airport_coordinates': (),
+            'get_delay_quantiles': ('airline', row['AIRLINE']),
+            'get_flights_by_date_range': (first_date, first_date + timedelta(days=13)),
+            'get_delayed_flights_per_route_map_range': (first_date,
+                                                        first_date + timedelta(days=13)),
+            'get_top_delayed': ('route', TOP_K, 10, first_date,
+                                first_date + timedelta(days=13)),
+        }
+        coordinates = self.get_airport_registry().coordinates(row['ORIGIN_AIRPORT'])
+        if coordinates:
+            latitude, longitude = coordinates
+            arguments.update({
+                'get_nearest_airports': (latitude, longitude, 5),
+                'get_airports_within_radius': (latitude, longitude, 500),
+                'get_airports_in_bbox': (latitude - 5, longitude - 5,
+                                         latitude + 5, longitude + 5),
+            })
+        return arguments
+
+
+    def query_plans(self, arguments=None):
+        """
+        Collect the EXPLAIN QUERY PLAN output of every public query method.
+        :param arguments: Dictionary mapping method names to argument tuples;
+                          defaults to arguments taken from the first flight.
+        :return: Dictionary mapping method names to lists of plan details.
+        """
+        arguments = self._sample_arguments() if arguments is None else arguments
+        plans = {}
+        for name, args in arguments.items():
+            self._plan_capture = []
+            try:
+                getattr(self, name)(*args)
+                plans[name] = [detail for plan in self._plan_capture
+                               for detail in plan]
+            finally:
+                self._plan_capture = None
+        return plans
+
+
+    def __init_subclass__(cls, **kwargs):
+        """Instrument the query methods that backends override."""
+        super().__init_subclass__(**kwargs)
+        metrics.instrument_methods(cls, QUERY_METHODS)
 
 
     def __del__(self):
         """Dispose of the SQLAlchemy engine when the object is deleted."""
         self._engine.dispose()
+
+
+metrics.instrument_methods(FlightData, QUERY_METHODS)
+
+
+def date_ordinal(when):
+    """
+    Return the FLIGHT_DATE value of a date.
+    :param when: datetime.date.
+    :return: Integer YYYYMMDD.
+    """
+    return when.year * 10000 + when.month * 100 + when.day
+
+
+def _skip_header(rows):
+    """Yield the rows of FlightData._iter_query without its column names."""
+    if next(rows, None) is not None:
+        yield from rows
+
+
+def database_path(url):
+    """
+    Return the file path of a SQLite database URL, also for URLs that open
+    the file in URI mode ('file:...?uri=true').
+    :param url: SQLAlchemy URL.
+    :return: File path, ':memory:' or None.
+    """
+    path = url.database
+    if path and url.query.get('uri') == 'true' and path.startswith('file:'):
+        path = path[len('file:'):]
+    return path
+
+
+def rollup_metadata_path(url):
+    """
+    Return the path of the rollup metadata of a database.
+    :param url: SQLAlchemy URL.
+    :return: File path, e.g. data/flights_rollups.json for
+             sqlite:///data/flights.sqlite3, or None for in-memory databases.
+    """
+    path = database_path(url)
+    if not path or path == ':memory:':
+        return None
+    return f"{os.path.splitext(path)[0]}{ROLLUP_METADATA_SUFFIX}"
+
+
+def create_sqlite_engine(db_uri, profile=None):
+    """
+    Create the SQLAlchemy engine for a connection profile.
+    :param db_uri: Database URI.
+    :param profile: Name of an entry in CONNECTION_PROFILES, a dictionary
+                    with the same keys, or None for SQLAlchemy's defaults.
+    :return: SQLAlchemy engine.
+    """
+    if isinstance(profile, str):
+        if profile not in CONNECTION_PROFILES:
+            raise ValueError(f"Unknown connection profile: {profile}")
+        profile = CONNECTION_PROFILES[profile]
+    profile = profile or {}
+    url = make_url(db_uri)
+    path = database_path(url)
+    on_disk = bool(path) and path != ':memory:'
+
+    # The journal mode is stored in the database file, so it is set once
+    # through a short-lived writable connection
+    if profile.get('journal_mode') and on_disk and os.path.exists(path):
+        try:
+            with sqlite3.connect(path) as connection:
+                connection.execute(f"PRAGMA journal_mode = {profile['journal_mode']}")
+        except sqlite3.Error as ex:
+            logging.warning("Could not set journal mode: %s", ex)
+    if profile.get('read_only') and on_disk:
+        url = url.set(database=f"file:{path}",
+                      query={**url.query, 'mode': 'ro', 'uri': 'true'})
+
+    options = {}
+    if profile.get('pool_size'):
+        # Threads beyond pool_size wait for a connection instead of opening
+        # more; SingletonThreadPool is not used because it closes connections
+        # still in use once a threaded server has run more than pool_size threads
+        options.update(poolclass=QueuePool, pool_size=profile['pool_size'],
+                       max_overflow=0, pool_use_lifo=True)
+    engine = create_engine(url, **options)
+
+    pragmas = [f"PRAGMA {name} = {profile[name]}"
+               for name in CONNECTION_PRAGMAS if name in profile]
+    if pragmas:
+        @event.listens_for(engine, 'connect')
+        def apply_pragmas(dbapi_connection, _):
+            cursor = dbapi_connection.cursor()
+            for pragma in pragmas:
+                cursor.execute(pragma)
+            cursor.close()
+    return engine
+
+
+def create_flight_data(db_uri, backend='sql', connection_profile=None):
+    """
+    Create a FlightData instance for the requested backend.
+    :param db_uri: Database URI.
+    :param backend: 'sql' to query SQLite directly, 'columnar' to serve
+                    queries from in-memory NumPy arrays, or 'partitioned'
+                    to query the monthly partitions built by partitions.py.
+    :param connection_profile: Connection profile passed to FlightData.
+    :return: FlightData instance.
+    """
+    # The other backends subclass FlightData, so they are imported here
+    # pylint: disable=import-outside-toplevel
+    if backend == 'columnar':
+        from columnar import ColumnarFlightData
+        return ColumnarFlightData(db_uri, connection_profile=connection_profile)
+    if backend == 'partitioned':
+        from partitions import PartitionedFlightData
+        return PartitionedFlightData(db_uri, connection_profile=connection_profile)
+    if backend != 'sql':
+        raise ValueError(f"Unknown FlightData backend: {backend}")
+    return FlightData(db_uri, connection_profile=connection_profile)
+
+
+def is_full_scan(detail):
+    """
+    Check whether an EXPLAIN QUERY PLAN detail line is a full scan of the
+    flights table.
+    :param detail: Plan detail string, e.g. 'SCAN flights'.
+    :return: True if the step scans the flights table without an index.
+    """
+    words = detail.split()
+    return (len(words) >= 2 and words[0] == 'SCAN'
+            and words[1] in ('flights', 'f') and 'INDEX' not in words)
+
+
+def print_plan_report(before, after):
+    """
+    Print the query plans of every method before and after optimization.
+    :param before: Plans returned by query_plans() before optimize_schema().
+    :param after: Plans returned by query_plans() after optimize_schema().
+    """
+    for name in after:
+        print(name)
+        for label, plans in (('before', before), ('after', after)):
+            print(f"  {label}:")
+            for detail in plans.get(name, []):
+                if detail in PLAN_NOISE:
+                    continue
+                marker = '  <-- full scan' if is_full_scan(detail) else ''
+                print(f"    {detail}{marker}")
+
+
+def main():
+    """
+    Command-line entry point.
+    Usage: python data.py {optimize,rollups,plans} [--db DB_URI]
+    """
+    parser = argparse.ArgumentParser(description="Flight data maintenance")
+    parser.add_argument('command', choices=['optimize', 'rollups', 'plans'],
+                        help="'optimize' normalizes the schema and builds "
+                             "indexes, 'rollups' updates the rollup tables, "
+                             "'plans' prints the current query plans")
+    parser.add_argument('--db', default=DEFAULT_DB_URI, help="Database URI")
+    args = parser.parse_args()
+
+    data_manager = FlightData(args.db)
+    before = data_manager.query_plans()
+    if args.command == 'optimize':
+        data_manager.optimize_schema()
+        print_plan_report(before, data_manager.query_plans())
+    elif args.command == 'rollups':
+        days = data_manager.refresh_rollups()
+        print(f"Rolled up {days} days.")
+    else:
+        print_plan_report({}, before)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+"""
+heatmap.py
+This module provides RouteMatrix, the delay percentages of the routes
+between airports as a sparse matrix. Airports are coded as integer row and
+column indices and only the routes that were flown are stored, as
+coordinate arrays, instead of a dense airports-by-airports table that is
+mostly empty. The matrix can be limited to the busiest airports and to
+routes with a minimum number of flights.
+Dependencies:
+- numpy
+"""
+
+import numpy as np
+
+
+class RouteMatrix:
+    """
+    Delay percentages of routes in coordinate format: origin airports are
+    the rows, destination airports the columns, both sorted by IATA code.
+    """
+    def __init__(self, rows, columns, row_index, column_index, total_flights, percentages):
+        """
+        Initialize the matrix. Use from_counts to build one from route counts.
+
+        :param rows: Array of origin airport codes.
+        :param columns: Array of destination airport codes.
+        :param row_index: Row of every route.
+        :param column_index: Column of every route.
+        :param total_flights: Number of flights of every route.
+        :param percentages: Percentage of delayed flights of every route.
+        """
+        self.rows = rows
+        self.columns = columns
+        self.row_index = row_index
+        self.column_index = column_index
+        self.total_flights = total_flights
+        self.percentages = percentages
+
+
+    @classmethod
+    def from_counts(cls, origins, destinations, total_flights, delayed_flights,
+                    top_n=None, min_flights=1):
+        """
+        Build the matrix from flight counts per route.
+        :param origins: Origin airport code of every route.
+        :param destinations: Destination airport code of every route.
+        :param total_flights: Number of flights of every route.
+        :param delayed_flights: Number of delayed flights of every route.
+        :param top_n: Only keep routes between the top_n airports with the
+                      most flights, counting departures and arrivals.
+        :param min_flights: Only keep routes with at least this many flights.
+        :return: RouteMatrix.
+        """
+        origins = np.asarray(origins, dtype=str)
+        destinations = np.asarray(destinations, dtype=str)
+        totals = np.asarray(total_flights, dtype=np.int64)
+        delayed = np.asarray(delayed_flights, dtype=np.float64)
+
+        # Code all airports as integers to rank and filter them
+        airports, codes = np.unique(np.concatenate([origins, destinations]),
+                                    return_inverse=True)
+        origin_codes, destination_codes = np.split(codes.ravel(), 2)
+        keep = totals >= max(min_flights, 1)
+        if top_n is not None:
+            traffic = (np.bincount(origin_codes, weights=totals, minlength=len(airports))
+                       + np.bincount(destination_codes, weights=totals,
+                                     minlength=len(airports)))
+            busiest = np.zeros(len(airports), dtype=bool)
+            busiest[np.argsort(-traffic, kind='stable')[:top_n]] = True
+            keep &= busiest[origin_codes] & busiest[destination_codes]
+
+        rows, row_index = np.unique(origins[keep], return_inverse=True)
+        columns, column_index = np.unique(destinations[keep], return_inverse=True)
+        return cls(rows, columns, row_index.ravel(), column_index.ravel(), totals[keep],
+                   delayed[keep] / totals[keep] * 100)
+
+
+    def __len__(self):
+        return len(self.percentages)
+
+
+    @property
+    def shape(self):
+        """Number of rows and columns."""
+        return len(self.rows), len(self.columns)
+
+
+    def to_dense(self):
+        """
+        Expand the matrix to a NumPy array, for plotting.
+        :return: 2-D array of percentages with NaN where no route was flown.
+        """
+        dense = np.full(self.shape, np.nan)
+        dense[self.row_index, self.column_index] = self.percentages
+        return dense
+
+
+    def to_records(self):
+        """
+        Return the routes as dictionaries, in row-major order.
+        :return: List of dictionaries with origin_airport,
+                 destination_airport and percentage.
+        """
+        order = np.lexsort((self.column_index, self.row_index))
+        return [{'origin_airport': str(self.rows[row]),
+                 'destination_airport': str(self.columns[column]),
+                 'percentage': float(percentage)}
+                for row, column, percentage in zip(self.row_index[order],
+                                                   self.column_index[order],
+                                                   self.percentages[order])]
+
+
+    def to_dict(self):
+        """
+        Encode the matrix compactly for JSON: the row and column labels
+        once, and every route as a [row, column, percentage] triplet.
+        :return: Dictionary with rows, columns and values.
+        """
+        order = np.lexsort((self.column_index, self.row_index))
+        return {
+            'rows': self.rows.tolist(),
+            'columns': self.columns.tolist(),
+            'values': [[int(row), int(column), round(float(percentage), 4)]
+                       for row, column, percentage in zip(self.row_index[order],
+                                                          self.column_index[order],
+                                                          self.percentages[order])],
+        }
@@ -0,0 +1,313 @@
+"""
+ingest.py
+This module builds the flights SQLite database from the raw flights, airlines
+and airports CSV files. The flights file is read in chunks of lines that are
+parsed in parallel worker processes. The parsed rows are written with batched
+executemany calls inside large transactions, and the indexes and rollup
+tables are built once all rows are loaded.
+Usage:
+    python ingest.py --flights flights.csv --airlines airlines.csv \
+                     --airports airports.csv [--db sqlite:///data/flights.sqlite3]
+Dependencies:
+- sqlalchemy
+- data (FlightData class)
+"""
+
+import argparse
+import csv
+import itertools
+import multiprocessing
+import os
+import sqlite3
+import time
+from collections import deque
+from sqlalchemy.engine import make_url
+from data import FlightData, DEFAULT_DB_URI, DELAY_THRESHOLD
+
+# Columns of the flights CSV, in the order they are stored after the ID
+FLIGHT_CSV_COLUMNS = (
+    'YEAR', 'MONTH', 'DAY', 'DAY_OF_WEEK', 'AIRLINE', 'FLIGHT_NUMBER',
+    'TAIL_NUMBER', 'ORIGIN_AIRPORT', 'DESTINATION_AIRPORT',
+    'SCHEDULED_DEPARTURE', 'DEPARTURE_TIME', 'DEPARTURE_DELAY', 'TAXI_OUT',
+    'WHEELS_OFF', 'SCHEDULED_TIME', 'ELAPSED_TIME', 'AIR_TIME', 'DISTANCE',
+    'WHEELS_ON', 'TAXI_IN', 'SCHEDULED_ARRIVAL', 'ARRIVAL_TIME',
+    'ARRIVAL_DELAY', 'DIVERTED', 'CANCELLED', 'CANCELLATION_REASON',
+    'AIR_SYSTEM_DELAY', 'SECURITY_DELAY', 'AIRLINE_DELAY',
+    'LATE_AIRCRAFT_DELAY', 'WEATHER_DELAY',
+)
+TEXT_COLUMNS = {'TAIL_NUMBER', 'ORIGIN_AIRPORT', 'DESTINATION_AIRPORT',
+                'CANCELLATION_REASON'}
+# Normalized columns that FlightData.optimize_schema() would otherwise add
+NORMALIZED_COLUMNS = ('DELAY_MINUTES', 'IS_DELAYED', 'FLIGHT_DATE')
+
+FLIGHTS_SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS flights (
+    ID INTEGER,
+    {', '.join(f"{name} {'TEXT' if name in TEXT_COLUMNS else 'INTEGER'}"
+               for name in FLIGHT_CSV_COLUMNS + NORMALIZED_COLUMNS)}
+)
+"""
+AIRLINES_SCHEMA = """
+CREATE TABLE IF NOT EXISTS airlines (ID INTEGER, AIRLINE TEXT)
+"""
+AIRPORTS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS airports (
+    IATA_CODE TEXT, AIRPORT TEXT, CITY TEXT, STATE TEXT, COUNTRY TEXT,
+    LATITUDE REAL, LONGITUDE REAL
+)
+"""
+
+CHUNK_LINES = 50_000  # CSV lines parsed per worker task
+COMMIT_ROWS = 1_000_000  # Rows written per transaction
+# PRAGMAs for the load; durability is restored once the load is committed
+BULK_LOAD_PRAGMAS = (
+    'PRAGMA journal_mode = WAL',
+    'PRAGMA synchronous = OFF',
+    'PRAGMA cache_size = -262144',  # 256 MiB
+    'PRAGMA temp_store = MEMORY',
+)
+
+_worker_state = {}
+
+
+def _init_worker(header, airline_ids, normalized):
+    """
+    Set up a parser process.
+    :param header: Column names of the flights CSV.
+    :param airline_ids: Dictionary mapping airline IATA codes to airline IDs.
+    :param normalized: Whether to append the normalized columns.
+    """
+    _worker_state['positions'] = [header.index(name) for name in FLIGHT_CSV_COLUMNS]
+    _worker_state['text'] = [name in TEXT_COLUMNS for name in FLIGHT_CSV_COLUMNS]
+    _worker_state['airline'] = FLIGHT_CSV_COLUMNS.index('AIRLINE')
+    _worker_state['delay'] = FLIGHT_CSV_COLUMNS.index('DEPARTURE_DELAY')
+    _worker_state['date'] = [FLIGHT_CSV_COLUMNS.index(name) for name in ('YEAR', 'MONTH', 'DAY')]
+    _worker_state['airline_ids'] = airline_ids
+    _worker_state['normalized'] = normalized
+
+
+def _to_number(value):
+    """
+    Convert a CSV field to a number. Empty fields stay empty strings, as
+    the queries in FlightData expect.
+    """
+    if value == '':
+        return value
+    try:
+        return int(value)
+    except ValueError:
+        try:
+            return float(value)
+        except ValueError:
+            return value
+
+
+def _parse_chunk(task):
+    """
+    Parse a chunk of flights CSV lines into rows ready for insertion.
+    :param task: Tuple of (first flight ID, list of CSV lines).
+    :return: Tuple of (list of row tuples, set of the (day, month, year)
+             dates of the flights).
+    """
+    first_id, lines = task
+    positions = _worker_state['positions']
+    is_text = _worker_state['text']
+    airline = _worker_state['airline']
+    delay_index = _worker_state['delay']
+    airline_ids = _worker_state['airline_ids']
+    normalized = _worker_state['normalized']
+    year, month, day = _worker_state['date']
+
+    rows, days = [], set()
+    for flight_id, fields in enumerate(csv.reader(lines), first_id):
+        values = [fields[position] if text else _to_number(fields[position])
+                  for position, text in zip(positions, is_text)]
+        values[airline] = airline_ids.get(values[airline], values[airline])
+        days.add((values[day], values[month], values[year]))
+        row = [flight_id] + values
+        if normalized:
+            delay = values[delay_index] if values[delay_index] != '' else 0
+            # Text that is not a number compares greater than any number in
+            # SQLite, so optimize_schema() flags it as delayed as well
+            is_delayed = isinstance(delay, str) or delay > DELAY_THRESHOLD
+            row += [delay, int(is_delayed),
+                    values[year] * 10000 + values[month] * 100 + values[day]]
+        rows.append(tuple(row))
+    return rows, days
+
+
+def _read_chunks(csv_file, first_id):
+    """
+    Read the flights CSV in chunks of CHUNK_LINES lines.
+    :param csv_file: Open file positioned after the header line.
+    :param first_id: ID of the first flight.
+    :return: Generator of (first flight ID, lines) tuples.
+    """
+    while True:
+        lines = list(itertools.islice(csv_file, CHUNK_LINES))
+        if not lines:
+            return
+        yield first_id, lines
+        first_id += len(lines)
+
+
+def load_airlines(connection, airlines_csv):
+    """
+    Add the airlines of the airlines CSV that are not in the database yet.
+    :param connection: sqlite3 connection.
+    :param airlines_csv: Path of the CSV with IATA_CODE and AIRLINE columns.
+    :return: Dictionary mapping airline IATA codes to airline IDs.
+    """
+    existing = dict(connection.execute("SELECT AIRLINE, ID FROM airlines"))
+    next_id = max(existing.values(), default=0) + 1
+    airline_ids, new_rows = {}, []
+    with open(airlines_csv, newline='', encoding='utf-8') as csv_file:
+        for row in csv.DictReader(csv_file):
+            name = row['AIRLINE']
+            if name not in existing:
+                existing[name] = next_id
+                new_rows.append((next_id, name))
+                next_id += 1
+            airline_ids[row['IATA_CODE']] = existing[name]
+    connection.executemany("INSERT INTO airlines VALUES (?, ?)", new_rows)
+    return airline_ids
+
+
+def load_airports(connection, airports_csv):
+    """
+    Add the airports of the airports CSV that are not in the database yet.
+    :param connection: sqlite3 connection.
+    :param airports_csv: Path of the airports CSV.
+    :return: Number of airports added.
+    """
+    existing = {code for (code,) in connection.execute("SELECT IATA_CODE FROM airports")}
+    columns = ('IATA_CODE', 'AIRPORT', 'CITY', 'STATE', 'COUNTRY',
+               'LATITUDE', 'LONGITUDE')
+    with open(airports_csv, newline='', encoding='utf-8') as csv_file:
+        rows = [tuple(_to_number(row[name]) if name in ('LATITUDE', 'LONGITUDE')
+                      else row[name] for name in columns)
+                for row in csv.DictReader(csv_file)
+                if row['IATA_CODE'] not in existing]
+    connection.executemany("INSERT INTO airports VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+    return len(rows)
+
+
+def load_flights(connection, flights_csv, airline_ids, workers=None, days=None):
+    """
+    Append the flights of the flights CSV to the database.
+    :param connection: sqlite3 connection.
+    :param flights_csv: Path of the flights CSV.
+    :param airline_ids: Dictionary mapping airline IATA codes to airline IDs.
+    :param workers: Number of parser processes, defaults to the CPU count.
+    :param days: Optional set, updated in place with the (day, month, year)
+                 dates of the loaded flights.
+    :return: Number of flights loaded.
+    """
+    columns = [row[1] for row in connection.execute("PRAGMA table_info(flights)")]
+    normalized = all(name in columns for name in NORMALIZED_COLUMNS)
+    insert_columns = ['ID', *FLIGHT_CSV_COLUMNS, *(NORMALIZED_COLUMNS if normalized else ())]
+    insert = (f"INSERT INTO flights ({', '.join(insert_columns)}) "
+              f"VALUES ({', '.join('?' * len(insert_columns))})")
+    first_id = connection.execute("SELECT COALESCE(MAX(ID), 0) FROM flights").fetchone()[0] + 1
+
+    workers = workers or os.cpu_count() or 1
+    loaded = uncommitted = 0
+    started = time.perf_counter()
+    with open(flights_csv, newline='', encoding='utf-8') as csv_file, \
+            multiprocessing.Pool(workers, _init_worker,
+                                 (next(csv.reader([csv_file.readline()])),
+                                  airline_ids, normalized)) as pool:
+        # Keep a bounded number of chunks in flight so that the file is not
+        # read faster than the rows can be written
+        pending = deque()
+        chunks = _read_chunks(csv_file, first_id)
+        connection.execute("BEGIN")
+        while True:
+            while len(pending) < workers * 2:
+                task = next(chunks, None)
+                if task is None:
+                    break
+                pending.append(pool.apply_async(_parse_chunk, (task,)))
+            if not pending:
+                break
+            rows, chunk_days = pending.popleft().get()
+            if days is not None:
+                days.update(chunk_days)
+            connection.executemany(insert, rows)
+            loaded += len(rows)
+            uncommitted += len(rows)
+            if uncommitted >= COMMIT_ROWS:
+                connection.execute("COMMIT")
+                connection.execute("BEGIN")
+                uncommitted = 0
+                elapsed = time.perf_counter() - started
+                print(f"  {loaded:,} flights, {loaded / elapsed:,.0f} rows/s")
+        connection.execute("COMMIT")
+    return loaded
+
+
+def ingest(db_uri, flights_csv, airlines_csv, airports_csv, workers=None):
+    """
+    Load the CSV files into the database, then build the indexes and
+    bring the rollup tables up to date, recomputing the days that the
+    loaded flights were added to.
+    :param db_uri: Database URI of the SQLite file to create or extend.
+    :param flights_csv: Path of the flights CSV.
+    :param airlines_csv: Path of the airlines CSV.
+    :param airports_csv: Path of the airports CSV.
+    :param workers: Number of parser processes, defaults to the CPU count.
+    """
+    connection = sqlite3.connect(make_url(db_uri).database, isolation_level=None)
+    try:
+        for pragma in BULK_LOAD_PRAGMAS:
+            connection.execute(pragma)
+        for schema in (FLIGHTS_SCHEMA, AIRLINES_SCHEMA, AIRPORTS_SCHEMA):
+            connection.execute(schema)
+
+        connection.execute("BEGIN")
+        airline_ids = load_airlines(connection, airlines_csv)
+        airports = load_airports(connection, airports_csv)
+        connection.execute("COMMIT")
+        print(f"Loaded {len(airline_ids)} airlines and {airports} new airports.")
+
+        started = time.perf_counter()
+        days = set()
+        loaded = load_flights(connection, flights_csv, airline_ids, workers, days)
+        elapsed = time.perf_counter() - started
+        print(f"Loaded {loaded:,} flights in {elapsed:.1f}s "
+              f"({loaded / max(elapsed, 1e-9):,.0f} rows/s).")
+        connection.execute("PRAGMA synchronous = NORMAL")
+    finally:
+        connection.close()
+
+    data_manager = FlightData(db_uri)
+    started = time.perf_counter()
+    data_manager.optimize_schema()
+    print(f"Built indexes in {time.perf_counter() - started:.1f}s.")
+    started = time.perf_counter()
+    # Days that were rolled up before hold only their earlier flights, so
+    # the days of the loaded flights are recomputed, then any others that
+    # were never rolled up are added
+    rolled_up = data_manager.refresh_rollups(days)
+    rolled_up += data_manager.refresh_rollups()
+    print(f"Rolled up {rolled_up} days in {time.perf_counter() - started:.1f}s.")
+
+
+def main():
+    """
+    Command-line entry point.
+    """
+    parser = argparse.ArgumentParser(
+        description="Build or extend the flights database from CSV files")
+    parser.add_argument('--flights', required=True, help="Flights CSV")
+    parser.add_argument('--airlines', required=True, help="Airlines CSV")
+    parser.add_argument('--airports', required=True, help="Airports CSV")
+    parser.add_argument('--db', default=DEFAULT_DB_URI, help="Database URI")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="Parser processes (default: CPU count)")
+    args = parser.parse_args()
+    ingest(args.db, args.flights, args.airlines, args.airports, args.workers)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,7 +4,6 @@ menu-driven options for querying flight data and visualizing delayed flights.
 """
 
 from datetime import datetime
-import visualization
 import data
 
 SQLITE_URI = 'sqlite:///data/flights.sqlite3'
@@ -78,6 +77,65 @@ def flights_by_date(data_manager):
             print("Invalid date format. Please enter date in DD/MM/YYYY format.")
 
 
+def _visualization():
+    """
+    Imports the visualization module on first use, so that the menu starts
+    without loading matplotlib, seaborn, folium and pandas.
+    :return: The visualization module.
+    """
+    import visualization  # pylint: disable=import-outside-toplevel
+    return visualization
+
+
+def ask_date():
+    """
+    Asks the user for a date in DD/MM/YYYY format until a valid one is entered.
+    :return: The date as a datetime.
+    """
+    while True:
+        try:
+            date_input = input("Enter date in DD/MM/YYYY format: ")
+            return datetime.strptime(date_input, '%d/%m/%Y')
+        except ValueError:
+            print("Invalid date format. Please use DD/MM/YYYY.")
+
+
+def visualize_delayed_flights_per_airline(data_manager):
+    """
+    Plots the percentage of delayed flights per airline.
+    :param data_manager: Instance of FlightData to fetch flight data.
+    """
+    _visualization().visualize_delayed_flights_per_airline(data_manager)
+
+
+def plot_delayed_flights_per_hour(data_manager):
+    """
+    Asks the user for a date and plots the percentage of delayed flights
+    per hour of that day.
+    :param data_manager: Instance of FlightData to fetch flight data.
+    """
+    date = ask_date()
+    _visualization().plot_delayed_flights_per_hour(data_manager, date)
+
+
+def plot_delayed_flights_heatmap(data_manager):
+    """
+    Plots the percentage of delayed flights per route as a heatmap.
+    :param data_manager: Instance of FlightData to fetch flight data.
+    """
+    _visualization().plot_delayed_flights_heatmap(data_manager)
+
+
+def plot_delayed_flights_map(data_manager):
+    """
+    Asks the user for a date and draws the percentage of delayed flights
+    per route of that day on a map.
+    :param data_manager: Instance of FlightData to fetch flight data.
+    """
+    date = ask_date()
+    _visualization().plot_delayed_flights_map(data_manager, date.day, date.month, date.year)
+
+
 def print_results(results):
     """
     Prints the flight results. Each result should contain the columns:
@@ -126,12 +184,12 @@ FUNCTIONS = {
     2: (flights_by_date,"Show flights by date"),
     3: (delayed_flights_by_airline,"Delayed flights by airline"),
     4: (delayed_flights_by_airport,"Delayed flights by origin airport"),
-    5: (visualization.visualize_delayed_flights_per_airline,"Visualize delayed flights by airline"),
-    6: (visualization.plot_delayed_flights_per_hour,
+    5: (visualize_delayed_flights_per_airline,"Visualize delayed flights by airline"),
+    6: (plot_delayed_flights_per_hour,
         "Visualize percentage of delayed flights per hour of the day"),
-    7: (visualization.plot_delayed_flights_heatmap,
+    7: (plot_delayed_flights_heatmap,
         "Visualize percentage of delayed flights by route"),
-    8: (visualization.plot_delayed_flights_map,
+    8: (plot_delayed_flights_map,
         "Visualize percentage of delayed flights per route on a map"),
     9: (quit, "Exit")
 }
@@ -148,27 +206,7 @@ def main():
         if choice_func == quit:
             print("Exiting program.")
             break
-        if choice_func == visualization.plot_delayed_flights_per_hour:
-            while True:
-                try:
-                    date_input = input("Enter date in DD/MM/YYYY format: ")
-                    date = datetime.strptime(date_input, '%d/%m/%Y')
-                    choice_func(data_manager, date)
-                    break
-                except ValueError:
-                    print("Invalid date format. Please use DD/MM/YYYY.")
-        elif choice_func == visualization.plot_delayed_flights_map:
-            while True:
-                try:
-                    date_input = input("Enter date in DD/MM/YYYY format: ")
-                    date = datetime.strptime(date_input, '%d/%m/%Y')
-                    day, month, year = date.day, date.month, date.year
-                    choice_func(data_manager, day, month, year)
-                    break
-                except ValueError:
-                    print("Invalid date format. Please use DD/MM/YYYY.")
-        else:
-            choice_func(data_manager)
+        choice_func(data_manager)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,346 @@
+"""
+metrics.py
+This module collects performance metrics of the FlightData queries and the
+API routes and renders them in the Prometheus text exposition format:
+- per query method: wall time, rows returned, bytes of the API responses
+  built from them, query cache hits and misses, and the SQL time and number
+  of statements behind it,
+- per API route: latency, requests by status, bytes sent and response
+  cache hits.
+Statements slower than a threshold are written to a slow-query log with
+their SQL and parameters.
+"""
+
+import functools
+import logging
+import math
+import threading
+import time
+
+# Upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SLOW_QUERY_MS = 500  # Default threshold of the slow-query log
+
+slow_query_log = logging.getLogger('flight_data.slow_queries')
+_settings = {'slow_query_seconds': SLOW_QUERY_MS / 1000}
+_state = threading.local()
+
+
+def _escape(value):
+    """Escape a label value for the text format."""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=()):
+    """Format label names and values as {name="value",...}."""
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs += [f'{name}="{value}"' for name, value in extra]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    """Format a sample value, using the text format's names for infinity."""
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """
+    Monotonically increasing values, one per combination of label values.
+    """
+    def __init__(self, name, documentation, label_names=()):
+        """
+        Initialize the counter.
+
+        :param name: Metric name.
+        :param documentation: Help text.
+        :param label_names: Names of the labels.
+        """
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+
+
+    def inc(self, *label_values, amount=1):
+        """
+        Increase the value of a combination of label values.
+        :param label_values: Values of the labels, in the order of label_names.
+        :param amount: Amount to add.
+        """
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+
+    def value(self, *label_values):
+        """
+        Return the value of a combination of label values.
+        :param label_values: Values of the labels.
+        :return: The value, 0 if it was never increased.
+        """
+        with self._lock:
+            return self._values.get(label_values, 0)
+
+
+    def render(self):
+        """
+        Render the counter in the text format.
+        :return: List of lines.
+        """
+        with self._lock:
+            values = sorted(self._values.items())
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        lines += [f"{self.name}{_format_labels(self.label_names, labels)} {_format_value(value)}"
+                  for labels, value in values]
+        return lines
+
+
+class Histogram:
+    """
+    Distribution of observed values in cumulative buckets, one per
+    combination of label values.
+    """
+    def __init__(self, name, documentation, label_names=(), buckets=LATENCY_BUCKETS):
+        """
+        Initialize the histogram.
+
+        :param name: Metric name.
+        :param documentation: Help text.
+        :param label_names: Names of the labels.
+        :param buckets: Sorted upper bounds of the buckets; +Inf is added.
+        """
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._buckets = tuple(buckets) + (math.inf,)
+        self._values = {}  # Label values -> [bucket counts, sum, count]
+        self._lock = threading.Lock()
+
+
+    def observe(self, value, *label_values):
+        """
+        Record an observation.
+        :param value: Observed value.
+        :param label_values: Values of the labels, in the order of label_names.
+        """
+        with self._lock:
+            entry = self._values.get(label_values)
+            if entry is None:
+                entry = self._values[label_values] = [[0] * len(self._buckets), 0.0, 0]
+            for index, bound in enumerate(self._buckets):
+                if value <= bound:
+                    entry[0][index] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+
+    def count(self, *label_values):
+        """
+        Return the number of observations of a combination of label values.
+        :param label_values: Values of the labels.
+        :return: Number of observations.
+        """
+        with self._lock:
+            entry = self._values.get(label_values)
+            return entry[2] if entry else 0
+
+
+    def render(self):
+        """
+        Render the histogram in the text format.
+        :return: List of lines.
+        """
+        with self._lock:
+            values = sorted((labels, (list(entry[0]), entry[1], entry[2]))
+                            for labels, entry in self._values.items())
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for labels, (buckets, total, count) in values:
+            cumulative = 0
+            for bound, bucket in zip(self._buckets, buckets):
+                cumulative += bucket
+                bucket_labels = _format_labels(self.label_names, labels,
+                                               [('le', _format_value(bound))])
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            label_text = _format_labels(self.label_names, labels)
+            lines.append(f"{self.name}_sum{label_text} {_format_value(total)}")
+            lines.append(f"{self.name}_count{label_text} {count}")
+        return lines
+
+
+METHOD_SECONDS = Histogram('flight_data_method_seconds',
+                           "Wall time of FlightData query methods, including the "
+                           "consumption of streamed results.", ('method',))
+METHOD_ROWS = Counter('flight_data_method_rows_total',
+                      "Rows returned by FlightData query methods.", ('method',))
+METHOD_RESPONSE_BYTES = Counter('flight_data_method_response_bytes_total',
+                                "Bytes of the API responses built from the results of "
+                                "FlightData query methods.", ('method',))
+QUERY_CACHE = Counter('flight_data_query_cache_total',
+                      "Query cache lookups of FlightData query methods.", ('method', 'result'))
+SQL_SECONDS = Counter('flight_data_sql_seconds_total',
+                      "Time spent executing SQL statements and fetching their rows.",
+                      ('method',))
+SQL_STATEMENTS = Counter('flight_data_sql_statements_total',
+                         "SQL statements executed.", ('method',))
+SLOW_QUERIES = Counter('flight_data_slow_queries_total',
+                       "SQL statements slower than the slow-query threshold.", ('method',))
+REQUEST_SECONDS = Histogram('flight_api_request_seconds',
+                            "Latency of API requests until the last byte of the response.",
+                            ('route', 'http_method'))
+REQUESTS = Counter('flight_api_requests_total',
+                   "API requests by route and status.", ('route', 'http_method', 'status'))
+RESPONSE_BYTES = Counter('flight_api_response_bytes_total',
+                         "Bytes of serialized API responses.", ('route',))
+RESPONSE_CACHE = Counter('flight_api_response_cache_total',
+                         "Response cache lookups of API routes.", ('route', 'result'))
+ALL_METRICS = (METHOD_SECONDS, METHOD_ROWS, METHOD_RESPONSE_BYTES, QUERY_CACHE, SQL_SECONDS,
+               SQL_STATEMENTS, SLOW_QUERIES, REQUEST_SECONDS, REQUESTS, RESPONSE_BYTES,
+               RESPONSE_CACHE)
+
+
+def render():
+    """
+    Render all metrics in the Prometheus text exposition format.
+    :return: Text of the /metrics response.
+    """
+    return '\n'.join(line for metric in ALL_METRICS for line in metric.render()) + '\n'
+
+
+def configure_slow_query_log(threshold_ms=SLOW_QUERY_MS, path=None):
+    """
+    Set the threshold of the slow-query log and optionally write it to a file.
+    :param threshold_ms: Statements taking at least this many milliseconds
+                         are logged.
+    :param path: File to append the log to, or None to use the logging
+                 configuration of the application.
+    """
+    _settings['slow_query_seconds'] = threshold_ms / 1000
+    if path:
+        handler = logging.FileHandler(path, encoding='utf-8')
+        handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+        slow_query_log.addHandler(handler)
+        slow_query_log.setLevel(logging.WARNING)
+        slow_query_log.propagate = False
+
+
+def current_method():
+    """
+    Return the name of the instrumented method running on this thread.
+    :return: Method name, or 'other' outside instrumented methods.
+    """
+    return getattr(_state, 'method', None) or 'other'
+
+
+def start_request():
+    """
+    Start collecting the query methods called by the request handled on
+    this thread.
+    """
+    _state.request_methods = []
+
+
+def request_methods():
+    """
+    Return the query methods called on this thread since start_request(),
+    and stop collecting them.
+    :return: Tuple of method names, in the order of their first call.
+    """
+    methods = getattr(_state, 'request_methods', None) or ()
+    _state.request_methods = None
+    return tuple(dict.fromkeys(methods))
+
+
+def record_response(methods, size):
+    """
+    Record the bytes of an API response built from the results of query methods.
+    :param methods: Names of the methods, from request_methods().
+    :param size: Bytes sent.
+    """
+    for method in methods:
+        METHOD_RESPONSE_BYTES.inc(method, amount=size)
+
+
+def record_query(method, query, params, seconds):
+    """
+    Record an executed SQL statement and log it if it was slow.
+    :param method: Name of the method that issued it.
+    :param query: SQL text.
+    :param params: Query parameters.
+    :param seconds: Time spent executing it and fetching its rows.
+    """
+    SQL_SECONDS.inc(method, amount=seconds)
+    SQL_STATEMENTS.inc(method)
+    if seconds >= _settings['slow_query_seconds']:
+        SLOW_QUERIES.inc(method)
+        slow_query_log.warning("Slow query in %s: %.1f ms; %s; params=%r",
+                               method, seconds * 1000, ' '.join(query.split()), params or {})
+
+
+def record_cache(method, hit):
+    """
+    Record a query cache lookup.
+    :param method: Name of the method that made it.
+    :param hit: True for a hit, False for a miss.
+    """
+    QUERY_CACHE.inc(method, 'hit' if hit else 'miss')
+
+
+def _record_method(name, seconds, rows):
+    """Record a completed call of a query method."""
+    METHOD_SECONDS.observe(seconds, name)
+    METHOD_ROWS.inc(name, amount=rows)
+
+
+def _counted(name, rows, started):
+    """Pass a streamed result through, recording the call once it is consumed."""
+    count = 0
+    try:
+        for row in rows:
+            count += 1
+            yield row
+    finally:
+        _record_method(name, time.perf_counter() - started, count)
+
+
+def _instrumented(name, method):
+    """Wrap a query method to record its calls."""
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        if getattr(_state, 'method', None) is not None:
+            # Called from another query method, which is measured instead
+            return method(*args, **kwargs)
+        _state.method = name
+        called = getattr(_state, 'request_methods', None)
+        if called is not None:
+            called.append(name)
+        started = time.perf_counter()
+        try:
+            result = method(*args, **kwargs)
+        finally:
+            _state.method = None
+        if hasattr(result, '__next__'):
+            return _counted(name, result, started)
+        if hasattr(getattr(result, 'rows', None), '__next__'):
+            # Compact results (data.Rows) stream their rows attribute
+            result.rows = _counted(name, result.rows, started)
+            return result
+        _record_method(name, time.perf_counter() - started,
+                       len(result) if hasattr(result, '__len__') else 0)
+        return result
+    wrapper.instrumented = True
+    return wrapper
+
+
+def instrument_methods(cls, names):
+    """
+    Instrument the query methods that a class defines itself.
+    :param cls: Class, e.g. FlightData or a subclass.
+    :param names: Names of the methods to instrument.
+    """
+    for name in names:
+        method = cls.__dict__.get(name)
+        if callable(method) and not getattr(method, 'instrumented', False):
+            setattr(cls, name, _instrumented(name, method))
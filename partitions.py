@@ -0,0 +1,805 @@
+"""
+partitions.py
+This module splits the flights database into one SQLite file per month and
+provides PartitionedFlightData, a FlightData backend that queries them.
+Date-filtered queries go to the partition of their month. Global aggregates
+run on every partition in a process pool, and the partial counts are merged,
+so their latency goes down with the number of cores. Range aggregates do the
+same on the partitions of the months they span, and the exact delay
+quantiles merge the per-delay flight counts of every partition. Every query
+method reads the partitions only; the main database just needs its files.
+Usage:
+    python partitions.py [--db sqlite:///data/flights.sqlite3] [--workers N]
+The partitions are written next to the database, e.g. data/flights_partitions/,
+and are used by the API with FLIGHT_DATA_BACKEND=partitioned.
+Dependencies:
+- pandas
+- sqlalchemy
+- data (FlightData class)
+"""
+
+import argparse
+import heapq
+import itertools
+import json
+import math
+import multiprocessing
+import operator
+import os
+import sqlite3
+import time
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+from sqlalchemy.engine import make_url
+from data import (FlightData, Rows, DEFAULT_DB_URI, DEPARTURE_HOUR, DELAY_QUANTILES,
+                  FLIGHT_COLUMNS, QUANTILE_KEYS, TOP_K, VALID_DELAY, database_path)
+from heatmap import RouteMatrix
+
+MANIFEST_NAME = 'manifest.json'
+PARTITION_PROFILE = 'read_heavy'  # Connection profile of the partition files
+COPIED_TABLES = ('airlines', 'airports')  # Small tables copied into every partition
+
+# Columns the flights are counted by for every get_top_delayed() dimension,
+# and the names of the key columns in its results
+TOP_COUNT_KEYS = {
+    'route': (('ORIGIN_AIRPORT', 'DESTINATION_AIRPORT'),
+              ('origin_airport', 'destination_airport')),
+    'airport': (('ORIGIN_AIRPORT',), ('airport',)),
+    'airline': (('AIRLINE',), ('airline',)),
+}
+
+# Partial aggregates computed on every partition; their counts add up
+PARTIAL_QUERIES = {
+    'delayed_by_airline': """
+        SELECT airlines.airline, COUNT(*) AS delay_count
+        FROM flights
+        JOIN airlines ON flights.airline = airlines.id
+        WHERE {delayed}
+        GROUP BY airlines.airline
+    """,
+    'routes': """
+        SELECT ORIGIN_AIRPORT, DESTINATION_AIRPORT,
+               COUNT(*) AS total_count,
+               SUM(CASE WHEN {delayed} THEN 1 ELSE 0 END) AS delayed_count
+        FROM flights
+        GROUP BY ORIGIN_AIRPORT, DESTINATION_AIRPORT
+    """,
+    'completed_routes': """
+        SELECT ORIGIN_AIRPORT, DESTINATION_AIRPORT,
+               COUNT(*) AS total_count,
+               SUM(CASE WHEN {delayed} THEN 1 ELSE 0 END) AS delayed_count
+        FROM flights
+        WHERE CANCELLED = 0 AND DIVERTED = 0
+        GROUP BY ORIGIN_AIRPORT, DESTINATION_AIRPORT
+    """,
+    'delay_counts': """
+        SELECT {group_columns},
+               COUNT(*) AS flights,
+               SUM(CASE WHEN {delayed} THEN 1 ELSE 0 END) AS delayed_flights
+        FROM flights
+        WHERE {condition}
+        GROUP BY {group_columns}
+    """,
+    'hourly': f"""
+        SELECT {DEPARTURE_HOUR} AS hour,
+               COUNT(*) AS total_count,
+               SUM(CASE WHEN {{delayed}} THEN 1 ELSE 0 END) AS delayed_count
+        FROM flights
+        WHERE {{condition}}
+        GROUP BY hour
+    """,
+    # Few distinct delays, so the flights per delay stay small and merge exactly
+    'delay_histogram': f"""
+        SELECT {{key}} AS key, DEPARTURE_DELAY AS delay, COUNT(*) AS flights
+        FROM flights
+        LEFT JOIN airlines ON flights.AIRLINE = airlines.ID
+        WHERE {VALID_DELAY} {{key_condition}}
+        GROUP BY key, delay
+    """,
+}
+
+_worker_managers = {}
+
+
+def partition_directory(db_uri):
+    """
+    Return the directory holding the partitions of a database.
+    :param db_uri: Database URI of the unpartitioned database.
+    :return: Directory path, e.g. data/flights_partitions for
+             sqlite:///data/flights.sqlite3.
+    """
+    path = database_path(make_url(db_uri))
+    return f"{os.path.splitext(path)[0]}_partitions"
+
+
+def _partition_query(db_uri, name, arguments):
+    """
+    Run a partial aggregate on one partition. Executed in a pool process,
+    which keeps one FlightData instance per partition.
+    :param db_uri: Database URI of the partition.
+    :param name: Key of PARTIAL_QUERIES.
+    :param arguments: Dictionary with the optional filters of the query:
+                      start and end dates, airline_name, airport_code, and
+                      the dimension and key of the counts.
+    :return: List of dictionaries with the partial counts.
+    """
+    data_manager = _worker_managers.get(db_uri)
+    if data_manager is None:
+        data_manager = FlightData(db_uri, query_cache_size=0,
+                                  connection_profile=PARTITION_PROFILE)
+        _worker_managers[db_uri] = data_manager
+    # pylint: disable=protected-access
+    params = {}
+    condition = '1'
+    if arguments.get('start') is not None:
+        condition = data_manager._date_range_condition(params, arguments['start'],
+                                                       arguments['end'])
+    if arguments.get('airline_name') is not None:
+        params['airline_name'] = arguments['airline_name']
+        condition += " AND AIRLINE = (SELECT ID FROM airlines WHERE airline = :airline_name)"
+    if arguments.get('airport_code') is not None:
+        params['airport_code'] = arguments['airport_code']
+        condition += " AND ORIGIN_AIRPORT = :airport_code"
+    dimension = arguments.get('dimension')
+    query = PARTIAL_QUERIES[name].format(
+        delayed=data_manager._delayed_expr(), condition=condition,
+        group_columns=', '.join(TOP_COUNT_KEYS[dimension][0]) if dimension in TOP_COUNT_KEYS
+        else '',
+        key=QUANTILE_KEYS[dimension] if name == 'delay_histogram' else '',
+        key_condition=data_manager._quantile_key_condition(params, dimension,
+                                                           arguments.get('key')))
+    return data_manager._execute_query(query, params)
+
+
+def _to_coordinate(value):
+    """Convert a coordinate the way SQLite's AVG() does."""
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return 0.0
+
+
+class PartitionedFlightData(FlightData):
+    """
+    FlightData backend reading one SQLite file per month.
+    """
+    def __init__(self, db_uri, connection_profile=None, workers=None):
+        """
+        Initialize the backend from the partitions of a database.
+
+        :param db_uri: Database URI of the unpartitioned database; the
+                       partitions are read from partition_directory(db_uri).
+        :param connection_profile: Connection profile passed to FlightData.
+        :param workers: Number of processes for the global aggregates,
+                        defaults to the CPU count.
+        """
+        # Set before FlightData.__init__, which already asks for data_version()
+        self._pool = None
+        self._directory = partition_directory(db_uri)
+        self._manifest_version = None
+        self._load_manifest(self._manifest_stat())
+        super().__init__(db_uri, connection_profile=connection_profile)
+        self._workers = workers or os.cpu_count() or 1
+
+
+    def _manifest_stat(self):
+        """
+        Return the modification time and size of the manifest.
+        :return: Version string, or '-' if the manifest is missing.
+        """
+        try:
+            stat = os.stat(os.path.join(self._directory, MANIFEST_NAME))
+        except OSError:
+            return '-'
+        return f"{stat.st_mtime_ns}-{stat.st_size}"
+
+
+    def _load_manifest(self, version):
+        """
+        Read the manifest and open its partitions, replacing the ones
+        loaded before.
+        :param version: _manifest_stat() taken before reading the manifest.
+        """
+        with open(os.path.join(self._directory, MANIFEST_NAME), encoding='utf-8') as file:
+            manifest = json.load(file)['partitions']
+        if not manifest:
+            raise ValueError(f"No partitions in {self._directory}")
+        previous = getattr(self, '_partitions', {})
+        # Assigned together, so a request sees either the old or the new set
+        self._manifest, self._partitions, self._manifest_version = manifest, {
+            (entry['year'], entry['month']): FlightData(
+                self._partition_uri(entry), connection_profile=PARTITION_PROFILE)
+            for entry in manifest
+        }, version
+        for partition in previous.values():
+            partition._engine.dispose()  # pylint: disable=protected-access
+
+
+    def _partition_uri(self, entry):
+        """Return the database URI of a manifest entry."""
+        return f"sqlite:///{os.path.abspath(os.path.join(self._directory, entry['file']))}"
+
+
+    def data_version(self):
+        """
+        Return a token that changes whenever the partitions are rebuilt, and
+        load the new manifest and partitions when they were. While the
+        manifest is missing or unreadable, e.g. during a rebuild, the loaded
+        partitions and their version are kept.
+        :return: Version string.
+        """
+        current = self._manifest_stat()
+        if current != self._manifest_version:
+            try:
+                self._load_manifest(current)
+            except (OSError, ValueError, KeyError):
+                pass
+        return self._manifest_version
+
+
+    def _partition_for(self, month, year):
+        """
+        Return the partition of a month. Months without a partition get an
+        arbitrary one, whose date filter then matches no flights.
+        :param month: Month number.
+        :param year: Year.
+        :return: FlightData instance.
+        """
+        try:
+            key = (int(year), int(month))
+        except (TypeError, ValueError):
+            key = None
+        return self._partitions.get(key) or next(iter(self._partitions.values()))
+
+
+    def _months(self, start, end):
+        """
+        Return the months with a partition within a range of dates.
+        :param start: First date.
+        :param end: Last date, included.
+        :return: Sorted list of (year, month) tuples.
+        """
+        return [month for month in sorted(self._partitions)
+                if (start.year, start.month) <= month <= (end.year, end.month)]
+
+
+    def _fan_out(self, name, arguments=None, months=None):
+        """
+        Run a partial aggregate on every partition in the process pool.
+        :param name: Key of PARTIAL_QUERIES.
+        :param arguments: Filters of the query, see _partition_query().
+        :param months: Only run it on the partitions of these (year, month)
+                       tuples, or None for all.
+        :return: Iterator of row lists, one per partition.
+        """
+        uris = [self._partition_uri(entry) for entry in self._manifest
+                if months is None or (entry['year'], entry['month']) in months]
+        if not uris:
+            return iter(())
+        if self._pool is None:
+            # Spawned rather than forked, as the API process runs threads
+            self._pool = ProcessPoolExecutor(
+                min(self._workers, len(self._manifest)),
+                mp_context=multiprocessing.get_context('spawn'))
+        return self._pool.map(_partition_query, uris, itertools.repeat(name),
+                              itertools.repeat(arguments or {}))
+
+
+    def _merged_counts(self, name, key_columns, arguments=None, months=None):
+        """
+        Add up the partial counts of all partitions.
+        :param name: Key of PARTIAL_QUERIES.
+        :param key_columns: Columns identifying a group.
+        :param arguments: Filters of the query, see _partition_query().
+        :param months: Only count the partitions of these (year, month)
+                       tuples, or None for all.
+        :return: Dictionary mapping group keys to dictionaries of counts,
+                 sorted by key as SQLite's GROUP BY orders them.
+        """
+        totals = {}
+        for rows in self._fan_out(name, arguments, months):
+            for row in rows:
+                key = tuple(row[column] for column in key_columns)
+                counts = totals.setdefault(key, {})
+                for column, value in row.items():
+                    if column not in key_columns:
+                        counts[column] = counts.get(column, 0) + (value or 0)
+        return dict(sorted(totals.items()))
+
+
+    def _merged_rows(self, method, args, limit, after, stream, as_tuples=False):
+        """
+        Merge the flights of all partitions in flight ID order.
+        :param method: Name of the FlightData row method.
+        :param args: Positional arguments of the method.
+        :param limit: Maximum number of flights, or None for all.
+        :param after: Only return flights with an ID greater than this cursor.
+        :param stream: If True, return a generator instead of a list.
+        :param as_tuples: If True, return a Rows result of FLIGHT_COLUMNS
+                          tuples instead of dictionaries.
+        :return: List or generator of dictionaries, or Rows.
+        """
+        if as_tuples:
+            flight_id = operator.itemgetter(FLIGHT_COLUMNS.index('FLIGHT_ID'))
+        else:
+            flight_id = operator.itemgetter('FLIGHT_ID')
+
+        def rows():
+            sources = [getattr(partition, method)(*args, limit=limit, after=after,
+                                                  stream=True, as_tuples=as_tuples)
+                       for partition in self._partitions.values()]
+            try:
+                merged = heapq.merge(*sources, key=flight_id)
+                yield from itertools.islice(merged, limit)
+            finally:
+                for source in sources:
+                    source.close()
+        merged_rows = rows() if stream else list(rows())
+        return Rows(FLIGHT_COLUMNS, merged_rows) if as_tuples else merged_rows
+
+
+    def get_flight_by_id(self, flight_id):
+        """
+        Retrieve flight details by flight ID from the partitions whose ID
+        range contains it.
+        :param flight_id: ID of the flight.
+        :return: List of dictionaries containing flight details.
+        """
+        for entry in self._manifest:
+            if entry['min_id'] <= int(flight_id) <= entry['max_id']:
+                results = self._partitions[(entry['year'], entry['month'])] \
+                    .get_flight_by_id(flight_id)
+                if results:
+                    return results
+        return []
+
+
+    def get_flights_by_ids(self, flight_ids):
+        """
+        Retrieve the details of many flights, asking each partition only for
+        the IDs within its ID range.
+        :param flight_ids: Iterable of flight IDs.
+        :return: Dictionary mapping the IDs that were found to dictionaries
+                 containing flight details.
+        """
+        remaining = set(int(flight_id) for flight_id in flight_ids)
+        results = {}
+        for entry in self._manifest:
+            candidates = [flight_id for flight_id in remaining
+                          if entry['min_id'] <= flight_id <= entry['max_id']]
+            if candidates:
+                found = self._partitions[(entry['year'], entry['month'])] \
+                    .get_flights_by_ids(candidates)
+                results.update(found)
+                remaining.difference_update(found)
+        return results
+
+
+    def get_flights_by_date(self, day, month, year, limit=None, after=None,
+                            stream=False, as_tuples=False):
+        """
+        Retrieve flights for a specific date from the partition of its month.
+        :param day: Day of the flights.
+        :param month: Month of the flights.
+        :param year: Year of the flights.
+        :param limit: Maximum number of flights to return, or None for all.
+        :param after: Only return flights with an ID greater than this cursor.
+        :param stream: If True, return a generator instead of a list.
+        :param as_tuples: If True, return a Rows result of FLIGHT_COLUMNS
+                          tuples instead of dictionaries.
+        :return: List of dictionaries containing flight details.
+        """
+        return self._partition_for(month, year).get_flights_by_date(
+            day, month, year, limit, after, stream, as_tuples)
+
+
+    def get_flights_by_date_range(self, start, end, limit=None, after=None,
+                                  stream=False, as_tuples=False):
+        """
+        Retrieve the flights of a range of dates from the partitions of the
+        months it spans, one month after the other, ordered by date and then
+        by flight ID.
+        :param start: First date.
+        :param end: Last date, included.
+        :param limit: Maximum number of flights to return, or None for all.
+        :param after: Only return the flights after this cursor, the flight
+                      ID of the last flight of the previous page.
+        :param stream: If True, return a generator instead of a list.
+        :param as_tuples: If True, return a Rows result of FLIGHT_COLUMNS
+                          tuples instead of dictionaries.
+        :return: List of dictionaries containing flight details.
+        """
+        first = (start.year, start.month)
+        if after is not None:
+            cursor = self.get_flight_by_id(after)
+            if not cursor:
+                return Rows(FLIGHT_COLUMNS, []) if as_tuples else []
+            first = max(first, (cursor[0]['YEAR'], cursor[0]['MONTH']))
+        months = [month for month in sorted(self._partitions)
+                  if first <= month <= (end.year, end.month)]
+
+        def rows():
+            remaining = limit
+            for month in months:
+                if remaining is not None and remaining <= 0:
+                    break
+                source = self._partitions[month].get_flights_by_date_range(
+                    start, end, remaining, after if month == first else None,
+                    stream=True, as_tuples=as_tuples)
+                try:
+                    for row in source:
+                        if remaining is not None:
+                            remaining -= 1
+                        yield row
+                finally:
+                    source.close()
+        range_rows = rows() if stream else list(rows())
+        return Rows(FLIGHT_COLUMNS, range_rows) if as_tuples else range_rows
+
+
+    def get_delayed_flights_by_airline(self, airline_name, limit=None, after=None,
+                                       stream=False, as_tuples=False):
+        """
+        Retrieve delayed flights for a specific airline, ordered by flight ID.
+        :param airline_name: Name of the airline.
+        :param limit: Maximum number of flights to return, or None for all.
+        :param after: Only return flights with an ID greater than this cursor.
+        :param stream: If True, return a generator instead of a list.
+        :param as_tuples: If True, return a Rows result of FLIGHT_COLUMNS
+                          tuples instead of dictionaries.
+        :return: List of dictionaries containing delayed flights.
+        """
+        return self._merged_rows('get_delayed_flights_by_airline', (airline_name,),
+                                 limit, after, stream, as_tuples)
+
+
+    def get_delayed_flights_by_airport(self, airport_code, limit=None, after=None,
+                                       stream=False, as_tuples=False):
+        """
+        Retrieve delayed flights for a specific airport, ordered by flight ID.
+        :param airport_code: Code of the airport.
+        :param limit: Maximum number of flights to return, or None for all.
+        :param after: Only return flights with an ID greater than this cursor.
+        :param stream: If True, return a generator instead of a list.
+        :param as_tuples: If True, return a Rows result of FLIGHT_COLUMNS
+                          tuples instead of dictionaries.
+        :return: List of dictionaries containing delayed flights.
+        """
+        return self._merged_rows('get_delayed_flights_by_airport', (airport_code,),
+                                 limit, after, stream, as_tuples)
+
+
+    def get_all_delayed_flights_grouped_by_airline(self, stream=False):
+        """
+        Retrieve all delayed flights grouped by airline, counted on every
+        partition in parallel.
+        :param stream: If True, return a generator instead of a list.
+        :return: List of dictionaries containing delayed flights by airline.
+        """
+        results = [{'AIRLINE': airline, 'delay_count': counts['delay_count']}
+                   for (airline,), counts
+                   in self._merged_counts('delayed_by_airline', ('AIRLINE',)).items()]
+        return iter(results) if stream else results
+
+
+    def get_delayed_flights_per_hour(self, day, month, year, stream=False):
+        """
+        Retrieve delayed flights grouped by hour for a specific date from
+        the delay cube, or else from the partition of its month.
+        :param day: Day of the flights.
+        :param month: Month of the flights.
+        :param year: Year of the flights.
+        :param stream: If True, return a generator instead of a list.
+        :return: List of dictionaries containing delayed flights per hour.
+        """
+        results = self._cube_per_hour(day, month, year)
+        if results is not None:
+            return iter(results) if stream else results
+        return self._partition_for(month, year).get_delayed_flights_per_hour(
+            day, month, year, stream)
+
+
+    def get_hourly_delays(self, start, end, airline_name=None, airport_code=None,
+                          stream=False):
+        """
+        Retrieve the flights and delayed flights per hour of departure over
+        a range of dates from the delay cube, or else counted on the
+        partitions of the months it spans in parallel.
+        :param start: First date.
+        :param end: Last date, included.
+        :param airline_name: Only count flights of this airline.
+        :param airport_code: Only count flights from this origin airport.
+        :param stream: If True, return a generator instead of a list.
+        :return: List of dictionaries with hour, delayed_count and total_count.
+        """
+        if self.get_delay_cube() is not None:
+            return super().get_hourly_delays(start, end, airline_name, airport_code, stream)
+        hours = {f"{hour:02d}": {'delayed_count': 0, 'total_count': 0} for hour in range(24)}
+        arguments = {'start': start, 'end': end, 'airline_name': airline_name,
+                     'airport_code': airport_code}
+        for rows in self._fan_out('hourly', arguments, self._months(start, end)):
+            for row in rows:
+                # Like the all_hours join, departure times past 23:59 are left out
+                if row['hour'] in hours:
+                    hours[row['hour']]['delayed_count'] += row['delayed_count'] or 0
+                    hours[row['hour']]['total_count'] += row['total_count']
+        results = [{'hour': hour, **counts} for hour, counts in hours.items()]
+        return iter(results) if stream else results
+
+
+    def get_delay_quantiles(self, dimension=None, key=None, quantiles=DELAY_QUANTILES,
+                            stream=False):
+        """
+        Retrieve quantiles of the departure delay of every route, airline or
+        origin airport, or of all flights. Served from the sketches when they
+        are up to date, and otherwise computed exactly from the flights per
+        delay of every partition, counted in parallel.
+        :param dimension: One of QUANTILE_DIMENSIONS, or None for all flights.
+        :param key: Only this route ('ORIGIN-DESTINATION'), airline name or
+                    origin airport code, or None for every one.
+        :param quantiles: Fractions between 0 and 1.
+        :param stream: If True, return a generator instead of a list.
+        :return: List of dictionaries with the key columns, flights, one
+                 pNN entry per quantile (e.g. p50) and rank_error.
+        """
+        if self.get_quantile_sketches() is not None:
+            return super().get_delay_quantiles(dimension, key, quantiles, stream)
+        histograms = self._merged_counts('delay_histogram', ('key', 'delay'),
+                                         {'dimension': dimension, 'key': key})
+        keys = {}
+        for (name, delay), counts in histograms.items():
+            keys.setdefault(name, []).append((delay, counts['flights']))
+        results = []
+        for name, delays in keys.items():
+            count = sum(flights for _, flights in delays)
+            values = []
+            for fraction in quantiles:
+                # The smallest delay whose rank reaches the fraction
+                rank, seen = max(math.ceil(fraction * count), 1), 0
+                for delay, flights in delays:
+                    seen += flights
+                    if seen >= rank:
+                        values.append(delay)
+                        break
+            results.append(self._quantile_row(dimension, None if dimension is None else name,
+                                              count, values, quantiles, 0.0))
+        return iter(results) if stream else results
+
+
+    def get_flight_delays_heatmap(self):
+        """
+        Retrieve a heatmap of flight delays between airports, counted on
+        every partition in parallel.
+        :return: DataFrame with origin, destination, and percentage of
+                delayed flights.
+        """
+        counts = self._merged_counts('completed_routes',
+                                     ('ORIGIN_AIRPORT', 'DESTINATION_AIRPORT'))
+        return pd.DataFrame(
+            [{'origin_airport': origin, 'destination_airport': destination,
+              'percentage': route['delayed_count'] / route['total_count'] * 100}
+             for (origin, destination), route in counts.items()
+             if route['total_count']],
+            columns=['origin_airport', 'destination_airport', 'percentage']
+        )
+
+
+    def get_flight_delays_heatmap_matrix(self, top_n=None, min_flights=1):
+        """
+        Retrieve the heatmap of flight delays between airports as a sparse
+        matrix, counted on every partition in parallel.
+        :param top_n: Only keep routes between the top_n airports with the
+                      most flights.
+        :param min_flights: Only keep routes with at least this many flights.
+        :return: RouteMatrix.
+        """
+        counts = self._merged_counts('completed_routes',
+                                     ('ORIGIN_AIRPORT', 'DESTINATION_AIRPORT'))
+        routes = {key: route for key, route in counts.items() if route['total_count']}
+        return RouteMatrix.from_counts(
+            [origin for origin, _ in routes], [destination for _, destination in routes],
+            [route['total_count'] for route in routes.values()],
+            [route['delayed_count'] for route in routes.values()],
+            top_n, min_flights)
+
+
+    def get_delayed_flights_average_per_route(self, stream=False):
+        """
+        Retrieve average percentage of delayed flights per route, counted
+        on every partition in parallel.
+        :param stream: If True, return a generator instead of a list.
+        :return: List of dictionaries containing average delay percentages.
+        """
+        counts = self._merged_counts('routes', ('ORIGIN_AIRPORT', 'DESTINATION_AIRPORT'))
+        # pylint: disable=protected-access
+        airports = {row['IATA_CODE']: row for row in next(iter(
+            self._partitions.values()))._execute_query(
+                "SELECT IATA_CODE, LATITUDE, LONGITUDE FROM airports")}
+        results = []
+        for (origin, destination), route in counts.items():
+            if origin not in airports or destination not in airports or not route['total_count']:
+                continue
+            results.append({
+                'origin_latitude': _to_coordinate(airports[origin]['LATITUDE']),
+                'origin_longitude': _to_coordinate(airports[origin]['LONGITUDE']),
+                'destination_latitude': _to_coordinate(airports[destination]['LATITUDE']),
+                'destination_longitude': _to_coordinate(airports[destination]['LONGITUDE']),
+                'avg_percentage': route['delayed_count'] * 100.0 / route['total_count'],
+            })
+        return iter(results) if stream else results
+
+
+    def get_delayed_flights_per_route_map(self, day, month, year, stream=False):
+        """
+        Retrieve delayed flights per route for a specific date from the
+        partition of its month.
+        :param day: Day of the flights.
+        :param month: Month of the flights.
+        :param year: Year of the flights.
+        :param stream: If True, return a generator instead of a list.
+        :return: List of dictionaries containing percentage of
+        delayed flights per route.
+        """
+        return self._partition_for(month, year).get_delayed_flights_per_route_map(
+            day, month, year, stream)
+
+
+    def get_delayed_flights_per_route_map_range(self, start, end, stream=False):
+        """
+        Retrieve delayed flights per route with percentage of delays over a
+        range of dates, counted on the partitions of the months it spans in
+        parallel.
+        :param start: First date.
+        :param end: Last date, included.
+        :param stream: If True, return a generator instead of a list.
+        :return: List of dictionaries containing percentage of
+        delayed flights per route.
+        """
+        key_columns, names = TOP_COUNT_KEYS['route']
+        counts = self._merged_counts('delay_counts', key_columns,
+                                     {'dimension': 'route', 'start': start, 'end': end},
+                                     self._months(start, end))
+        results = [{**dict(zip(names, route)),
+                    'percentage': route_counts['delayed_flights'] * 100.0
+                                  / route_counts['flights']}
+                   for route, route_counts in counts.items()]
+        return iter(results) if stream else results
+
+
+    def get_top_delayed(self, dimension, k=TOP_K, min_flights=1, start=None, end=None,
+                        stream=False):
+        """
+        Retrieve the k routes, origin airports or airlines with the highest
+        share of delayed flights, counted on every partition, or on the
+        partitions of the months between start and end, in parallel.
+        :param dimension: One of TOP_DIMENSIONS.
+        :param k: Number of rows to return.
+        :param min_flights: Only rank keys with at least this many flights.
+        :param start: Optional first date of the flights counted.
+        :param end: Last date, included; required with start.
+        :param stream: If True, return a generator instead of a list.
+        :return: List of dictionaries with the key columns, flights,
+                 delayed_flights and percentage, worst first; ties go to
+                 the key with more flights.
+        """
+        key_columns, names = TOP_COUNT_KEYS[dimension]
+        counts = self._merged_counts(
+            'delay_counts', key_columns, {'dimension': dimension, 'start': start, 'end': end},
+            None if start is None else self._months(start, end))
+        minimum = max(int(min_flights), 1)
+        worst = heapq.nlargest(
+            int(k), ((group, totals) for group, totals in counts.items()
+                     if totals['flights'] >= minimum),
+            key=lambda item: (item[1]['delayed_flights'] / item[1]['flights'],
+                              item[1]['flights']))
+        if dimension == 'airline':
+            # pylint: disable=protected-access
+            airlines = {row['ID']: row['AIRLINE'] for row in next(iter(
+                self._partitions.values()))._execute_query("SELECT ID, AIRLINE FROM airlines")}
+            worst = [((airlines.get(airline) or str(airline),), totals)
+                     for (airline,), totals in worst]
+        results = [{**dict(zip(names, group)), 'flights': totals['flights'],
+                    'delayed_flights': totals['delayed_flights'],
+                    'percentage': totals['delayed_flights'] * 100.0 / totals['flights']}
+                   for group, totals in worst]
+        return iter(results) if stream else results
+
+
+    def get_airport_registry(self):
+        """
+        Return the airports with valid coordinates as an AirportRegistry.
+        :return: AirportRegistry instance.
+        """
+        return next(iter(self._partitions.values())).get_airport_registry()
+
+
+    def __del__(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+        super().__del__()
+
+
+def _build_partition(source_path, path, year, month):
+    """
+    Copy one month of flights, and the airlines and airports tables, into a
+    partition file and optimize it. Executed in a pool process.
+    :param source_path: Path of the unpartitioned database.
+    :param path: Path of the partition file.
+    :param year: Year of the partition.
+    :param month: Month of the partition.
+    :return: Manifest entry of the partition.
+    """
+    if os.path.exists(path):
+        os.remove(path)
+    # Opened as a URI so that the source can be attached read-only
+    connection = sqlite3.connect(f"file:{path}", uri=True, isolation_level=None)
+    try:
+        connection.execute("PRAGMA journal_mode = WAL")
+        connection.execute("PRAGMA synchronous = OFF")
+        connection.execute("ATTACH DATABASE ? AS source", (f"file:{source_path}?mode=ro",))
+        connection.execute("BEGIN")
+        for table in ('flights',) + COPIED_TABLES:
+            (schema,) = connection.execute(
+                "SELECT sql FROM source.sqlite_master WHERE type = 'table' AND name = ?",
+                (table,)).fetchone()
+            connection.execute(schema)
+        connection.execute("INSERT INTO flights SELECT * FROM source.flights "
+                           "WHERE YEAR = ? AND MONTH = ? ORDER BY ID", (year, month))
+        for table in COPIED_TABLES:
+            connection.execute(f"INSERT INTO {table} SELECT * FROM source.{table}")
+        connection.execute("COMMIT")
+        connection.execute("DETACH DATABASE source")
+        rows, min_id, max_id = connection.execute(
+            "SELECT COUNT(*), MIN(ID), MAX(ID) FROM flights").fetchone()
+    finally:
+        connection.close()
+    FlightData(f"sqlite:///{path}", query_cache_size=0).optimize_schema()
+    return {'year': year, 'month': month, 'file': os.path.basename(path),
+            'rows': rows, 'min_id': min_id, 'max_id': max_id}
+
+
+def build_partitions(db_uri, workers=None):
+    """
+    Split a database into one partition file per month, building the
+    partitions in parallel, and write the manifest.
+    :param db_uri: Database URI of the unpartitioned database.
+    :param workers: Number of processes, defaults to the CPU count.
+    :return: List of manifest entries.
+    """
+    source_path = os.path.abspath(database_path(make_url(db_uri)))
+    directory = partition_directory(db_uri)
+    os.makedirs(directory, exist_ok=True)
+    with sqlite3.connect(f"file:{source_path}?mode=ro", uri=True) as connection:
+        months = connection.execute(
+            "SELECT DISTINCT YEAR, MONTH FROM flights ORDER BY YEAR, MONTH").fetchall()
+
+    paths = [os.path.join(directory, f"flights_{year}_{month:02d}.sqlite3")
+             for year, month in months]
+    with ProcessPoolExecutor(workers) as pool:
+        manifest = list(pool.map(_build_partition, itertools.repeat(source_path),
+                                 paths, *zip(*months)))
+    with open(os.path.join(directory, MANIFEST_NAME), 'w', encoding='utf-8') as file:
+        json.dump({'source': source_path, 'partitions': manifest}, file, indent=2)
+    return manifest
+
+
+def main():
+    """
+    Command-line entry point.
+    """
+    parser = argparse.ArgumentParser(description="Split the flights database by month")
+    parser.add_argument('--db', default=DEFAULT_DB_URI, help="Database URI")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="Processes (default: CPU count)")
+    args = parser.parse_args()
+    started = time.perf_counter()
+    manifest = build_partitions(args.db, args.workers)
+    print(f"Wrote {len(manifest)} partitions with "
+          f"{sum(entry['rows'] for entry in manifest):,} flights to "
+          f"{partition_directory(args.db)} in {time.perf_counter() - started:.1f}s.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+"""
+prerender.py
+This module renders the charts of visualization.py headlessly, with the Agg
+backend, for every date in a range, so that the images can be regenerated
+nightly on a server and served without rendering anything per request.
+The charts are rendered in parallel in a process pool. Outputs rendered
+from the current version of the database are skipped, and a manifest.json
+listing every output is written next to them for the API (/charts).
+Usage:
+    python prerender.py --start 2015-01-01 --end 2015-01-31
+                        [--db sqlite:///data/flights.sqlite3]
+                        [--output static/images/prerendered] [--workers N] [--force]
+Dependencies:
+- matplotlib (Agg backend)
+- visualization (chart functions)
+- data (FlightData class)
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import date, datetime, timedelta, timezone
+from data import FlightData, DEFAULT_DB_URI
+
+PRERENDER_DIR = os.path.join('static', 'images', 'prerendered')
+MANIFEST_NAME = 'manifest.json'
+# Charts drawn from the whole database, rendered once per run
+GLOBAL_CHARTS = {
+    'delayed_by_airline': 'delayed_flights_per_airline.png',
+    'heatmap': 'delayed_flights_heatmap.png',
+}
+# Busiest airports kept in the prerendered heatmap; with every airport the
+# routes are too small to read
+HEATMAP_TOP_N = 50
+# Charts of a single date, rendered into a directory per date
+DATE_CHARTS = {
+    'delayed_per_hour': 'delayed_flights_per_hour.png',
+    'route_map': 'delayed_flights_map.html',
+}
+
+_worker_state = {}
+
+
+def _init_worker(db_uri):
+    """
+    Select the Agg backend and open the database in a pool process.
+    :param db_uri: Database URI.
+    """
+    # pylint: disable=import-outside-toplevel
+    import matplotlib
+    matplotlib.use('Agg')
+    import visualization
+    _worker_state['visualization'] = visualization
+    _worker_state['data_manager'] = FlightData(db_uri, query_cache_size=0)
+
+
+def _render(chart, day, path):
+    """
+    Render one chart. Executed in a pool process.
+    :param chart: Key of GLOBAL_CHARTS or DATE_CHARTS.
+    :param day: ISO date of a date chart, or None.
+    :param path: Output file.
+    :return: True if the file was written, False if there was no data.
+    """
+    visualization = _worker_state['visualization']
+    data_manager = _worker_state['data_manager']
+    if chart == 'delayed_by_airline':
+        return visualization.visualize_delayed_flights_per_airline(data_manager, path)
+    if chart == 'heatmap':
+        return visualization.plot_delayed_flights_heatmap(data_manager, path,
+                                                          top_n=HEATMAP_TOP_N)
+    if chart == 'delayed_per_hour':
+        return visualization.plot_delayed_flights_per_hour(
+            data_manager, datetime.fromisoformat(day), path)
+    when = date.fromisoformat(day)
+    return visualization.plot_delayed_flights_map(
+        data_manager, when.day, when.month, when.year,
+        use_cache=False, output_path=path) is not None
+
+
+def manifest_path(directory=PRERENDER_DIR):
+    """
+    Return the path of the manifest in an output directory.
+    :param directory: Output directory of the rendered charts.
+    :return: Path of manifest.json.
+    """
+    return os.path.join(directory, MANIFEST_NAME)
+
+
+def load_manifest(directory=PRERENDER_DIR):
+    """
+    Read the manifest of an output directory.
+    :param directory: Output directory of the rendered charts.
+    :return: Manifest dictionary, empty if none has been written yet.
+    """
+    try:
+        with open(manifest_path(directory), encoding='utf-8') as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {'charts': {}, 'dates': {}}
+
+
+def _write_manifest(directory, manifest):
+    """Write the manifest atomically, so readers never see a partial file."""
+    temporary = manifest_path(directory) + '.tmp'
+    with open(temporary, 'w', encoding='utf-8') as file:
+        json.dump(manifest, file, indent=2, sort_keys=True)
+    os.replace(temporary, manifest_path(directory))
+
+
+def date_range(start, end):
+    """
+    List the dates from start to end, both included.
+    :param start: First date.
+    :param end: Last date.
+    :return: List of dates.
+    """
+    return [start + timedelta(days=offset) for offset in range((end - start).days + 1)]
+
+
+def _is_current(entry, directory, version):
+    """Check whether a manifest entry was rendered from this data version."""
+    if not entry or entry.get('data_version') != version:
+        return False
+    return entry['file'] is None or os.path.exists(os.path.join(directory, entry['file']))
+
+
+def prerender(db_uri, start, end, directory=PRERENDER_DIR, workers=None, force=False):
+    """
+    Render the global charts and the charts of every date from start to end,
+    skipping the outputs that are up to date, and update the manifest.
+    :param db_uri: Database URI.
+    :param start: First date.
+    :param end: Last date, included.
+    :param directory: Output directory.
+    :param workers: Number of processes, defaults to the CPU count.
+    :param force: Render every output even if it is up to date.
+    :return: Tuple of (rendered, skipped, failed) counts.
+    """
+    version = FlightData(db_uri, query_cache_size=0).data_version()
+    manifest = load_manifest(directory)
+    days = [day.isoformat() for day in date_range(start, end)]
+    tasks = []  # (chart, ISO date or None, file relative to the directory)
+    for chart, name in GLOBAL_CHARTS.items():
+        if force or not _is_current(manifest['charts'].get(chart), directory, version):
+            tasks.append((chart, None, name))
+    for day in days:
+        entries = manifest['dates'].get(day, {})
+        for chart, name in DATE_CHARTS.items():
+            if force or not _is_current(entries.get(chart), directory, version):
+                tasks.append((chart, day, f"{day}/{name}"))
+    skipped = len(GLOBAL_CHARTS) + len(DATE_CHARTS) * len(days) - len(tasks)
+
+    failed = 0
+    if tasks:
+        os.makedirs(directory, exist_ok=True)
+        for day in {day for _, day, _ in tasks if day}:
+            os.makedirs(os.path.join(directory, day), exist_ok=True)
+        with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'),
+                                 initializer=_init_worker, initargs=(db_uri,)) as pool:
+            futures = {pool.submit(_render, chart, day, os.path.join(directory, file)):
+                       (chart, day, file) for chart, day, file in tasks}
+            for future in as_completed(futures):
+                chart, day, file = futures[future]
+                try:
+                    written = future.result()
+                except Exception as error:  # pylint: disable=broad-except
+                    print(f"Failed to render {file}: {error}")
+                    failed += 1
+                    continue
+                entry = {'file': file if written else None, 'data_version': version,
+                         'rendered_at': datetime.now(timezone.utc).isoformat()}
+                if day is None:
+                    manifest['charts'][chart] = entry
+                else:
+                    manifest['dates'].setdefault(day, {})[chart] = entry
+        manifest['data_version'] = version
+        _write_manifest(directory, manifest)
+    return len(tasks) - failed, skipped, failed
+
+
+def main():
+    """
+    Command-line entry point.
+    """
+    parser = argparse.ArgumentParser(description="Render the charts for a date range")
+    parser.add_argument('--start', type=date.fromisoformat, required=True,
+                        help="First date, YYYY-MM-DD")
+    parser.add_argument('--end', type=date.fromisoformat, required=True,
+                        help="Last date, YYYY-MM-DD")
+    parser.add_argument('--db', default=DEFAULT_DB_URI, help="Database URI")
+    parser.add_argument('--output', default=PRERENDER_DIR, help="Output directory")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="Processes (default: CPU count)")
+    parser.add_argument('--force', action='store_true',
+                        help="Render outputs that are already up to date")
+    args = parser.parse_args()
+    if args.end < args.start:
+        parser.error("--end is before --start")
+    started = time.perf_counter()
+    rendered, skipped, failed = prerender(args.db, args.start, args.end, args.output,
+                                          args.workers, args.force)
+    print(f"Rendered {rendered}, skipped {skipped} up to date, {failed} failed, "
+          f"in {time.perf_counter() - started:.1f}s. Manifest: {manifest_path(args.output)}")
+
+
+if __name__ == "__main__":
+    main()
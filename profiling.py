@@ -0,0 +1,163 @@
+"""
+profiling.py
+This module profiles single API requests on demand. A RequestProfile runs
+cProfile on the request thread. It also adds up the time spent in each
+phase of the request, as reported by the code doing the work:
+- query: executing SQL statements and fetching their rows,
+- materialization: building row dictionaries, DataFrames and matrices,
+- serialization: encoding the response as JSON.
+The remaining time is reported as 'other'. The stats can be saved as a
+.prof file for pstats or snakeviz, or summarized as JSON.
+"""
+
+import cProfile
+import io
+import json
+import os
+import pstats
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+PHASES = ('query', 'materialization', 'serialization')
+TOP_FUNCTIONS = 25  # Functions listed in a JSON summary
+
+_state = threading.local()
+# cProfile supports one active profiler per process on recent Pythons
+_profiler_lock = threading.Lock()
+
+
+def add_phase(name, seconds):
+    """
+    Add time to a phase of the request being profiled on this thread.
+    Does nothing when no request is profiled.
+    :param name: Phase name, one of PHASES.
+    :param seconds: Time spent.
+    """
+    phases = getattr(_state, 'phases', None)
+    if phases is not None:
+        phases[name] = phases.get(name, 0.0) + seconds
+
+
+def active():
+    """
+    Check whether a request is profiled on this thread.
+    :return: True while a RequestProfile is running.
+    """
+    return getattr(_state, 'phases', None) is not None
+
+
+@contextmanager
+def phase(name):
+    """
+    Context manager adding the time spent in its block to a phase.
+    :param name: Phase name, one of PHASES.
+    """
+    if not active():
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_phase(name, time.perf_counter() - started)
+
+
+class RequestProfile:
+    """
+    cProfile and phase timings of one request, collected on the thread
+    that handles it.
+    """
+    def __init__(self):
+        """
+        Initialize the profile; call start() to begin collecting.
+        """
+        self.phases = {}
+        self.total = None
+        self._profiler = cProfile.Profile()
+        self._started = None
+
+
+    def start(self):
+        """
+        Start profiling the current thread.
+        :return: True if profiling started, False if another request is
+                 being profiled.
+        """
+        if not _profiler_lock.acquire(blocking=False):
+            return False
+        _state.phases = self.phases
+        self._started = time.perf_counter()
+        self._profiler.enable()
+        return True
+
+
+    def stop(self):
+        """
+        Stop profiling and compute the time not covered by the phases.
+        Does nothing if the profile is already stopped.
+        """
+        if self._started is None or self.total is not None:
+            return
+        self._profiler.disable()
+        self.total = time.perf_counter() - self._started
+        _state.phases = None
+        _profiler_lock.release()
+        self.phases['other'] = max(self.total - sum(self.phases.get(name, 0.0)
+                                                    for name in PHASES), 0.0)
+
+
+    def breakdown_ms(self):
+        """
+        Return the phase timings.
+        :return: Dictionary mapping the phases, 'other' and 'total' to
+                 milliseconds.
+        """
+        timings = {name: round(self.phases.get(name, 0.0) * 1000, 3)
+                   for name in PHASES + ('other',)}
+        timings['total'] = round(self.total * 1000, 3)
+        return timings
+
+
+    def server_timing(self):
+        """
+        Format the phase timings as a Server-Timing header value, which
+        browser developer tools display next to the request.
+        :return: Header value.
+        """
+        return ', '.join(f"{name};dur={duration}"
+                         for name, duration in self.breakdown_ms().items())
+
+
+    def top_functions(self, limit=TOP_FUNCTIONS):
+        """
+        List the functions with the highest cumulative time.
+        :param limit: Number of functions.
+        :return: List of dictionaries with function, calls, total_ms and
+                 cumulative_ms.
+        """
+        stats = pstats.Stats(self._profiler, stream=io.StringIO())
+        rows = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)
+        return [{'function': f"{os.path.basename(filename)}:{line}({name})",
+                 'calls': calls, 'total_ms': round(total * 1000, 3),
+                 'cumulative_ms': round(cumulative * 1000, 3)}
+                for (filename, line, name), (_, calls, total, cumulative, _) in rows[:limit]]
+
+
+    def save(self, directory, label):
+        """
+        Save the cProfile stats and the phase timings.
+        :param directory: Directory to write to; created if missing.
+        :param label: Text included in the file names, e.g. the endpoint.
+        :return: Path of the .prof file; the timings are written next to it
+                 with a .json extension.
+        """
+        os.makedirs(directory, exist_ok=True)
+        name = f"{time.strftime('%Y%m%d-%H%M%S')}-{label}-{uuid.uuid4().hex[:8]}"
+        path = os.path.join(directory, f"{name}.prof")
+        self._profiler.dump_stats(path)
+        with open(os.path.join(directory, f"{name}.json"), 'w', encoding='utf-8') as file:
+            json.dump({'phases_ms': self.breakdown_ms(),
+                       'top_functions': self.top_functions()}, file, indent=2)
+        return path
@@ -0,0 +1,395 @@
+"""
+sketches.py
+This module summarizes the distribution of departure delays with KLL
+quantile sketches: one per route, per airline and per origin airport, built
+in one streaming pass over the flights table. A sketch keeps a few hundred
+of the delays, each standing for 2^level flights, so that the median, p90
+or p99 of millions of flights can be read without sorting them, within a
+known rank error. Sketches of the same kind merge into a sketch of all
+their flights, e.g. the airline sketches into one of every flight.
+Usage:
+    python sketches.py [--db sqlite:///data/flights.sqlite3] [--k 200]
+The sketches are written next to the database, e.g. data/flights_sketches/,
+and are used by FlightData as long as the database has not changed since
+they were built. Rebuild them after loading new data.
+Dependencies:
+- numpy
+- sqlalchemy
+- data (FlightData class)
+"""
+
+import argparse
+import json
+import math
+import os
+import sqlite3
+import time
+import numpy as np
+from sqlalchemy.engine import make_url
+from data import (FlightData, DEFAULT_DB_URI, QUANTILE_DIMENSIONS, VALID_DELAY,
+                  database_path)
+
+METADATA_NAME = 'sketches.json'
+SKETCH_K = 200  # Capacity of the top level; the rank error shrinks as 1/k
+LEVEL_RATIO = 2 / 3  # Capacity of a level relative to the level above it
+MIN_LEVEL_CAPACITY = 8
+BUILD_BATCH_ROWS = 200_000  # Flights read and grouped at a time
+SKETCH_SEED = 20150101  # Builds of the same data write the same sketches
+
+
+def rank_error(k):
+    """
+    Return the normalized rank error of a KLL sketch: a quantile read from
+    it is the exact quantile of a rank at most this far from the one asked
+    for, with 99% confidence. Uses the fit published with the Apache
+    DataSketches KLL sketch, which has the same level capacities.
+    :param k: Capacity of the top level.
+    :return: Error as a fraction of the number of flights, e.g. 0.0165.
+    """
+    return 2.446 / k ** 0.9433
+
+
+class KLLSketch:
+    """
+    KLL quantile sketch of a stream of numbers. Level h holds items that
+    each stand for 2^h of the numbers; a level over its capacity is sorted
+    and every other item is promoted to the level above.
+    """
+    def __init__(self, k=SKETCH_K, rng=None, levels=None):
+        """
+        Initialize an empty sketch, or one with the given levels.
+
+        :param k: Capacity of the top level.
+        :param rng: numpy random Generator choosing the items promoted by a
+                    compaction; a seeded one makes the sketch reproducible.
+        :param levels: List of arrays of items, from level 0 up.
+        """
+        self.k = k
+        self.levels = list(levels) if levels else [np.empty(0, dtype=np.float32)]
+        self._rng = rng if rng is not None else np.random.default_rng()
+        self._pending = []  # Arrays added to level 0 since the last compaction
+        self._pending_size = 0
+
+
+    def _capacity(self, level):
+        """Return the number of items that a level holds before it is compacted."""
+        depth = len(self.levels) - 1 - level
+        return max(MIN_LEVEL_CAPACITY, int(math.ceil(self.k * LEVEL_RATIO ** depth)))
+
+
+    def _flush(self):
+        """Move the pending items into level 0."""
+        if self._pending:
+            self.levels[0] = np.concatenate([self.levels[0]] + self._pending)
+            self._pending = []
+            self._pending_size = 0
+
+
+    def _compress(self):
+        """Compact the lowest full level until the sketch fits its capacity."""
+        self._flush()
+        while sum(len(items) for items in self.levels) > sum(
+                self._capacity(level) for level in range(len(self.levels))):
+            level = next(level for level, items in enumerate(self.levels)
+                         if len(items) >= self._capacity(level))
+            if level + 1 == len(self.levels):
+                self.levels.append(np.empty(0, dtype=np.float32))
+            items = np.sort(self.levels[level])
+            # An odd item out stays behind, so that weights add up exactly
+            paired = len(items) - len(items) % 2
+            self.levels[level] = items[paired:]
+            self.levels[level + 1] = np.concatenate(
+                (self.levels[level + 1], items[self._rng.integers(2):paired:2]))
+
+
+    def update(self, values):
+        """
+        Add numbers to the sketch.
+        :param values: Array of numbers.
+        """
+        self._pending.append(np.asarray(values, dtype=np.float32))
+        self._pending_size += len(values)
+        if len(self.levels[0]) + self._pending_size >= self._capacity(0):
+            self._compress()
+
+
+    def merge(self, other):
+        """
+        Add the numbers summarized by another sketch.
+        :param other: KLLSketch with the same k.
+        """
+        self._flush()
+        other._flush()  # pylint: disable=protected-access
+        for level, items in enumerate(other.levels):
+            if level == len(self.levels):
+                self.levels.append(np.empty(0, dtype=np.float32))
+            self.levels[level] = np.concatenate((self.levels[level], items))
+        self._compress()
+
+
+    @property
+    def count(self):
+        """Number of numbers summarized."""
+        self._flush()
+        return sum(len(items) << level for level, items in enumerate(self.levels))
+
+
+    @property
+    def exact(self):
+        """True while no item has been compacted, so quantiles are exact."""
+        self._flush()
+        return all(len(items) == 0 for items in self.levels[1:])
+
+
+    def sorted_items(self):
+        """
+        Return the items in ascending order with their weights.
+        :return: Tuple of (items, levels) arrays; an item of level h
+                 stands for 2^h numbers.
+        """
+        self._flush()
+        items = np.concatenate(self.levels)
+        levels = np.repeat(np.arange(len(self.levels), dtype=np.uint8),
+                           [len(level_items) for level_items in self.levels])
+        order = np.argsort(items, kind='stable')
+        return items[order], levels[order]
+
+
+    def quantiles(self, fractions):
+        """
+        Read quantiles: the smallest item whose rank reaches each fraction
+        of the numbers.
+        :param fractions: Sequence of fractions between 0 and 1.
+        :return: List of quantiles, None for an empty sketch.
+        """
+        items, levels = self.sorted_items()
+        if len(items) == 0:
+            return [None] * len(fractions)
+        ranks = np.cumsum(np.left_shift(1, levels.astype(np.int64)))
+        positions = np.searchsorted(ranks, np.asarray(fractions) * ranks[-1], side='left')
+        return items[np.minimum(positions, len(items) - 1)].tolist()
+
+
+class QuantileSketches:
+    """
+    The sketches of one database: for every dimension, the keys and their
+    sketches stored back to back in sorted-item arrays.
+    """
+    def __init__(self, dimensions, k, data_version):
+        """
+        Initialize the sketches. Use load() to read built sketches.
+
+        :param dimensions: Dictionary mapping each of QUANTILE_DIMENSIONS to
+                           a tuple of (keys, offsets, items, levels), where
+                           the sketch of keys[i] spans offsets[i] to
+                           offsets[i + 1] of items and levels.
+        :param k: Capacity of the top level of the sketches.
+        :param data_version: FlightData.data_version() of the database the
+                             sketches were built from.
+        """
+        self.dimensions = dimensions
+        self.k = k
+        self.data_version = data_version
+        self._indexes = {name: {key: index for index, key in enumerate(keys)}
+                         for name, (keys, _, _, _) in dimensions.items()}
+
+
+    @classmethod
+    def load(cls, directory):
+        """
+        Read sketches written by build_sketches().
+        :param directory: Directory of the sketches.
+        :return: QuantileSketches.
+        :raises OSError: If the sketches have not been built.
+        :raises ValueError: If the files do not belong together, e.g. while
+                            the sketches are being rebuilt.
+        """
+        with open(os.path.join(directory, METADATA_NAME), encoding='utf-8') as file:
+            metadata = json.load(file)
+        dimensions = {}
+        for name in QUANTILE_DIMENSIONS:
+            with np.load(os.path.join(directory, f"{name}.npz")) as arrays:
+                offsets, items, levels = arrays['offsets'], arrays['items'], arrays['levels']
+            keys = metadata['keys'][name]
+            if (len(offsets) != len(keys) + 1 or offsets[-1] != len(items)
+                    or len(items) != len(levels)):
+                raise ValueError(f"Sketch files of {name} do not match the metadata")
+            dimensions[name] = (keys, offsets, items, levels)
+        return cls(dimensions, metadata['k'], metadata['data_version'])
+
+
+    def keys(self, dimension):
+        """
+        List the keys of a dimension.
+        :param dimension: One of QUANTILE_DIMENSIONS.
+        :return: Sorted list of keys, e.g. 'LAX-JFK' for a route.
+        """
+        return self.dimensions[dimension][0]
+
+
+    def sketch(self, dimension, key):
+        """
+        Return the sketch of one key.
+        :param dimension: One of QUANTILE_DIMENSIONS.
+        :param key: Airline name, origin airport code, or route as
+                    'ORIGIN-DESTINATION'.
+        :return: KLLSketch, or None if the key has no flights.
+        """
+        index = self._indexes[dimension].get(key)
+        if index is None:
+            return None
+        _, offsets, items, levels = self.dimensions[dimension]
+        start, end = offsets[index], offsets[index + 1]
+        levels = levels[start:end]
+        items = items[start:end]
+        return KLLSketch(self.k, levels=[items[levels == level]
+                                         for level in range(int(levels.max()) + 1)])
+
+
+    def merged(self, dimension):
+        """
+        Merge the sketches of every key of a dimension.
+        :param dimension: One of QUANTILE_DIMENSIONS.
+        :return: KLLSketch of all the flights.
+        """
+        sketch = KLLSketch(self.k, rng=np.random.default_rng(SKETCH_SEED))
+        for key in self.keys(dimension):
+            sketch.merge(self.sketch(dimension, key))
+        return sketch
+
+
+def sketch_directory(db_uri):
+    """
+    Return the directory holding the sketches of a database.
+    :param db_uri: Database URI or SQLAlchemy URL.
+    :return: Directory path, e.g. data/flights_sketches for
+             sqlite:///data/flights.sqlite3.
+    """
+    path = database_path(make_url(db_uri))
+    return f"{os.path.splitext(path)[0]}_sketches"
+
+
+def _group_keys(batch):
+    """
+    Compute the key of every flight of a batch in every dimension.
+    :param batch: Tuple of (origin airports, destination airports,
+                  airline names) arrays.
+    :return: Dictionary mapping the dimensions to arrays of keys.
+    """
+    origins, destinations, airlines = batch
+    return {'route': np.char.add(np.char.add(origins, '-'), destinations),
+            'airline': airlines, 'airport': origins}
+
+
+def build_sketches(db_uri, k=SKETCH_K):
+    """
+    Sketch the departure delays of every route, airline and origin airport
+    in one pass over the flights table and write the sketches. Flights
+    without a departure delay, e.g. cancelled ones, are left out.
+    :param db_uri: Database URI.
+    :param k: Capacity of the top level of the sketches.
+    :return: The built QuantileSketches.
+    """
+    data_manager = FlightData(db_uri, query_cache_size=0)
+    # Recorded once the log is checkpointed, as that changes the version
+    data_manager.checkpoint()
+    version = data_manager.data_version()
+    directory = sketch_directory(db_uri)
+    os.makedirs(directory, exist_ok=True)
+    rng = np.random.default_rng(SKETCH_SEED)
+    sketches = {name: {} for name in QUANTILE_DIMENSIONS}
+
+    path = database_path(make_url(db_uri))
+    with sqlite3.connect(f"file:{path}?mode=ro", uri=True) as connection:
+        names = dict(connection.execute("SELECT ID, AIRLINE FROM airlines"))
+        cursor = connection.execute(f"""
+        SELECT ORIGIN_AIRPORT, DESTINATION_AIRPORT, AIRLINE, DEPARTURE_DELAY
+        FROM flights
+        WHERE {VALID_DELAY}
+        """)
+        while rows := cursor.fetchmany(BUILD_BATCH_ROWS):
+            origins, destinations, airlines, delays = zip(*rows)
+            airlines = [names.get(airline, str(airline)) for airline in airlines]
+            delays = np.array(delays, dtype=np.float32)
+            keys = _group_keys((np.array(origins, dtype=str),
+                                np.array(destinations, dtype=str),
+                                np.array(airlines, dtype=str)))
+            for name, dimension_keys in keys.items():
+                unique, inverse = np.unique(dimension_keys, return_inverse=True)
+                order = np.argsort(inverse, kind='stable')
+                groups = np.split(delays[order], np.cumsum(np.bincount(inverse))[:-1])
+                for key, values in zip(unique.tolist(), groups):
+                    sketch = sketches[name].get(key)
+                    if sketch is None:
+                        sketch = sketches[name][key] = KLLSketch(k, rng)
+                    sketch.update(values)
+
+    keys = {}
+    for name, dimension_sketches in sketches.items():
+        keys[name] = sorted(dimension_sketches)
+        items, levels = zip(*(dimension_sketches[key].sorted_items()
+                              for key in keys[name])) if keys[name] else ((), ())
+        offsets = np.zeros(len(keys[name]) + 1, dtype=np.int64)
+        np.cumsum([len(key_items) for key_items in items], out=offsets[1:])
+        sketch_path = os.path.join(directory, f"{name}.npz")
+        with open(sketch_path + '.tmp', 'wb') as file:
+            np.savez(file, offsets=offsets,
+                     items=np.concatenate(items or [np.empty(0, dtype=np.float32)]),
+                     levels=np.concatenate(levels or [np.empty(0, dtype=np.uint8)]))
+        os.replace(sketch_path + '.tmp', sketch_path)
+
+    # Written last and atomically: readers check the sketches against it
+    metadata_path = os.path.join(directory, METADATA_NAME)
+    with open(metadata_path + '.tmp', 'w', encoding='utf-8') as file:
+        json.dump({'data_version': version, 'k': k, 'keys': keys}, file)
+    os.replace(metadata_path + '.tmp', metadata_path)
+    return QuantileSketches.load(directory)
+
+
+def sketches_version(db_uri):
+    """
+    Return a token that changes whenever the sketches of a database are rebuilt.
+    :param db_uri: Database URI or SQLAlchemy URL.
+    :return: Version string, '-' if the sketches have not been built.
+    """
+    try:
+        stat = os.stat(os.path.join(sketch_directory(db_uri), METADATA_NAME))
+    except OSError:
+        return '-'
+    return f"{stat.st_mtime_ns}-{stat.st_size}"
+
+
+def load_sketches(db_uri, data_version):
+    """
+    Read the sketches of a database if they are up to date.
+    :param db_uri: Database URI or SQLAlchemy URL.
+    :param data_version: Current FlightData.data_version() of the database.
+    :return: QuantileSketches, or None if they are missing or were built
+             from an older version of the database.
+    """
+    try:
+        sketches = QuantileSketches.load(sketch_directory(db_uri))
+    except (OSError, ValueError, KeyError):
+        return None
+    return sketches if sketches.data_version == data_version else None
+
+
+def main():
+    """
+    Command-line entry point.
+    """
+    parser = argparse.ArgumentParser(
+        description="Build the delay quantile sketches of a database")
+    parser.add_argument('--db', default=DEFAULT_DB_URI, help="Database URI")
+    parser.add_argument('--k', type=int, default=SKETCH_K,
+                        help="Sketch size; the rank error shrinks as 1/k")
+    args = parser.parse_args()
+    started = time.perf_counter()
+    sketches = build_sketches(args.db, args.k)
+    counts = ', '.join(f"{len(sketches.keys(name))} {name}s" for name in QUANTILE_DIMENSIONS)
+    print(f"Wrote the sketches of {counts} (rank error {rank_error(args.k):.2%}) to "
+          f"{sketch_directory(args.db)} in {time.perf_counter() - started:.1f}s.")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,37 @@
+let loadedFlights = [];
+let nextPageUrl = null;
+
+function setNextPage(url) {
+    nextPageUrl = url;
+    document.getElementById('loadMore').style.display = url ? 'inline-block' : 'none';
+}
+
+async function fetchFlightPage(url, errorMessage, append = false) {
+    try {
+        const response = await fetch(url);
+        const data = await response.json();
+        loadedFlights = append ? loadedFlights.concat(data.results) : data.results;
+        displayResults(loadedFlights, 'flights');
+
+        if (data.next_cursor === null || data.next_cursor === undefined) {
+            setNextPage(null);
+        } else {
+            const next = new URL(url);
+            next.searchParams.set('after', data.next_cursor);
+            setNextPage(next.toString());
+        }
+    } catch (error) {
+        console.error(errorMessage, error);
+        showError(errorMessage);
+    }
+}
+
+async function loadMoreFlights() {
+    if (nextPageUrl) {
+        await fetchFlightPage(nextPageUrl, 'Error fetching more flights.', true);
+    }
+}
+
 function displayResults(data, dataType) {
     const resultsDiv = document.getElementById('results');
     resultsDiv.innerHTML = '';
@@ -19,7 +53,7 @@ function displayResults(data, dataType) {
             headers = ['ID', 'AIRLINE'];
             break;
         case 'flights':
-            headers = ['ID', 'YEAR', 'MONTH', 'DAY', 'AIRLINE', 'FLIGHT_NUMBER', 'ORIGIN_AIRPORT', 'DESTINATION_AIRPORT', 'SCHEDULED_DEPARTURE', 'DEPARTURE_TIME', 'DEPARTURE_DELAY', 'ARRIVAL_TIME', 'ARRIVAL_DELAY'];
+            headers = ['FLIGHT_ID', 'YEAR', 'MONTH', 'DAY', 'AIRLINE', 'FLIGHT_NUMBER', 'ORIGIN_AIRPORT', 'DESTINATION_AIRPORT', 'SCHEDULED_DEPARTURE', 'DEPARTURE_TIME', 'DEPARTURE_DELAY', 'ARRIVAL_TIME', 'ARRIVAL_DELAY'];
             break;
         case 'airports':
             headers = ['IATA_CODE', 'AIRPORT', 'CITY', 'STATE', 'COUNTRY', 'LATITUDE', 'LONGITUDE'];
@@ -63,6 +97,7 @@ async function fetchFlightById() {
     try {
         const response = await fetch(`http://127.0.0.1:5000/flight/${flightId}`);
         const data = await response.json();
+        setNextPage(null);
         displayResults(data, 'flights');
     } catch (error) {
         console.error('Error fetching flight by ID:', error);
@@ -80,14 +115,10 @@ async function fetchFlightsByDate() {
         return;
     }
 
-    try {
-        const response = await fetch(`http://127.0.0.1:5000/flights/date?day=${day}&month=${month}&year=${year}`);
-        const data = await response.json();
-        displayResults(data, 'flights');
-    } catch (error) {
-        console.error('Error fetching flights by date:', error);
-        showError('Error fetching flights by date.');
-    }
+    await fetchFlightPage(
+        `http://127.0.0.1:5000/flights/date?day=${day}&month=${month}&year=${year}`,
+        'Error fetching flights by date.'
+    );
 }
 
 async function fetchDelayedFlightsByAirline() {
@@ -97,14 +128,10 @@ async function fetchDelayedFlightsByAirline() {
         return;
     }
 
-    try {
-        const response = await fetch(`http://127.0.0.1:5000/delayed/airline/${encodeURIComponent(airlineName)}`);
-        const data = await response.json();
-        displayResults(data, 'flights');
-    } catch (error) {
-        console.error('Error fetching delayed flights by airline:', error);
-        showError('Error fetching delayed flights by airline.');
-    }
+    await fetchFlightPage(
+        `http://127.0.0.1:5000/delayed/airline/${encodeURIComponent(airlineName)}`,
+        'Error fetching delayed flights by airline.'
+    );
 }
 
 async function fetchDelayedFlightsByAirport() {
@@ -114,14 +141,10 @@ async function fetchDelayedFlightsByAirport() {
         return;
     }
 
-    try {
-        const response = await fetch(`http://127.0.0.1:5000/delayed/airport/${encodeURIComponent(airportCode)}`);
-        const data = await response.json();
-        displayResults(data, 'flights');
-    } catch (error) {
-        console.error('Error fetching delayed flights by airport:', error);
-        showError('Error fetching delayed flights by airport.');
-    }
+    await fetchFlightPage(
+        `http://127.0.0.1:5000/delayed/airport/${encodeURIComponent(airportCode)}`,
+        'Error fetching delayed flights by airport.'
+    );
 }
 
 
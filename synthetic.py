@@ -0,0 +1,383 @@
+"""
+synthetic.py
+This module generates synthetic flights databases with the schema built by
+ingest.py, for benchmarks and development without the real data. Any
+number of flights can be generated, from a few thousand up to the 5.8
+million of the full 2015 data set. The output is reproducible for a given
+seed and has realistic skew:
+- airline market shares and hub-heavy routes follow a power law,
+- departures peak in the morning and the late afternoon,
+- delays become more likely through the day, at busy airports and in the
+  winter and summer peaks, with a long tail of long delays,
+- about 1.5% of flights are cancelled and 0.3% diverted,
+- October uses numeric airport codes, as the 2015 data does, and a few
+  airports have no coordinates.
+Usage:
+    python synthetic.py --rows 1000000 [--db sqlite:///data/synthetic.sqlite3]
+                        [--seed 0] [--airports 300]
+Dependencies:
+- numpy
+- sqlalchemy
+- ingest (schemas and bulk load settings)
+- data (FlightData class)
+- cube (delay cube)
+- sketches (delay quantile sketches)
+"""
+
+import argparse
+import os
+import sqlite3
+import time
+from datetime import date
+import numpy as np
+from sqlalchemy.engine import make_url
+from airports import EARTH_RADIUS_KM
+from cube import build_cube
+from data import FlightData, DELAY_THRESHOLD, database_path
+from sketches import build_sketches
+from ingest import (AIRLINES_SCHEMA, AIRPORTS_SCHEMA, BULK_LOAD_PRAGMAS, FLIGHTS_SCHEMA,
+                    FLIGHT_CSV_COLUMNS, NORMALIZED_COLUMNS)
+
+SYNTHETIC_DB_URI = 'sqlite:///data/synthetic.sqlite3'
+FULL_YEAR_ROWS = 5_819_079  # Flights in the 2015 data set
+YEAR = 2015
+CHUNK_ROWS = 200_000  # Flights generated and written per transaction
+
+# Airlines of the 2015 data set with their approximate share of flights
+AIRLINES = (
+    ('WN', 'Southwest Airlines Co.', 0.22),
+    ('DL', 'Delta Air Lines Inc.', 0.15),
+    ('AA', 'American Airlines Inc.', 0.125),
+    ('OO', 'Skywest Airlines Inc.', 0.10),
+    ('EV', 'Atlantic Southeast Airlines', 0.10),
+    ('UA', 'United Air Lines Inc.', 0.09),
+    ('MQ', 'American Eagle Airlines Inc.', 0.05),
+    ('B6', 'JetBlue Airways', 0.045),
+    ('US', 'US Airways Inc.', 0.035),
+    ('AS', 'Alaska Airlines Inc.', 0.03),
+    ('NK', 'Spirit Air Lines', 0.02),
+    ('F9', 'Frontier Airlines Inc.', 0.015),
+    ('HA', 'Hawaiian Airlines Inc.', 0.013),
+    ('VX', 'Virgin America', 0.01),
+)
+# The busiest airports, in order of traffic; the rest are generated
+HUBS = (
+    ('ATL', 'Atlanta', 'GA', 33.64, -84.43), ('ORD', 'Chicago', 'IL', 41.98, -87.90),
+    ('DFW', 'Dallas-Fort Worth', 'TX', 32.90, -97.04), ('DEN', 'Denver', 'CO', 39.86, -104.67),
+    ('LAX', 'Los Angeles', 'CA', 33.94, -118.41), ('SFO', 'San Francisco', 'CA', 37.62, -122.37),
+    ('PHX', 'Phoenix', 'AZ', 33.43, -112.01), ('IAH', 'Houston', 'TX', 29.98, -95.34),
+    ('LAS', 'Las Vegas', 'NV', 36.08, -115.15), ('MSP', 'Minneapolis', 'MN', 44.88, -93.22),
+    ('MCO', 'Orlando', 'FL', 28.43, -81.31), ('SEA', 'Seattle', 'WA', 47.45, -122.31),
+    ('DTW', 'Detroit', 'MI', 42.21, -83.35), ('BOS', 'Boston', 'MA', 42.36, -71.01),
+    ('EWR', 'Newark', 'NJ', 40.69, -74.17), ('CLT', 'Charlotte', 'NC', 35.21, -80.94),
+    ('LGA', 'New York', 'NY', 40.78, -73.87), ('SLC', 'Salt Lake City', 'UT', 40.79, -111.98),
+    ('JFK', 'New York', 'NY', 40.64, -73.78), ('BWI', 'Baltimore', 'MD', 39.18, -76.67),
+)
+# Airports of the 2015 data set without coordinates
+UNLOCATED_AIRPORTS = ('ECP', 'PBG', 'UST')
+# Share of departures per hour of the day
+HOUR_WEIGHTS = np.array([1, 0.3, 0.1, 0.1, 0.2, 2, 7, 8, 7, 6, 6, 6,
+                         6, 6, 6, 6, 6.5, 7, 6.5, 5.5, 4.5, 3.5, 2.5, 1.5])
+MONTH_WEIGHTS = np.array([0.95, 0.88, 1.05, 1.02, 1.04, 1.06, 1.10, 1.09, 0.98, 1.01, 0.96, 0.99])
+# Added to the probability of a delay per month: winter storms and summer peaks
+MONTH_DELAY_BIAS = np.array([0.04, 0.05, 0.01, -0.01, -0.01, 0.05, 0.05, 0.03,
+                             -0.04, -0.03, -0.02, 0.05])
+CANCELLATION_REASONS = np.array(['A', 'B', 'C', 'D'])
+CANCELLATION_WEIGHTS = np.array([0.28, 0.54, 0.18, 0.0002])
+
+
+def _airport_rows(rng, count):
+    """
+    Build the airports: the hubs first, then generated airports spread over
+    the contiguous United States, then the airports without coordinates.
+    :param rng: NumPy random generator.
+    :param count: Number of airports with coordinates, including the hubs.
+    :return: List of airports table rows.
+    """
+    rows = [(code, f"{city} International Airport", city, state, 'USA', latitude, longitude)
+            for code, city, state, latitude, longitude in HUBS[:count]]
+    codes = {row[0] for row in rows} | set(UNLOCATED_AIRPORTS)
+    letters = np.array(list('ABCDEFGHIJKLMNOPQRSTUVWXYZ'))
+    while len(rows) < count:
+        code = ''.join(rng.choice(letters, 3))
+        if code in codes:
+            continue
+        codes.add(code)
+        rows.append((code, f"{code} Regional Airport", f"{code} City", 'XX', 'USA',
+                     round(float(rng.uniform(25, 49)), 5),
+                     round(float(rng.uniform(-124, -68)), 5)))
+    rows += [(code, f"{code} Airport", '', '', 'USA', '', '') for code in UNLOCATED_AIRPORTS]
+    return rows
+
+
+def _day_counts(rng, rows):
+    """
+    Spread the flights over the days of the year, with fewer flights on
+    Saturdays and seasonal variation.
+    :param rng: NumPy random generator.
+    :param rows: Number of flights.
+    :return: Tuple of (dates, flights per date).
+    """
+    first = date(YEAR, 1, 1).toordinal()
+    dates = [date.fromordinal(ordinal)
+             for ordinal in range(first, date(YEAR, 12, 31).toordinal() + 1)]
+    weights = np.array([MONTH_WEIGHTS[day.month - 1] * (0.8 if day.weekday() == 5 else 1.0)
+                        for day in dates])
+    return dates, rng.multinomial(rows, weights / weights.sum())
+
+
+def _hhmm(minutes):
+    """Convert minutes after midnight to the HHMM integers of the data set."""
+    minutes = np.asarray(minutes) % 1440
+    return minutes // 60 * 100 + minutes % 60
+
+
+def _blank(values, mask):
+    """Return a column as a list with empty strings where mask is set."""
+    column = values.astype(object)
+    column[mask] = ''
+    return column.tolist()
+
+
+class _FlightGenerator:
+    """
+    Generates chunks of flights rows. The per-airline, per-airport and per
+    hour tendencies are drawn once, so that all chunks share them.
+    """
+    def __init__(self, rng, airports):
+        """
+        Draw the tendencies of the airlines, airports and hours.
+
+        :param rng: NumPy random generator.
+        :param airports: Rows of the airports table.
+        """
+        self._rng = rng
+        self._codes = np.array([row[0] for row in airports])
+        # October flights use numeric airport codes, as in the 2015 data
+        self._numeric_codes = np.array([str(10135 + 37 * index)
+                                        for index in range(len(airports))])
+        latitudes = np.array([row[5] if row[5] != '' else np.nan for row in airports],
+                             dtype=float)
+        longitudes = np.array([row[6] if row[6] != '' else np.nan for row in airports],
+                              dtype=float)
+        self._latitudes = np.nan_to_num(latitudes, nan=39.8)
+        self._longitudes = np.nan_to_num(longitudes, nan=-98.6)
+
+        # Airport traffic follows a power law; unlocated airports are small
+        ranks = np.arange(1, len(airports) + 1)
+        weights = 1 / ranks ** 1.1
+        self._airport_weights = weights / weights.sum()
+        self._airport_delay_bias = np.where(ranks <= 10, 0.03, 0.0) + rng.normal(0, 0.02,
+                                                                                 len(ranks))
+        shares = np.array([share for _, _, share in AIRLINES])
+        self._airline_weights = shares / shares.sum()
+        self._airline_delay_bias = rng.uniform(-0.04, 0.06, len(AIRLINES))
+        self._hour_weights = HOUR_WEIGHTS / HOUR_WEIGHTS.sum()
+        # Delays build up through the day
+        self._hour_delay_bias = np.clip((np.arange(24) - 5) / 15, 0, 1) * 0.12
+        letters = np.array(list('ABCDEFGHJKLMNPRSTUVWXYZ'))
+        self._tails = np.array([f"N{number}{''.join(rng.choice(letters, 2))}"
+                                for number in rng.integers(100, 999, 5000)])
+
+
+    def rows(self, first_id, dates, day_counts):
+        """
+        Generate the flights of some dates.
+        :param first_id: ID of the first flight.
+        :param dates: List of dates.
+        :param day_counts: Number of flights of every date.
+        :return: List of flights rows, in date and departure time order,
+                 with the columns of ingest.FLIGHTS_SCHEMA.
+        """
+        rng = self._rng
+        count = int(sum(day_counts))
+        days = np.repeat(np.arange(len(dates)), day_counts)
+        month = np.array([day.month for day in dates])[days]
+        scheduled = (rng.choice(24, count, p=self._hour_weights) * 60
+                     + rng.integers(0, 12, count) * 5)
+        order = np.lexsort((scheduled, days))
+        days, month, scheduled = days[order], month[order], scheduled[order]
+        hour = scheduled // 60
+
+        airline = rng.choice(len(AIRLINES), count, p=self._airline_weights)
+        origin = rng.choice(len(self._codes), count, p=self._airport_weights)
+        destination = rng.choice(len(self._codes), count, p=self._airport_weights)
+        same = origin == destination
+        destination[same] = (destination[same] + 1 + rng.integers(0, len(self._codes) - 1,
+                                                                   same.sum())) % len(self._codes)
+
+        # Delays: a share of flights is late with a long-tailed delay, the
+        # rest leave around the scheduled time
+        probability = np.clip(0.10 + self._hour_delay_bias[hour]
+                              + self._airline_delay_bias[airline]
+                              + self._airport_delay_bias[origin]
+                              + MONTH_DELAY_BIAS[month - 1], 0.02, 0.6)
+        late = rng.random(count) < probability
+        delay = np.where(late, 5 + rng.lognormal(3.3, 0.9, count),
+                         np.clip(rng.normal(-3, 5, count), -20, 14)).round().astype(np.int64)
+        cancelled = rng.random(count) < np.where(month == 2, 0.04, 0.013)
+        diverted = ~cancelled & (rng.random(count) < 0.0026)
+
+        miles = np.maximum(0.621371 * _route_km(self._latitudes, self._longitudes,
+                                                origin, destination),
+                           50).round().astype(np.int64)
+        scheduled_time = (miles / 7.5 + 35).round().astype(np.int64)
+        taxi_out = (8 + rng.exponential(8, count)).round().astype(np.int64)
+        taxi_in = (3 + rng.exponential(5, count)).round().astype(np.int64)
+        air_time = np.maximum(scheduled_time - 25 + rng.normal(0, 6, count).round()
+                              .astype(np.int64), 15)
+        elapsed_time = taxi_out + air_time + taxi_in
+        departure = scheduled + delay
+        arrival_delay = delay + elapsed_time - scheduled_time
+        no_departure = cancelled
+        no_arrival = cancelled | diverted
+        with_causes = ~no_arrival & (arrival_delay >= 15)
+        airline_delay = np.maximum(delay, 0) // 2
+        late_aircraft_delay = np.maximum(delay, 0) - airline_delay
+        air_system_delay = np.maximum(arrival_delay - airline_delay - late_aircraft_delay, 0)
+
+        codes = np.where((month == 10)[:, None],
+                         self._numeric_codes[np.stack([origin, destination], axis=1)],
+                         self._codes[np.stack([origin, destination], axis=1)])
+        reasons = np.where(cancelled, CANCELLATION_REASONS[rng.choice(
+            len(CANCELLATION_REASONS), count, p=CANCELLATION_WEIGHTS / CANCELLATION_WEIGHTS.sum())],
+                           '')
+        weekday = np.array([day.isoweekday() for day in dates])[days]
+        day_of_month = np.array([day.day for day in dates])[days]
+        zeros = np.zeros(count, dtype=np.int64)
+
+        columns = {
+            'YEAR': np.full(count, YEAR).tolist(),
+            'MONTH': month.tolist(),
+            'DAY': day_of_month.tolist(),
+            'DAY_OF_WEEK': weekday.tolist(),
+            'AIRLINE': (airline + 1).tolist(),
+            'FLIGHT_NUMBER': rng.integers(1, 6000, count).tolist(),
+            'TAIL_NUMBER': self._tails[rng.integers(0, len(self._tails), count)].tolist(),
+            'ORIGIN_AIRPORT': codes[:, 0].tolist(),
+            'DESTINATION_AIRPORT': codes[:, 1].tolist(),
+            'SCHEDULED_DEPARTURE': _hhmm(scheduled).tolist(),
+            'DEPARTURE_TIME': _blank(_hhmm(departure), no_departure),
+            'DEPARTURE_DELAY': _blank(delay, no_departure),
+            'TAXI_OUT': _blank(taxi_out, no_departure),
+            'WHEELS_OFF': _blank(_hhmm(departure + taxi_out), no_departure),
+            'SCHEDULED_TIME': scheduled_time.tolist(),
+            'ELAPSED_TIME': _blank(elapsed_time, no_arrival),
+            'AIR_TIME': _blank(air_time, no_arrival),
+            'DISTANCE': miles.tolist(),
+            'WHEELS_ON': _blank(_hhmm(departure + taxi_out + air_time), no_arrival),
+            'TAXI_IN': _blank(taxi_in, no_arrival),
+            'SCHEDULED_ARRIVAL': _hhmm(scheduled + scheduled_time).tolist(),
+            'ARRIVAL_TIME': _blank(_hhmm(departure + elapsed_time), no_arrival),
+            'ARRIVAL_DELAY': _blank(arrival_delay, no_arrival),
+            'DIVERTED': diverted.astype(np.int64).tolist(),
+            'CANCELLED': cancelled.astype(np.int64).tolist(),
+            'CANCELLATION_REASON': reasons.tolist(),
+            'AIR_SYSTEM_DELAY': _blank(air_system_delay, ~with_causes),
+            'SECURITY_DELAY': _blank(zeros, ~with_causes),
+            'AIRLINE_DELAY': _blank(airline_delay, ~with_causes),
+            'LATE_AIRCRAFT_DELAY': _blank(late_aircraft_delay, ~with_causes),
+            'WEATHER_DELAY': _blank(zeros, ~with_causes),
+        }
+        delay_minutes = np.where(no_departure, 0, delay)
+        return list(zip(range(first_id, first_id + count),
+                        *(columns[name] for name in FLIGHT_CSV_COLUMNS),
+                        delay_minutes.tolist(),
+                        (delay_minutes > DELAY_THRESHOLD).astype(np.int64).tolist(),
+                        (YEAR * 10000 + month * 100 + day_of_month).tolist()))
+
+
+def _route_km(latitudes, longitudes, origins, destinations):
+    """Great-circle distance in kilometres of every route."""
+    lat1, lon1 = np.radians(latitudes[origins]), np.radians(longitudes[origins])
+    lat2, lon2 = np.radians(latitudes[destinations]), np.radians(longitudes[destinations])
+    a = (np.sin((lat2 - lat1) / 2) ** 2
+         + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def generate(db_uri, rows, seed=0, airports=300):
+    """
+    Create a synthetic flights database, replacing any existing file, and
+    build its indexes, rollup tables, delay cube and delay quantile sketches.
+    :param db_uri: Database URI of the SQLite file to create.
+    :param rows: Number of flights.
+    :param seed: Seed of the random generator.
+    :param airports: Number of airports with coordinates.
+    :return: Number of flights written.
+    """
+    path = database_path(make_url(db_uri))
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    rng = np.random.default_rng(seed)
+    airport_rows = _airport_rows(rng, max(airports, 2))
+    generator = _FlightGenerator(rng, airport_rows)
+    dates, day_counts = _day_counts(rng, rows)
+
+    columns = ['ID', *FLIGHT_CSV_COLUMNS, *NORMALIZED_COLUMNS]
+    insert = (f"INSERT INTO flights ({', '.join(columns)}) "
+              f"VALUES ({', '.join('?' * len(columns))})")
+    connection = sqlite3.connect(path, isolation_level=None)
+    written = 0
+    started = time.perf_counter()
+    try:
+        for pragma in BULK_LOAD_PRAGMAS:
+            connection.execute(pragma)
+        for schema in (FLIGHTS_SCHEMA, AIRLINES_SCHEMA, AIRPORTS_SCHEMA):
+            connection.execute(schema)
+        connection.execute("BEGIN")
+        connection.executemany("INSERT INTO airlines VALUES (?, ?)",
+                               [(index, name) for index, (_, name, _)
+                                in enumerate(AIRLINES, 1)])
+        connection.executemany("INSERT INTO airports VALUES (?, ?, ?, ?, ?, ?, ?)",
+                               airport_rows)
+        connection.execute("COMMIT")
+
+        # Whole days per chunk, so that the flights stay in date order
+        first = 0
+        while first < len(dates):
+            last = first + 1
+            while last < len(dates) and day_counts[first:last + 1].sum() <= CHUNK_ROWS:
+                last += 1
+            chunk = generator.rows(written + 1, dates[first:last], day_counts[first:last])
+            connection.execute("BEGIN")
+            connection.executemany(insert, chunk)
+            connection.execute("COMMIT")
+            written += len(chunk)
+            first = last
+            elapsed = time.perf_counter() - started
+            print(f"  {written:,} flights, {written / elapsed:,.0f} rows/s")
+        connection.execute("PRAGMA synchronous = NORMAL")
+    finally:
+        connection.close()
+
+    data_manager = FlightData(db_uri)
+    data_manager.optimize_schema()
+    data_manager.refresh_rollups()
+    data_manager.checkpoint()
+    build_cube(db_uri)
+    build_sketches(db_uri)
+    return written
+
+
+def main():
+    """
+    Command-line entry point.
+    """
+    parser = argparse.ArgumentParser(description="Generate a synthetic flights database")
+    parser.add_argument('--rows', type=int, default=FULL_YEAR_ROWS,
+                        help=f"Number of flights (default: {FULL_YEAR_ROWS:,}, the full year)")
+    parser.add_argument('--db', default=SYNTHETIC_DB_URI, help="Database URI to create")
+    parser.add_argument('--seed', type=int, default=0, help="Random seed")
+    parser.add_argument('--airports', type=int, default=300,
+                        help="Airports with coordinates")
+    args = parser.parse_args()
+    started = time.perf_counter()
+    written = generate(args.db, args.rows, args.seed, args.airports)
+    print(f"Generated {written:,} flights in {args.db} in "
+          f"{time.perf_counter() - started:.1f}s.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""
+Shared fixtures of the test suite: a small synthetic flights database,
+generated once per test session, and the API serving it, with helpers to
+copy that database and to compare query results.
+"""
+
+import importlib
+import os
+import sqlite3
+import subprocess
+import sys
+import numpy as np
+import pandas as pd
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+SYNTHETIC_ROWS = 20_000
+
+
+@pytest.fixture(scope='session')
+def synthetic_db(tmp_path_factory):
+    """
+    Generate a synthetic database with its indexes, rollup tables, delay
+    cube and quantile sketches. It is generated by synthetic.py in its own
+    process, as from the command line, so that no connection of the test
+    process holds on to its write-ahead log.
+    :return: Database URI.
+    """
+    path = tmp_path_factory.mktemp('synthetic') / 'flights.sqlite3'
+    db_uri = f"sqlite:///{path}"
+    subprocess.run([sys.executable, 'synthetic.py', '--rows', str(SYNTHETIC_ROWS),
+                    '--seed', '1', '--airports', '40', '--db', db_uri],
+                   cwd=REPO_DIR, check=True, capture_output=True)
+    return db_uri
+
+
+def copy_database(synthetic_db, tmp_path_factory, name):
+    """
+    Copy the synthetic database, without its delay cube and sketches.
+    :return: Path of the copy.
+    """
+    path = tmp_path_factory.mktemp(name) / 'flights.sqlite3'
+    with sqlite3.connect(synthetic_db.removeprefix('sqlite:///')) as source, \
+            sqlite3.connect(path) as copy:
+        source.backup(copy)
+    return path
+
+
+def comparable(result):
+    """Convert a result to lists and dictionaries with rounded floats."""
+    # pylint: disable=import-outside-toplevel
+    from data import Rows
+    from heatmap import RouteMatrix
+    if isinstance(result, pd.DataFrame):
+        result = result.to_dict(orient='records')
+    elif isinstance(result, RouteMatrix):
+        result = {name: value.tolist() if isinstance(value, np.ndarray) else value
+                  for name, value in vars(result).items()}
+    elif isinstance(result, Rows):
+        result = {'columns': result.columns, 'rows': list(result)}
+    if isinstance(result, dict):
+        return {key: comparable(value) for key, value in result.items()}
+    if isinstance(result, (list, tuple)) or hasattr(result, '__next__'):
+        return [comparable(value) for value in result]
+    if isinstance(result, (float, np.floating)):
+        return round(float(result), 6)
+    return result.item() if isinstance(result, np.generic) else result
+
+
+@pytest.fixture(scope='session')
+def api(synthetic_db):
+    """
+    The api module, serving the synthetic database. It reads the database
+    URI from the environment when it is first imported.
+    """
+    with pytest.MonkeyPatch.context() as patch:
+        patch.setenv('FLIGHT_DATA_DB', synthetic_db)
+        return importlib.import_module('api')
@@ -0,0 +1,94 @@
+"""
+Tests that the grid index of AirportRegistry finds the same airports as a
+brute-force search over all of them, near the poles and across the
+antimeridian as well.
+"""
+
+import numpy as np
+import pytest
+from airports import AirportRegistry, haversine_km
+
+AIRPORTS = 2000
+
+
+@pytest.fixture(scope='module', name='registry')
+def fixture_registry():
+    """Airports at random points of the globe, with some on its edges."""
+    rng = np.random.default_rng(7)
+    # Uniform on the sphere, so the polar cells are sparse
+    latitudes = np.degrees(np.arcsin(rng.uniform(-1, 1, AIRPORTS)))
+    longitudes = rng.uniform(-180, 180, AIRPORTS)
+    edges = [(90, 0), (-90, 45), (0, 180), (10, -180), (-20, 179.99), (30, -179.99)]
+    latitudes = np.append(latitudes, [latitude for latitude, _ in edges])
+    longitudes = np.append(longitudes, [longitude for _, longitude in edges])
+    return AirportRegistry({'IATA_CODE': f'A{index:04d}', 'LATITUDE': latitude,
+                            'LONGITUDE': longitude}
+                           for index, (latitude, longitude)
+                           in enumerate(zip(latitudes.tolist(), longitudes.tolist())))
+
+
+def _codes(results):
+    """IATA codes of registry results."""
+    return [result['IATA_CODE'] for result in results]
+
+
+def _distances(registry, latitude, longitude):
+    """Distances from a point to every airport, in registry order."""
+    return haversine_km(latitude, longitude, registry.latitudes, registry.longitudes)
+
+
+def _code(position):
+    """IATA code of the airport at a position of the fixture."""
+    return f'A{position:04d}'
+
+
+POINTS = [(0, 0), (40.6, -73.8), (-33.9, 151.2), (89.5, 10), (-89.9, -170), (0, 179.9),
+          (12, -179.5), (65, 180), (-45, -180), (89.99, -179.99)]
+
+
+@pytest.mark.parametrize('latitude, longitude', POINTS)
+@pytest.mark.parametrize('count', [1, 5, 50])
+def test_nearest_matches_brute_force(registry, latitude, longitude, count):
+    """The count closest airports, nearest first."""
+    distances = _distances(registry, latitude, longitude)
+    expected = np.argsort(distances, kind='stable')[:count]
+    results = registry.nearest(latitude, longitude, count)
+    assert _codes(results) == [_code(position) for position in expected]
+    assert [result['DISTANCE_KM'] for result in results] == distances[expected].tolist()
+
+
+@pytest.mark.parametrize('latitude, longitude', POINTS)
+@pytest.mark.parametrize('radius_km', [0, 100, 800, 5000, 30000])
+def test_within_radius_matches_brute_force(registry, latitude, longitude, radius_km):
+    """Every airport within the radius, nearest first."""
+    distances = _distances(registry, latitude, longitude)
+    inside = np.flatnonzero(distances <= radius_km)
+    results = registry.within_radius(latitude, longitude, radius_km)
+    # Airports at the same distance, such as both poles, may come in any order
+    assert sorted(_codes(results)) == sorted(_code(position) for position in inside)
+    assert [result['DISTANCE_KM'] for result in results] == sorted(distances[inside].tolist())
+
+
+@pytest.mark.parametrize('south, west, north, east', [
+    (-10, -10, 10, 10),
+    (30, -125, 50, -65),
+    (-90, -180, 90, 180),
+    (60, -180, 90, 180),
+    (-90, 170, -60, 180),
+    # Across the antimeridian
+    (-30, 170, 30, -170),
+    (-90, 179, 90, -179),
+    (20, 100, 60, -100),
+    (-5, 0, 5, -0.5),
+])
+def test_within_bbox_matches_brute_force(registry, south, west, north, east):
+    """Every airport inside the box, ordered by code."""
+    latitudes, longitudes = registry.latitudes, registry.longitudes
+    inside = (latitudes >= south) & (latitudes <= north)
+    if west <= east:
+        inside &= (longitudes >= west) & (longitudes <= east)
+    else:
+        inside &= (longitudes >= west) | (longitudes <= east)
+    expected = sorted(_code(position) for position in np.flatnonzero(inside))
+    assert expected
+    assert _codes(registry.within_bbox(south, west, north, east)) == expected
@@ -0,0 +1,264 @@
+"""
+Tests of the API: streamed bodies are encoded like jsonify, copied into the
+response cache while they are sent, served from it unchanged, and counted
+in the metrics of the query method behind them; and the routes answer
+invalid requests with 400.
+"""
+
+import json
+import os
+import pstats
+from datetime import date
+import pytest
+
+URL = '/delayed/airlines'
+
+
+@pytest.fixture(name='client')
+def fixture_client(api):
+    """A test client with an empty response cache."""
+    api.response_cache.clear()
+    return api.app.test_client()
+
+
+def test_streamed_body_is_compact_like_jsonify(client):
+    """Streamed JSON uses the separators and key order of jsonify."""
+    body = client.get(URL).get_data()
+    assert json.loads(body)
+    assert body == json.dumps(json.loads(body), separators=(',', ':'),
+                              sort_keys=True).encode()
+
+
+def test_warm_response_matches_cold(api, client, monkeypatch):
+    """The body copied into the cache is sent again byte for byte."""
+    cold = client.get(URL)
+    assert cold.get_data() and len(api.response_cache) == 1
+
+    def not_called(**_):
+        raise AssertionError("The cached response ran the query")
+    monkeypatch.setattr(api.data_manager, 'get_all_delayed_flights_grouped_by_airline',
+                        not_called)
+    warm = client.get(URL)
+    assert warm.get_data() == cold.get_data()
+    assert warm.headers['ETag'] == cold.headers['ETag']
+    assert warm.mimetype == cold.mimetype
+
+
+def test_large_streamed_body_is_sent_but_not_cached(api, client, monkeypatch):
+    """Bodies over CACHE_MAX_ENTRY_BYTES are streamed without being stored."""
+    monkeypatch.setattr(api, 'CACHE_MAX_ENTRY_BYTES', 100)
+    body = client.get(URL).get_data()
+    assert len(body) > 100 and json.loads(body)
+    assert len(api.response_cache) == 0
+
+
+def test_unfinished_streamed_body_is_not_cached(api, client):
+    """A response the client stops reading is not stored."""
+    response = client.get(URL, buffered=False)
+    next(response.response)
+    response.close()
+    assert len(api.response_cache) == 0
+
+
+def test_response_bytes_are_recorded_per_query_method(api, client):
+    """The bytes sent are added up under the query method behind the route."""
+    method = 'get_all_delayed_flights_grouped_by_airline'
+    before = api.metrics.METHOD_RESPONSE_BYTES.value(method)
+    body = client.get(URL).get_data()
+    assert api.metrics.METHOD_RESPONSE_BYTES.value(method) - before == len(body)
+    # Served from the response cache, without calling the method
+    client.get(URL).get_data()
+    assert api.metrics.METHOD_RESPONSE_BYTES.value(method) - before == len(body)
+
+
+def test_batch_returns_flights_and_missing_ids(api, client):
+    """Found flights are keyed by ID, unknown IDs are listed once each."""
+    flight_id = api.data_manager._execute_query(  # pylint: disable=protected-access
+        "SELECT MIN(ID) AS id FROM flights")[0]['id']
+    response = client.post('/flights/batch', json={'ids': [flight_id, -1, flight_id, -1]})
+    assert response.status_code == 200
+    body = response.get_json()
+    assert list(body['results']) == [str(flight_id)]
+    assert body['results'][str(flight_id)]['FLIGHT_ID'] == flight_id
+    assert body['missing'] == [-1]
+
+
+@pytest.mark.parametrize('body', [
+    None, [1, 2], {'id': [1]}, {'ids': 1}, {'ids': ['1']}, {'ids': [1.5]}, {'ids': [True]},
+])
+def test_batch_rejects_invalid_bodies(client, body):
+    """Bodies that are not a list of integer IDs get 400."""
+    if body is None:
+        response = client.post('/flights/batch', data='not json',
+                               content_type='application/json')
+    else:
+        response = client.post('/flights/batch', json=body)
+    assert response.status_code == 400
+    assert 'error' in response.get_json()
+
+
+def test_batch_rejects_too_many_ids(api, client, monkeypatch):
+    """More than MAX_BATCH_IDS IDs get 400."""
+    monkeypatch.setattr(api, 'MAX_BATCH_IDS', 2)
+    assert client.post('/flights/batch', json={'ids': [1, 2]}).status_code == 200
+    response = client.post('/flights/batch', json={'ids': [1, 2, 3]})
+    assert response.status_code == 400
+    assert '2' in response.get_json()['error']
+
+
+@pytest.mark.parametrize('kind', ['routes', 'airports', 'airlines'])
+def test_top_returns_the_worst_keys_with_enough_flights(api, client, kind):
+    """At most k rows of at least min_flights flights, worst first."""
+    rows = client.get(f'/top/{kind}?k=3&min_flights=5').get_json()
+    assert 0 < len(rows) <= 3
+    assert all(row['flights'] >= 5 for row in rows)
+    assert [row['percentage'] for row in rows] == sorted(
+        (row['percentage'] for row in rows), reverse=True)
+    assert rows == api.data_manager.get_top_delayed(api.TOP_ENDPOINTS[kind], 3, 5)
+    assert len(client.get(f'/top/{kind}').get_json()) <= api.TOP_K
+
+
+@pytest.mark.parametrize('query', [
+    'k=0', 'k=-1', 'k=ten', 'k=1.5', 'min_flights=0', 'min_flights=x', 'from=2015-13-01',
+    'from=2015-02-01&to=2015-01-01',
+])
+def test_top_rejects_invalid_parameters(client, query):
+    """k outside 1..MAX_TOP_K, min_flights below 1 and bad dates get 400."""
+    response = client.get(f'/top/routes?{query}')
+    assert response.status_code == 400
+    assert 'error' in response.get_json()
+
+
+def test_top_caps_k_at_max_top_k(api, client):
+    """k may be MAX_TOP_K but not more."""
+    assert client.get(f'/top/airports?k={api.MAX_TOP_K}').status_code == 200
+    assert client.get(f'/top/airports?k={api.MAX_TOP_K + 1}').status_code == 400
+    assert client.get('/top/aircraft').status_code == 404
+
+
+def test_delayed_hour_adds_up_a_range_of_dates(api, client):
+    """from/to return the hourly delays of the range, and from alone one day."""
+    hours = client.get('/delayed/hour?from=2015-03-30&to=2015-04-12').get_json()
+    assert hours == api.data_manager.get_hourly_delays(date(2015, 3, 30), date(2015, 4, 12))
+    assert len(hours) == 24
+    day = client.get('/delayed/hour?from=2015-03-30').get_json()
+    assert day == client.get('/delayed/hour?from=2015-03-30&to=2015-03-30').get_json()
+
+
+@pytest.mark.parametrize('query', [
+    'from=2015-3-30', 'from=30/03/2015', 'from=2015-02-30', 'from=', 'from=2015-03-30&to=x',
+    'from=2015-04-12&to=2015-03-30', 'day=1&month=1',
+])
+def test_delayed_hour_rejects_malformed_or_reversed_ranges(client, query):
+    """Dates that are not YYYY-MM-DD, to before from and missing dates get 400."""
+    response = client.get(f'/delayed/hour?{query}')
+    assert response.status_code == 400
+    assert 'error' in response.get_json()
+
+
+@pytest.mark.parametrize('path', [
+    '/airports/nearest', '/airports/nearest?lat=40', '/airports/nearest?lat=x&lon=-73',
+    '/airports/nearest?lat=nan&lon=-73', '/airports/nearest?lat=40&lon=inf',
+    '/airports/nearest?lat=40&lon=-73&count=0', '/airports/nearest?lat=40&lon=-73&count=two',
+    '/airports/radius?lat=40&lon=-73', '/airports/radius?lat=40&lon=-73&radius_km=-1',
+    '/airports/radius?lat=40&lon=-73&radius_km=far',
+    '/airports/bbox?south=30&west=-120&north=50', '/airports/bbox?south=30&west=-120'
+    '&north=50&east=nan',
+])
+def test_airport_routes_reject_invalid_parameters(client, path):
+    """Missing, non-numeric and non-finite coordinates and bad counts get 400."""
+    response = client.get(path)
+    assert response.status_code == 400
+    assert 'error' in response.get_json()
+
+
+def test_airport_routes_answer_like_the_registry(api, client):
+    """Valid requests return the registry results, count capped at MAX_NEAREST_AIRPORTS."""
+    registry = api.data_manager.get_airport_registry()
+    assert client.get('/airports/nearest?lat=40&lon=-73&count=3').get_json() == \
+        registry.nearest(40, -73, 3)
+    count = api.MAX_NEAREST_AIRPORTS
+    assert client.get(f'/airports/nearest?lat=0&lon=0&count={count}').status_code == 200
+    assert client.get(f'/airports/nearest?lat=0&lon=0&count={count + 1}').status_code == 400
+    assert client.get('/airports/bbox?south=-90&west=170&north=90&east=-170').get_json() == \
+        registry.within_bbox(-90, 170, 90, -170)
+
+
+def _routes(records):
+    """Percentages of heatmap records by route, rounded like format=matrix."""
+    return {(row['origin_airport'], row['destination_airport']): round(row['percentage'], 4)
+            for row in records}
+
+
+@pytest.mark.parametrize('query', ['', 'top_n=10', 'min_flights=5', 'top_n=5&min_flights=3'])
+def test_heatmap_formats_hold_the_same_routes(client, query):
+    """format=matrix and format=columnar decode to the routes of format=records."""
+    records = client.get(f'/heatmap?{query}').get_json()
+    assert records
+    matrix = client.get(f'/heatmap?format=matrix&{query}').get_json()
+    assert _routes({'origin_airport': matrix['rows'][row],
+                    'destination_airport': matrix['columns'][column],
+                    'percentage': percentage}
+                   for row, column, percentage in matrix['values']) == _routes(records)
+    columnar = client.get(f'/heatmap?format=columnar&{query}').get_json()
+    assert [dict(zip(columnar['columns'], row)) for row in columnar['rows']] == records
+
+
+@pytest.mark.parametrize('query', ['format=dense', 'top_n=0', 'top_n=x', 'min_flights=x'])
+def test_heatmap_rejects_invalid_parameters(client, query):
+    """Unknown formats and non-numeric or non-positive top_n get 400."""
+    assert client.get(f'/heatmap?{query}').status_code == 400
+
+
+def _profile_files(directory):
+    """Names of the files in the profile directory."""
+    return sorted(path.name for path in directory.iterdir()) if directory.exists() else []
+
+
+def test_profiling_is_off_by_default(api, client, tmp_path, monkeypatch):
+    """Without FLIGHT_DATA_PROFILING=1, X-Profile is ignored."""
+    assert not api.PROFILING_ENABLED
+    monkeypatch.setattr(api, 'PROFILE_DIR', str(tmp_path / 'profiles'))
+    response = client.get(URL, headers={'X-Profile': 'stats'})
+    assert response.status_code == 200 and isinstance(response.get_json(), list)
+    assert 'X-Profile-File' not in response.headers
+    assert not _profile_files(tmp_path / 'profiles')
+
+
+@pytest.mark.parametrize('headers', [
+    {'X-Profile': 'save'}, {'X-Profile': 'save', 'X-Profile-Token': 'wrong'},
+    {'X-Profile': 'other', 'X-Profile-Token': 'secret'},
+])
+def test_profiling_requires_the_token(api, client, tmp_path, monkeypatch, headers):
+    """With a token configured, requests without it are not profiled."""
+    monkeypatch.setattr(api, 'PROFILING_ENABLED', True)
+    monkeypatch.setattr(api, 'PROFILING_TOKEN', 'secret')
+    monkeypatch.setattr(api, 'PROFILE_DIR', str(tmp_path))
+    response = client.get(URL, headers=headers)
+    assert response.status_code == 200
+    assert 'X-Profile-File' not in response.headers
+    assert not _profile_files(tmp_path)
+
+
+@pytest.mark.parametrize('mode', ['save', 'stats'])
+def test_profiled_request_saves_a_profile(api, client, tmp_path, monkeypatch, mode):
+    """The profile is written and its phase timings are sent with the response."""
+    monkeypatch.setattr(api, 'PROFILING_ENABLED', True)
+    monkeypatch.setattr(api, 'PROFILING_TOKEN', 'secret')
+    monkeypatch.setattr(api, 'PROFILE_DIR', str(tmp_path))
+    expected = client.get(URL).get_json()
+    response = client.get(f'{URL}?profile={mode}&profile_token=secret')
+    assert response.status_code == 200
+    path = response.headers['X-Profile-File']
+    assert _profile_files(tmp_path) == sorted([os.path.basename(path),
+                                               os.path.basename(path)[:-5] + '.json'])
+    assert pstats.Stats(path).total_calls > 0
+    timings = dict(item.split(';dur=') for item in response.headers['Server-Timing'].split(', '))
+    assert set(timings) == {'query', 'materialization', 'serialization', 'other', 'total'}
+    assert float(timings['query']) > 0
+    if mode == 'stats':
+        summary = response.get_json()
+        assert summary['profile_file'] == path and summary['top_functions']
+        assert summary['phases_ms']['total'] == float(timings['total'])
+    else:
+        assert response.get_json() == expected
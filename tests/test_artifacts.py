@@ -0,0 +1,30 @@
+"""
+Tests that the files built from a database stay valid in later processes.
+"""
+
+import subprocess
+import sys
+from conftest import REPO_DIR
+
+
+def _run(code):
+    """Run Python code in a new interpreter from the repository directory."""
+    return subprocess.run([sys.executable, '-c', code], cwd=REPO_DIR, check=True,
+                          capture_output=True, text=True).stdout.strip()
+
+
+def test_cube_loads_in_a_new_process(synthetic_db):
+    """The cube records the version the database keeps once the log is checkpointed."""
+    code = ("from data import FlightData\n"
+            f"print(FlightData({synthetic_db!r}).get_delay_cube() is not None)")
+    assert _run(code) == 'True'
+    # Closing the first process' connections must not change the version either
+    assert _run(code) == 'True'
+
+
+def test_sketches_load_in_a_new_process(synthetic_db):
+    """The sketches record the version the database keeps once the log is checkpointed."""
+    code = ("from data import FlightData\n"
+            f"print(FlightData({synthetic_db!r}).get_quantile_sketches() is not None)")
+    assert _run(code) == 'True'
+    assert _run(code) == 'True'
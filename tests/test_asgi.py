@@ -0,0 +1,83 @@
+"""
+Tests that the ASGI server runs every request on the thread pool of its cost
+and refuses request bodies above its limit.
+"""
+
+import asyncio
+import importlib
+import json
+import pytest
+
+NDJSON = [(b'accept', b'application/x-ndjson')]
+
+
+@pytest.fixture(scope='module', name='asgi_app')
+def fixture_asgi_app(api):  # pylint: disable=unused-argument
+    """The PooledWsgiApp of asgi_api, serving the synthetic database."""
+    return importlib.import_module('asgi_api').app
+
+
+@pytest.mark.parametrize('method, path, query, headers, pool', [
+    ('GET', '/flight/1', b'', [], 'light'),
+    ('GET', '/airports/nearest', b'lat=40&lon=-73', [], 'light'),
+    ('GET', '/flights/date', b'day=1&month=1&year=2015', [], 'light'),
+    ('GET', '/flights/date', b'day=1&month=1&year=2015&limit=100', NDJSON, 'light'),
+    ('GET', '/flights/date', b'day=1&month=1&year=2015', NDJSON, 'heavy'),
+    ('GET', '/flights/date', b'from=2015-01-01&to=2015-12-31', [], 'heavy'),
+    ('GET', '/delayed/airline/Delta%20Air%20Lines%20Inc.', b'limit=500', [], 'light'),
+    ('GET', '/delayed/airport/LAX', b'limit=100000', NDJSON, 'heavy'),
+    ('GET', '/delayed/hour', b'day=1&month=1&year=2015', [], 'light'),
+    ('GET', '/delayed/hour', b'from=2015-01-01&to=2015-02-28', [], 'heavy'),
+    ('GET', '/route-map', b'day=1&month=1&year=2015', [], 'light'),
+    ('GET', '/route-map', b'from=2015-01-01&to=2015-06-30', [], 'heavy'),
+    ('POST', '/flights/batch', b'', [], 'heavy'),
+    ('GET', '/delayed/airlines', b'', [], 'heavy'),
+    ('GET', '/delayed/hourly', b'from=2015-01-01', [], 'heavy'),
+    ('GET', '/stats/delay-quantiles', b'', [], 'heavy'),
+    ('GET', '/top/routes', b'', [], 'heavy'),
+    ('GET', '/heatmap', b'', [], 'heavy'),
+    ('GET', '/average/routes', b'', [], 'heavy'),
+    ('GET', '/no-such-route', b'', [], 'light'),
+])
+def test_requests_run_on_the_pool_of_their_cost(asgi_app, method, path, query, headers,
+                                                 pool):
+    """Aggregates, batches, ranges and unlimited streams get the heavy pool."""
+    scope = {'type': 'http', 'method': method, 'path': path, 'query_string': query,
+             'headers': headers}
+    # pylint: disable=protected-access
+    assert asgi_app._pool_for(scope) is getattr(asgi_app, f'_{pool}_pool')
+
+
+def _post(asgi_app, path, chunks, headers=()):
+    """
+    Send a POST request with a body in chunks to the ASGI application.
+    :return: (status, body) of the response.
+    """
+    scope = {'type': 'http', 'method': 'POST', 'path': path, 'query_string': b'',
+             'headers': [(b'content-type', b'application/json'), *headers]}
+    messages = [{'type': 'http.request', 'body': chunk, 'more_body': index < len(chunks) - 1}
+                for index, chunk in enumerate(chunks)]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(asgi_app(scope, receive, send))
+    return sent[0]['status'], b''.join(message.get('body', b'') for message in sent[1:])
+
+
+def test_small_body_is_handled(asgi_app):
+    """A batch request within the limit reaches the route."""
+    status, body = _post(asgi_app, '/flights/batch', [b'{"ids": [', b'-1]}'])
+    assert status == 200
+    assert json.loads(body)['missing'] == [-1]
+
+
+def test_large_body_is_refused(asgi_app, monkeypatch):
+    """Bodies above max_body_bytes get 413, whether announced or streamed."""
+    monkeypatch.setattr(asgi_app, '_max_body_bytes', 10)
+    assert _post(asgi_app, '/flights/batch', [b'{"ids": [', b'1, 2, 3]}'])[0] == 413
+    assert _post(asgi_app, '/flights/batch', [b'{}'], [(b'content-length', b'11')])[0] == 413
@@ -0,0 +1,250 @@
+"""
+Tests that the SQL, columnar and partitioned backends answer every query
+method like plain SQL on the flights table, including the order of the rows
+and queries without results.
+"""
+# pylint: disable=protected-access
+
+import sqlite3
+from datetime import date
+import pytest
+from columnar import ColumnarFlightData
+from conftest import comparable, copy_database
+from data import QUERY_METHODS, SCHEMA_INDEXES, SCHEMA_TRIGGERS, FlightData
+from partitions import PartitionedFlightData, build_partitions
+
+BACKENDS = ('sql', 'columnar', 'partitioned')
+START, END = date(2015, 3, 30), date(2015, 4, 12)  # Spans two partitions
+NO_FLIGHTS = (date(1900, 1, 1), date(1900, 1, 31))
+# Methods that list every hour, with zero counts when there are no flights
+HOURLY_METHODS = ('get_delayed_flights_per_hour', 'get_hourly_delays')
+
+
+@pytest.fixture(scope='module', name='sample')
+def fixture_sample(synthetic_db):
+    """Values of the first flight of START to build the query arguments from."""
+    (row,) = FlightData(synthetic_db)._execute_query(
+        """
+        SELECT flights.ID, flights.DAY, flights.MONTH, flights.YEAR,
+               flights.ORIGIN_AIRPORT, airlines.AIRLINE, airports.LATITUDE,
+               airports.LONGITUDE
+        FROM flights
+        JOIN airlines ON flights.AIRLINE = airlines.ID
+        JOIN airports ON flights.ORIGIN_AIRPORT = airports.IATA_CODE
+        WHERE flights.YEAR = :year AND flights.MONTH = :month AND flights.DAY = :day
+        ORDER BY flights.ID LIMIT 1
+        """, {'year': START.year, 'month': START.month, 'day': START.day})
+    return row
+
+
+@pytest.fixture(scope='module', name='reference')
+def fixture_reference(synthetic_db):
+    """Plain SQL on the flights table, without rollup tables or delay cube."""
+    data_manager = FlightData(synthetic_db, query_cache_size=0)
+    data_manager._has_rollups = False
+    data_manager.get_delay_cube = lambda: None
+    return data_manager
+
+
+@pytest.fixture(scope='module', name='backends')
+def fixture_backends(synthetic_db):
+    """One instance of every backend."""
+    build_partitions(synthetic_db, workers=2)
+    backends = {'sql': FlightData(synthetic_db),
+                'columnar': ColumnarFlightData(synthetic_db),
+                'partitioned': PartitionedFlightData(synthetic_db, workers=2)}
+    yield backends
+    if backends['partitioned']._pool is not None:
+        backends['partitioned']._pool.shutdown()
+
+
+@pytest.fixture(scope='module', name='pruned')
+def fixture_pruned(synthetic_db, tmp_path_factory):
+    """
+    Partitioned backend of a copy of the database whose flights and rollups
+    were deleted after partitioning, without delay cube or sketches.
+    """
+    path = copy_database(synthetic_db, tmp_path_factory, 'pruned')
+    build_partitions(f'sqlite:///{path}', workers=2)
+    with sqlite3.connect(path) as connection:
+        connection.execute("DELETE FROM flights")
+        for table in ('route_rollup', 'route_day_rollup', 'rollup_days'):
+            connection.execute(f"DROP TABLE {table}")
+    data_manager = PartitionedFlightData(f'sqlite:///{path}', workers=2)
+    yield data_manager
+    if data_manager._pool is not None:
+        data_manager._pool.shutdown()
+
+
+def _cases(sample):
+    """
+    Return the calls to compare: (method name, arguments, keyword arguments,
+    whether the result is empty).
+    """
+    day = (sample['DAY'], sample['MONTH'], sample['YEAR'])
+    airline, airport = sample['AIRLINE'], sample['ORIGIN_AIRPORT']
+    latitude, longitude = sample['LATITUDE'], sample['LONGITUDE']
+    return [
+        ('get_flight_by_id', (sample['ID'],), {}, False),
+        ('get_flight_by_id', (-1,), {}, True),
+        ('get_flights_by_ids', ([sample['ID'], sample['ID'] + 7, -1],), {}, False),
+        ('get_flights_by_ids', ([],), {}, True),
+        ('get_flights_by_date', day, {}, False),
+        ('get_flights_by_date', day, {'limit': 5, 'after': sample['ID']}, False),
+        ('get_flights_by_date', (1, 1, 1900), {}, True),
+        ('get_flights_by_date_range', (START, END), {}, False),
+        ('get_flights_by_date_range', (START, END), {'limit': 5, 'after': sample['ID']},
+         False),
+        ('get_flights_by_date_range', NO_FLIGHTS, {}, True),
+        ('get_delayed_flights_by_airline', (airline,), {}, False),
+        ('get_delayed_flights_by_airline', (airline,), {'limit': 10, 'after': sample['ID']},
+         False),
+        ('get_delayed_flights_by_airline', ('No Such Airline',), {}, True),
+        ('get_all_delayed_flights_grouped_by_airline', (), {}, False),
+        ('get_delayed_flights_by_airport', (airport,), {}, False),
+        ('get_delayed_flights_by_airport', ('ZZZ',), {}, True),
+        ('get_delayed_flights_per_hour', day, {}, False),
+        ('get_delayed_flights_per_hour', (1, 1, 1900), {}, True),
+        ('get_hourly_delays', (START, END), {}, False),
+        ('get_hourly_delays', (START, END, airline, airport), {}, False),
+        ('get_hourly_delays', NO_FLIGHTS, {}, True),
+        ('get_delay_quantiles', (), {}, False),
+        ('get_delay_quantiles', ('airline',), {}, False),
+        ('get_delay_quantiles', ('route', f'{airport}-ZZZ'), {}, True),
+        ('get_flight_delays_heatmap', (), {}, False),
+        ('get_flight_delays_heatmap_matrix', (), {}, False),
+        ('get_flight_delays_heatmap_matrix', (), {'top_n': 5, 'min_flights': 2}, False),
+        ('get_delayed_flights_average_per_route', (), {}, False),
+        ('get_delayed_flights_per_route_map', day, {}, False),
+        ('get_delayed_flights_per_route_map', (1, 1, 1900), {}, True),
+        ('get_delayed_flights_per_route_map_range', (START, END), {}, False),
+        ('get_delayed_flights_per_route_map_range', NO_FLIGHTS, {}, True),
+        ('get_top_delayed', ('route',), {}, False),
+        ('get_top_delayed', ('airport', 5, 10, START, END), {}, False),
+        ('get_top_delayed', ('airline', 3), {}, False),
+        ('get_top_delayed', ('route', 20, 10**9), {}, True),
+        ('get_airport_coordinates', (), {}, False),
+        ('get_nearest_airports', (latitude, longitude, 5), {}, False),
+        ('get_airports_within_radius', (latitude, longitude, 500), {}, False),
+        ('get_airports_within_radius', (0, 0, 1), {}, True),
+        ('get_airports_in_bbox', (latitude - 5, longitude - 5, latitude + 5, longitude + 5),
+         {}, False),
+        ('get_airports_in_bbox', (-1, -1, 1, 1), {}, True),
+    ]
+
+
+def test_every_query_method_has_cases(sample):
+    """The cases cover every public query method."""
+    assert {case[0] for case in _cases(sample)} == set(QUERY_METHODS)
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_backend_matches_sql(backends, reference, sample, backend):
+    """Every call returns what plain SQL returns, in the same order."""
+    for name, args, kwargs, empty in _cases(sample):
+        expected = comparable(getattr(reference, name)(*args, **kwargs))
+        actual = comparable(getattr(backends[backend], name)(*args, **kwargs))
+        assert actual == expected, (name, args, kwargs)
+        if name in HOURLY_METHODS:
+            assert (not any(row['total_count'] for row in expected)) == empty, name
+        else:
+            assert (not expected) == empty, (name, args, kwargs)
+
+
+def test_partitions_do_not_read_the_pruned_database(pruned, reference, sample, monkeypatch):
+    """Every query method of the partitioned backend reads the partitions only."""
+    # The copy has no sketches, so its quantiles are exact
+    monkeypatch.setattr(reference, 'get_quantile_sketches', lambda: None)
+    assert not pruned._execute_query("SELECT ID FROM flights LIMIT 1")
+    for name, args, kwargs, _ in _cases(sample):
+        expected = comparable(getattr(reference, name)(*args, **kwargs))
+        assert comparable(getattr(pruned, name)(*args, **kwargs)) == expected, name
+
+
+def test_partitions_are_reloaded_when_rebuilt(synthetic_db, tmp_path_factory):
+    """A rebuilt manifest changes data_version() and replaces the partitions read."""
+    path = copy_database(synthetic_db, tmp_path_factory, 'rebuilt')
+    build_partitions(f'sqlite:///{path}', workers=2)
+    data_manager = PartitionedFlightData(f'sqlite:///{path}', workers=2)
+    version = data_manager.data_version()
+    assert data_manager.data_version() == version
+    assert data_manager.get_flights_by_date_range(START, END)
+    with sqlite3.connect(path) as connection:
+        connection.execute("DELETE FROM flights WHERE YEAR = ? AND MONTH = ?",
+                           (END.year, END.month))
+    build_partitions(f'sqlite:///{path}', workers=2)
+    assert data_manager.data_version() != version
+    assert (END.year, END.month) not in data_manager._partitions
+    expected = FlightData(f'sqlite:///{path}').get_flights_by_date_range(START, END)
+    assert data_manager.get_flights_by_date_range(START, END) == expected
+
+
+@pytest.mark.parametrize('optimized', [False, True])
+def test_columnar_counts_text_delays_like_sql(synthetic_db, tmp_path_factory, sample,
+                                              optimized):
+    """
+    Delays that are not numbers, such as 'n/a' in a loaded CSV, count as
+    delayed in both backends, with and without optimize_schema().
+    """
+    path = copy_database(synthetic_db, tmp_path_factory, 'text_delays')
+    with sqlite3.connect(path) as connection:
+        for table in ('route_rollup', 'route_day_rollup', 'rollup_days'):
+            connection.execute(f"DROP TABLE {table}")
+        for index in SCHEMA_INDEXES:
+            connection.execute(f"DROP INDEX {index}")
+        for trigger in SCHEMA_TRIGGERS:
+            connection.execute(f"DROP TRIGGER {trigger}")
+        connection.execute("ALTER TABLE flights DROP COLUMN IS_DELAYED")
+        connection.execute("ALTER TABLE flights DROP COLUMN DELAY_MINUTES")
+        connection.execute("UPDATE flights SET DEPARTURE_DELAY = 'n/a' "
+                           "WHERE ID % 50 = 0 OR ID = ?", (sample['ID'],))
+    sql = FlightData(f'sqlite:///{path}')
+    if optimized:
+        sql.optimize_schema()
+    columnar = ColumnarFlightData(f'sqlite:///{path}')
+    assert sample['ID'] in {row['FLIGHT_ID'] for row in sql.get_delayed_flights_by_airport(
+        sample['ORIGIN_AIRPORT'])}
+    for name, args, kwargs, _ in _cases(sample):
+        expected = comparable(getattr(sql, name)(*args, **kwargs))
+        assert comparable(getattr(columnar, name)(*args, **kwargs)) == expected, name
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+@pytest.mark.parametrize('method, args', [
+    ('get_delayed_flights_by_airline', ('Delta Air Lines Inc.',)),
+    ('get_flights_by_date_range', (START, END)),
+])
+def test_pages_add_up_to_the_full_result(backends, backend, method, args):
+    """Paging with the cursor of each page returns every row once, in order."""
+    query = getattr(backends[backend], method)
+    full = query(*args)
+    pages, after = [], None
+    while page := query(*args, limit=37, after=after):
+        pages += page
+        after = page[-1]['FLIGHT_ID']
+    assert pages == full
+    if method == 'get_flights_by_date_range':
+        keys = [(row['YEAR'], row['MONTH'], row['DAY'], row['FLIGHT_ID']) for row in full]
+    else:
+        keys = [row['FLIGHT_ID'] for row in full]
+    assert keys == sorted(keys) and len(set(keys)) == len(keys)
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_tuples_match_dictionaries(backends, backend):
+    """Rows returned as tuples hold the values of the dictionaries."""
+    data_manager = backends[backend]
+    records = data_manager.get_flights_by_date_range(START, END, limit=50)
+    rows = data_manager.get_flights_by_date_range(START, END, limit=50, as_tuples=True)
+    assert list(rows.records()) == records
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_streamed_results_match_lists(backends, sample, backend):
+    """stream=True yields the rows of the list result."""
+    data_manager = backends[backend]
+    airport = sample['ORIGIN_AIRPORT']
+    assert list(data_manager.get_delayed_flights_by_airport(airport, stream=True)) == \
+        data_manager.get_delayed_flights_by_airport(airport)
+    assert list(data_manager.get_top_delayed('route', 5, stream=True)) == \
+        data_manager.get_top_delayed('route', 5)
@@ -0,0 +1,52 @@
+"""
+Tests of RouteMatrix.from_counts(): the routes it keeps with top_n and
+min_flights, and their percentages, against a plain Python filter.
+"""
+
+import itertools
+import numpy as np
+import pytest
+from heatmap import RouteMatrix
+
+AIRPORTS = ('ATL', 'BOS', 'DEN', 'JFK', 'LAX', 'ORD', 'SEA', 'SFO')
+
+
+@pytest.fixture(scope='module', name='routes')
+def fixture_routes():
+    """Flight and delayed flight counts of random routes between AIRPORTS."""
+    rng = np.random.default_rng(3)
+    pairs = [pair for pair in itertools.permutations(AIRPORTS, 2) if rng.random() < 0.6]
+    totals = rng.integers(1, 50, len(pairs))
+    delayed = rng.binomial(totals, 0.3)
+    return [(origin, destination, int(total), int(count))
+            for (origin, destination), total, count in zip(pairs, totals, delayed)]
+
+
+def _expected(routes, top_n, min_flights):
+    """Routes kept by from_counts, as (origin, destination, percentage), row-major."""
+    traffic = dict.fromkeys(sorted({airport for route in routes for airport in route[:2]}), 0)
+    for origin, destination, total, _ in routes:
+        traffic[origin] += total
+        traffic[destination] += total
+    # Ties go to the airport that sorts first, as from_counts sorts stably by code
+    busiest = set(sorted(traffic, key=lambda airport: -traffic[airport])[:top_n]) \
+        if top_n is not None else set(traffic)
+    return sorted((origin, destination, delayed / total * 100)
+                  for origin, destination, total, delayed in routes
+                  if total >= min_flights and origin in busiest and destination in busiest)
+
+
+@pytest.mark.parametrize('top_n, min_flights', [
+    (None, 1), (None, 25), (3, 1), (5, 10), (1, 1), (len(AIRPORTS), 1), (4, 10**6),
+])
+def test_from_counts_keeps_the_busiest_routes(routes, top_n, min_flights):
+    """Only routes between the top_n airports with at least min_flights flights are kept."""
+    matrix = RouteMatrix.from_counts(*zip(*routes), top_n=top_n, min_flights=min_flights)
+    expected = _expected(routes, top_n, min_flights)
+    assert [(row['origin_airport'], row['destination_airport'], row['percentage'])
+            for row in matrix.to_records()] == expected
+    assert len(matrix) == len(expected)
+    assert matrix.rows.tolist() == sorted({origin for origin, _, _ in expected})
+    assert matrix.columns.tolist() == sorted({destination for _, destination, _ in expected})
+    dense = matrix.to_dense()
+    assert np.count_nonzero(~np.isnan(dense)) == len(expected)
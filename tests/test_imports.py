@@ -0,0 +1,31 @@
+"""
+Tests that starting the API or the CLI does not load the plotting and
+dataframe libraries, which are imported by the views that need them.
+"""
+
+import subprocess
+import sys
+import pytest
+from conftest import REPO_DIR
+
+HEAVY_PACKAGES = {'pandas', 'matplotlib', 'seaborn', 'folium'}
+
+
+def _imported_packages(module):
+    """
+    Import a module in a new interpreter and return the top-level packages
+    listed by -X importtime.
+    """
+    completed = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                               cwd=REPO_DIR, capture_output=True, text=True, check=True)
+    # Lines look like "import time:   self [us] | cumulative | <indent>name"
+    return {line.rsplit('|', 1)[-1].strip().split('.')[0]
+            for line in completed.stderr.splitlines() if line.startswith('import time:')}
+
+
+@pytest.mark.parametrize('module', ['api', 'main'])
+def test_startup_does_not_import_heavy_packages(module):
+    """pandas, matplotlib, seaborn and folium are not loaded on import."""
+    packages = _imported_packages(module)
+    assert module in packages
+    assert not packages & HEAVY_PACKAGES
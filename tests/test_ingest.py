@@ -0,0 +1,78 @@
+"""
+Tests of loading and extending the database from CSV files.
+"""
+
+import csv
+from data import FlightData
+from ingest import FLIGHT_CSV_COLUMNS, ingest
+
+AIRLINES = [{'IATA_CODE': 'AA', 'AIRLINE': 'American Airlines Inc.'},
+            {'IATA_CODE': 'DL', 'AIRLINE': 'Delta Air Lines Inc.'}]
+AIRPORTS = [{'IATA_CODE': code, 'AIRPORT': code, 'CITY': code, 'STATE': 'CA',
+             'COUNTRY': 'USA', 'LATITUDE': 30 + index, 'LONGITUDE': -100 - index}
+            for index, code in enumerate(('LAX', 'SFO', 'JFK'))]
+
+
+def _write_csv(path, rows, columns):
+    """Write dictionaries to a CSV file."""
+    with open(path, 'w', newline='', encoding='utf-8') as file:
+        writer = csv.DictWriter(file, columns)
+        writer.writeheader()
+        writer.writerows(rows)
+    return str(path)
+
+
+def _flight(day, origin, destination, delay, airline='AA'):
+    """Return a CSV row of a flight on a day of January 2015."""
+    row = dict.fromkeys(FLIGHT_CSV_COLUMNS, '')
+    row.update({'YEAR': 2015, 'MONTH': 1, 'DAY': day, 'DAY_OF_WEEK': 4,
+                'AIRLINE': airline, 'FLIGHT_NUMBER': 1, 'ORIGIN_AIRPORT': origin,
+                'DESTINATION_AIRPORT': destination, 'SCHEDULED_DEPARTURE': 800,
+                'DEPARTURE_TIME': 805, 'DEPARTURE_DELAY': delay, 'DIVERTED': 0,
+                'CANCELLED': 0})
+    return row
+
+
+def _ingest(tmp_path, name, flights):
+    """Load flights into the test database."""
+    db_uri = f"sqlite:///{tmp_path / 'flights.sqlite3'}"
+    ingest(db_uri, _write_csv(tmp_path / f'{name}.csv', flights, FLIGHT_CSV_COLUMNS),
+           _write_csv(tmp_path / 'airlines.csv', AIRLINES, ['IATA_CODE', 'AIRLINE']),
+           _write_csv(tmp_path / 'airports.csv', AIRPORTS, list(AIRPORTS[0])),
+           workers=1)
+    return db_uri
+
+
+def _route_counts(data_manager, rollups):
+    """Count the flights per route from the rollup tables or the flights."""
+    data_manager._has_rollups = rollups  # pylint: disable=protected-access
+    return data_manager.get_top_delayed('route', 100)
+
+
+def test_appending_to_rolled_up_days_updates_the_rollups(tmp_path):
+    """Flights added to days that are already rolled up are counted."""
+    _ingest(tmp_path, 'first', [_flight(1, 'LAX', 'SFO', 30), _flight(2, 'SFO', 'JFK', 0)])
+    db_uri = _ingest(tmp_path, 'second', [_flight(1, 'LAX', 'SFO', 0),
+                                          _flight(2, 'SFO', 'JFK', 45, 'DL'),
+                                          _flight(3, 'JFK', 'LAX', 25)])
+    data_manager = FlightData(db_uri, query_cache_size=0)
+    from_rollups = _route_counts(data_manager, True)
+    assert from_rollups == _route_counts(data_manager, False)
+    assert {(row['origin_airport'], row['flights'], row['delayed_flights'])
+            for row in from_rollups} == {('LAX', 2, 1), ('SFO', 2, 1), ('JFK', 1, 1)}
+
+
+def test_non_numeric_delays_are_normalized_like_optimize_schema(tmp_path):
+    """A delay that is not a number does not abort the load."""
+    db_uri = _ingest(tmp_path, 'flights', [_flight(1, 'LAX', 'SFO', 'n/a'),
+                                           _flight(1, 'LAX', 'SFO', '')])
+    data_manager = FlightData(db_uri, query_cache_size=0)
+    loaded = data_manager._execute_query(  # pylint: disable=protected-access
+        "SELECT DELAY_MINUTES, IS_DELAYED FROM flights ORDER BY ID")
+    with data_manager._engine.begin() as connection:  # pylint: disable=protected-access
+        connection.exec_driver_sql("UPDATE flights SET DELAY_MINUTES = NULL")
+    data_manager.optimize_schema()
+    assert loaded == data_manager._execute_query(  # pylint: disable=protected-access
+        "SELECT DELAY_MINUTES, IS_DELAYED FROM flights ORDER BY ID")
+    assert loaded == [{'DELAY_MINUTES': 'n/a', 'IS_DELAYED': 1},
+                      {'DELAY_MINUTES': 0, 'IS_DELAYED': 0}]
@@ -0,0 +1,42 @@
+"""
+Tests that prerender.py reports only the charts it saved, and renders the
+heatmap of the busiest airports.
+"""
+# pylint: disable=protected-access
+
+import pytest
+import prerender
+
+
+@pytest.fixture(scope='module', name='worker')
+def fixture_worker(synthetic_db):
+    """The state of a pool process, set up in the test process."""
+    prerender._init_worker(synthetic_db)
+    yield prerender._worker_state
+    prerender._worker_state.clear()
+
+
+def test_day_without_flights_is_not_reported_as_written(worker, tmp_path):
+    """A file left by an earlier run does not count as rendered."""
+    assert worker
+    path = tmp_path / prerender.DATE_CHARTS['delayed_per_hour']
+    path.write_bytes(b'stale')
+    assert prerender._render('delayed_per_hour', '1900-01-01', str(path)) is False
+    assert path.read_bytes() == b'stale'
+    assert prerender._render('delayed_per_hour', '2015-03-30', str(path)) is True
+    assert path.read_bytes() != b'stale'
+
+
+def test_heatmap_keeps_the_busiest_airports(worker, tmp_path, monkeypatch):
+    """The heatmap is rendered with HEATMAP_TOP_N."""
+    data_manager = worker['data_manager']
+    calls = []
+    matrix = data_manager.get_flight_delays_heatmap_matrix
+
+    def recorded(top_n=None, min_flights=1):
+        calls.append(top_n)
+        return matrix(top_n, min_flights)
+    monkeypatch.setattr(data_manager, 'get_flight_delays_heatmap_matrix', recorded)
+    path = tmp_path / prerender.GLOBAL_CHARTS['heatmap']
+    assert prerender._render('heatmap', None, str(path)) is True
+    assert calls == [prerender.HEATMAP_TOP_N] and path.stat().st_size
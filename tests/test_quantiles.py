@@ -0,0 +1,144 @@
+"""
+Tests of the delay quantiles: exact ones computed in SQL when the sketches
+are not available, and ones read from the KLL sketches, which must be within
+the rank error they report.
+"""
+# pylint: disable=protected-access
+
+import bisect
+import math
+import pytest
+from conftest import copy_database
+from data import FlightData
+from sketches import SKETCH_K, KLLSketch, build_sketches, rank_error
+
+QUANTILES = (0, 0.1, 0.5, 0.9, 0.99, 1)
+
+
+@pytest.fixture(name='exact_data')
+def fixture_exact_data(synthetic_db):
+    """FlightData that ignores the sketches."""
+    data_manager = FlightData(synthetic_db, query_cache_size=0)
+    data_manager.get_quantile_sketches = lambda: None
+    return data_manager
+
+
+def _expected(delays, quantiles):
+    """Smallest delay whose rank reaches each fraction, by sorting in Python."""
+    values = sorted(delays)
+    return [values[max(math.ceil(fraction * len(values)) - 1, 0)] for fraction in quantiles]
+
+
+@pytest.mark.parametrize('quantiles', [(0.5, 0.9, 0.99), (0, 0.25, 1)])
+def test_quantiles_of_all_flights(exact_data, quantiles):
+    """The quantiles of all flights match a full sort of the delays."""
+    delays = [row['DEPARTURE_DELAY'] for row in exact_data._execute_query(
+        "SELECT DEPARTURE_DELAY FROM flights "
+        "WHERE typeof(DEPARTURE_DELAY) IN ('integer', 'real')")]
+    (row,) = exact_data.get_delay_quantiles(None, None, quantiles)
+    assert row['flights'] == len(delays)
+    assert [row[f"p{fraction * 100:g}"] for fraction in quantiles] == \
+        _expected(delays, quantiles)
+    assert row['rank_error'] == 0
+
+
+def test_quantiles_per_airline(exact_data):
+    """Every airline gets its own quantiles, in key order."""
+    rows = exact_data.get_delay_quantiles('airline', None, (0.5,))
+    delays = {}
+    for flight in exact_data._execute_query(
+            "SELECT airlines.AIRLINE AS airline, DEPARTURE_DELAY FROM flights "
+            "JOIN airlines ON flights.AIRLINE = airlines.ID "
+            "WHERE typeof(DEPARTURE_DELAY) IN ('integer', 'real')"):
+        delays.setdefault(flight['airline'], []).append(flight['DEPARTURE_DELAY'])
+    assert [row['airline'] for row in rows] == sorted(delays)
+    for row in rows:
+        assert row['p50'] == _expected(delays[row['airline']], (0.5,))[0]
+
+
+def test_unknown_key_has_no_quantiles(exact_data):
+    """A key without flights returns no rows."""
+    assert exact_data.get_delay_quantiles('airport', 'NOPE') == []
+
+
+@pytest.fixture(scope='module', name='sketched_db')
+def fixture_sketched_db(synthetic_db, tmp_path_factory):
+    """Copy of the synthetic database with sketches built by the test."""
+    path = copy_database(synthetic_db, tmp_path_factory, 'sketched')
+    build_sketches(f'sqlite:///{path}')
+    return f'sqlite:///{path}'
+
+
+def _delays(data_manager, dimension):
+    """Sorted valid delays of every key of a dimension, read with SQL."""
+    key = {'airline': "airlines.AIRLINE", 'route': "ORIGIN_AIRPORT || '-' || DESTINATION_AIRPORT",
+           None: "''"}[dimension]
+    delays = {}
+    for name, delay in data_manager._execute_query(
+            f"SELECT {key}, DEPARTURE_DELAY FROM flights "
+            "JOIN airlines ON flights.AIRLINE = airlines.ID "
+            "WHERE typeof(DEPARTURE_DELAY) IN ('integer', 'real')", as_tuples=True):
+        delays.setdefault(name, []).append(delay)
+    return {name: sorted(values) for name, values in delays.items()}
+
+
+def _rank_distance(values, value, fraction):
+    """
+    Distance between the rank asked for and the ranks that value holds among
+    the sorted values, as a fraction of their number.
+    """
+    wanted = max(math.ceil(fraction * len(values)), 1)
+    first, last = bisect.bisect_left(values, value) + 1, bisect.bisect_right(values, value)
+    assert first <= last, f"{value} is not one of the delays"
+    return max(first - wanted, wanted - last, 0) / len(values)
+
+
+def _assert_within_rank_error(row, delays):
+    """Every quantile of a row is within the rank error it reports."""
+    assert row['flights'] == len(delays)
+    for fraction in QUANTILES:
+        distance = _rank_distance(delays, row[f"p{fraction * 100:g}"], fraction)
+        assert distance <= row['rank_error'], (fraction, distance)
+
+
+def test_compacted_sketches_are_within_rank_error(sketched_db):
+    """The quantiles of compacted per-airline sketches are within rank_error(k)."""
+    data_manager = FlightData(sketched_db, query_cache_size=0)
+    assert data_manager.get_quantile_sketches() is not None
+    delays = _delays(data_manager, 'airline')
+    rows = data_manager.get_delay_quantiles('airline', None, QUANTILES)
+    assert [row['airline'] for row in rows] == sorted(delays)
+    compacted = [row for row in rows if row['rank_error']]
+    assert compacted, "No sketch was compacted"
+    for row in compacted:
+        assert row['rank_error'] == round(rank_error(SKETCH_K), 4)
+        _assert_within_rank_error(row, delays[row['airline']])
+
+
+def test_merged_sketch_is_within_rank_error(sketched_db):
+    """The quantiles of all flights, from the merged sketches, are within rank_error(k)."""
+    data_manager = FlightData(sketched_db, query_cache_size=0)
+    (row,) = data_manager.get_delay_quantiles(None, None, QUANTILES)
+    assert row['rank_error'] == round(rank_error(SKETCH_K), 4)
+    _assert_within_rank_error(row, _delays(data_manager, None)[''])
+
+
+def test_exact_sketches_report_no_rank_error(sketched_db):
+    """Sketches of routes that were never compacted give the exact quantiles."""
+    data_manager = FlightData(sketched_db, query_cache_size=0)
+    sketched = data_manager.get_delay_quantiles('route', None, QUANTILES)
+    exact = [row for row in sketched if row['rank_error'] == 0]
+    assert exact, "Every route sketch was compacted"
+    data_manager.get_quantile_sketches = lambda: None
+    expected = {(row['origin_airport'], row['destination_airport']): row
+                for row in data_manager.get_delay_quantiles('route', None, QUANTILES)}
+    for row in exact:
+        assert row == expected[(row['origin_airport'], row['destination_airport'])]
+
+
+def test_sketch_of_few_values_is_exact():
+    """A sketch below the capacity of its level keeps every value."""
+    sketch = KLLSketch(rng=None)
+    sketch.update([5, 1, 4, 2, 3])
+    assert sketch.exact and sketch.count == 5
+    assert sketch.quantiles((0, 0.5, 1)) == [1, 3, 5]
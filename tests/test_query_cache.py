@@ -0,0 +1,100 @@
+"""
+Tests of the memoization of FlightData._execute_query(): repeated queries
+are served from the cache until the database file or its write-ahead log
+changes, and the hits and misses are counted.
+"""
+# pylint: disable=protected-access
+
+import os
+import sqlite3
+import pytest
+import metrics
+from conftest import copy_database
+from data import FlightData
+
+METHOD = 'get_flight_by_id'
+
+
+@pytest.fixture(name='cached')
+def fixture_cached(synthetic_db, tmp_path_factory):
+    """A memoizing FlightData on a copy of the database, and the copy's path."""
+    path = copy_database(synthetic_db, tmp_path_factory, 'query_cache')
+    return FlightData(f'sqlite:///{path}', query_cache_size=16), path
+
+
+def _flight_id(data_manager):
+    """ID of the first flight."""
+    return data_manager._execute_query("SELECT MIN(ID) AS id FROM flights")[0]['id']
+
+
+def _no_queries(data_manager, monkeypatch):
+    """Make any query that reaches SQLite fail the test."""
+    def connect(*_, **__):
+        raise AssertionError("The query reached SQLite")
+    monkeypatch.setattr(data_manager._engine, 'connect', connect)
+
+
+def test_repeated_query_is_served_from_the_cache(cached, monkeypatch):
+    """The second call reads the cache and gets its own copy of the rows."""
+    data_manager, _ = cached
+    flight_id = _flight_id(data_manager)
+    before = data_manager.query_cache_stats()
+    first = data_manager.get_flight_by_id(flight_id)
+    first[0]['AIRLINE'] = 'Changed by the caller'
+    with monkeypatch.context() as patch:
+        _no_queries(data_manager, patch)
+        second = data_manager.get_flight_by_id(flight_id)
+    assert second[0]['AIRLINE'] != 'Changed by the caller'
+    assert second == data_manager.get_flight_by_id(flight_id) and len(second) == 1
+    stats = data_manager.query_cache_stats()
+    assert stats['hits'] - before['hits'] == 2
+    assert stats['misses'] - before['misses'] == 1
+
+
+def test_cache_hits_and_misses_are_counted_per_method(cached):
+    """Every lookup is counted under the query method that made it."""
+    data_manager, _ = cached
+    flight_id = _flight_id(data_manager)
+    hits, misses = (metrics.QUERY_CACHE.value(METHOD, result) for result in ('hit', 'miss'))
+    for _ in range(3):
+        data_manager.get_flight_by_id(flight_id)
+    assert metrics.QUERY_CACHE.value(METHOD, 'miss') - misses == 1
+    assert metrics.QUERY_CACHE.value(METHOD, 'hit') - hits == 2
+
+
+def test_streamed_result_is_cached_once_read(cached, monkeypatch):
+    """A fully read stream fills the cache for the next call."""
+    data_manager, _ = cached
+    airport = data_manager._execute_query("SELECT MIN(ORIGIN_AIRPORT) AS a FROM flights")[0]['a']
+    streamed = list(data_manager.get_delayed_flights_by_airport(airport, stream=True))
+    _no_queries(data_manager, monkeypatch)
+    assert data_manager.get_delayed_flights_by_airport(airport) == streamed
+
+
+@pytest.mark.parametrize('journal_mode', ['DELETE', 'WAL'])
+def test_write_invalidates_the_cache(cached, journal_mode):
+    """
+    A write to the database file, or one still in the write-ahead log,
+    drops the memoized results.
+    """
+    data_manager, path = cached
+    flight_id = _flight_id(data_manager)
+    data_manager.get_flight_by_id(flight_id)
+    data_manager._engine.dispose()
+    connection = sqlite3.connect(path)
+    try:
+        connection.execute(f"PRAGMA journal_mode = {journal_mode}")
+        database_stat = os.stat(path)
+        with connection:
+            connection.execute("UPDATE flights SET DEPARTURE_DELAY = 999 WHERE ID = ?",
+                               (flight_id,))
+        if journal_mode == 'WAL':
+            # The change is only in the log while the connection is open
+            assert os.stat(path).st_mtime_ns == database_stat.st_mtime_ns
+            assert os.path.getsize(f'{path}-wal')
+        misses = data_manager.query_cache_stats()['misses']
+        assert data_manager.get_flight_by_id(flight_id)[0]['DEPARTURE_DELAY'] == 999
+        assert data_manager.query_cache_stats()['misses'] == misses + 1
+        assert data_manager.query_cache_stats()['entries'] == 1
+    finally:
+        connection.close()
@@ -0,0 +1,73 @@
+"""
+Tests of FlightData.refresh_rollups(): the rollup tables answer like the
+flights table, are not used once flights are written, and are rebuilt by the
+next refresh.
+"""
+# pylint: disable=protected-access
+
+import sqlite3
+from datetime import date
+from conftest import comparable, copy_database
+from data import FlightData
+
+START, END = date(2015, 3, 30), date(2015, 4, 12)
+# Query methods served from the rollup tables, with their arguments
+ROLLUP_CASES = (
+    ('get_top_delayed', ('route',)),
+    ('get_top_delayed', ('airline', 5, 10, START, END)),
+    ('get_flight_delays_heatmap', ()),
+    ('get_delayed_flights_average_per_route', ()),
+    ('get_delayed_flights_per_route_map_range', (START, END)),
+)
+
+
+def _results(data_manager):
+    """Comparable results of the methods served from the rollups."""
+    return [comparable(getattr(data_manager, name)(*args)) for name, args in ROLLUP_CASES]
+
+
+def _assert_matches_flights(data_manager):
+    """The results match those of the flights table."""
+    flights = FlightData(data_manager._engine.url, query_cache_size=0)
+    flights._has_rollups = False
+    assert _results(data_manager) == _results(flights)
+
+
+def test_refresh_rollups_tracks_writes(synthetic_db, tmp_path_factory):
+    """Rollups are rebuilt after flights of rolled-up days are changed."""
+    path = copy_database(synthetic_db, tmp_path_factory, 'rollups')
+    data_manager = FlightData(f'sqlite:///{path}', query_cache_size=0)
+    days = len(data_manager._execute_query("SELECT DISTINCT YEAR, MONTH, DAY FROM flights"))
+    # The copy has the tables but no recorded version, so they are rebuilt
+    assert data_manager._has_rollups and not data_manager._rollups_current()
+    assert data_manager.refresh_rollups() == days
+    assert data_manager._rollups_current()
+    assert FlightData(f'sqlite:///{path}')._rollups_current()
+    _assert_matches_flights(data_manager)
+    assert data_manager.refresh_rollups() == 0
+
+    with sqlite3.connect(path) as connection:
+        connection.execute(
+            "UPDATE flights SET DEPARTURE_DELAY = 90, CANCELLED = 0, DIVERTED = 0 "
+            "WHERE YEAR = ? AND MONTH = ? AND DAY = ?", (START.year, START.month, START.day))
+    assert not data_manager._rollups_current()
+    _assert_matches_flights(data_manager)
+    stale = _results(data_manager)
+
+    assert data_manager.refresh_rollups() == days
+    assert data_manager._rollups_current()
+    assert _results(data_manager) == stale
+    _assert_matches_flights(data_manager)
+
+
+def test_refresh_rollups_recomputes_given_days(synthetic_db, tmp_path_factory):
+    """Days passed in are recomputed and the rollups then count as current."""
+    path = copy_database(synthetic_db, tmp_path_factory, 'rollup_days')
+    data_manager = FlightData(f'sqlite:///{path}', query_cache_size=0)
+    data_manager.refresh_rollups()
+    with sqlite3.connect(path) as connection:
+        connection.execute("DELETE FROM flights WHERE YEAR = ? AND MONTH = ? AND DAY = ?",
+                           (END.year, END.month, END.day))
+    assert data_manager.refresh_rollups([(END.day, END.month, END.year)]) == 1
+    assert data_manager._rollups_current()
+    _assert_matches_flights(data_manager)
@@ -0,0 +1,113 @@
+"""
+Tests of FlightData.optimize_schema(): the normalized columns, triggers and
+indexes it adds, the query plans it reports, and that every query method
+answers the same before and after it, also for rows written afterwards
+without the normalized columns.
+"""
+# pylint: disable=protected-access
+
+import sqlite3
+from conftest import comparable, copy_database
+from data import (SCHEMA_INDEXES, SCHEMA_TRIGGERS, FlightData, is_full_scan,
+                  print_plan_report)
+
+NORMALIZED_COLUMNS = ('DELAY_MINUTES', 'IS_DELAYED', 'FLIGHT_DATE')
+
+
+def _unoptimized_copy(synthetic_db, tmp_path_factory, name):
+    """
+    Copy the synthetic database without the indexes, triggers, normalized
+    columns and rollup tables of optimize_schema() and refresh_rollups().
+    :return: Database URI of the copy.
+    """
+    path = copy_database(synthetic_db, tmp_path_factory, name)
+    with sqlite3.connect(path) as connection:
+        for table in ('route_rollup', 'route_day_rollup', 'rollup_days'):
+            connection.execute(f"DROP TABLE {table}")
+        for index in SCHEMA_INDEXES:
+            connection.execute(f"DROP INDEX {index}")
+        for trigger in SCHEMA_TRIGGERS:
+            connection.execute(f"DROP TRIGGER {trigger}")
+        for column in NORMALIZED_COLUMNS:
+            connection.execute(f"ALTER TABLE flights DROP COLUMN {column}")
+    return f'sqlite:///{path}'
+
+
+def _schema_names(data_manager, kind):
+    """Names of the indexes or triggers of the database."""
+    return {row['name'] for row in data_manager._execute_query(
+        "SELECT name FROM sqlite_master WHERE type = :kind", {'kind': kind})}
+
+
+def _results(data_manager, arguments):
+    """Comparable results of every query method."""
+    return {name: comparable(getattr(data_manager, name)(*args))
+            for name, args in arguments.items()}
+
+
+def test_optimize_schema_keeps_the_results(synthetic_db, tmp_path_factory, capsys):
+    """
+    The columns, triggers and indexes are added, the plans no longer scan
+    the flights table, and every query method returns what it did before.
+    """
+    data_manager = FlightData(_unoptimized_copy(synthetic_db, tmp_path_factory, 'optimize'),
+                              query_cache_size=0)
+    assert not data_manager._optimized
+    arguments = data_manager._sample_arguments()
+    before, plans_before = _results(data_manager, arguments), data_manager.query_plans()
+
+    data_manager.optimize_schema()
+    assert data_manager._optimized and FlightData(data_manager._engine.url)._optimized
+    assert all(data_manager._has_flight_column(column) for column in NORMALIZED_COLUMNS)
+    assert _schema_names(data_manager, 'index') >= set(SCHEMA_INDEXES)
+    assert _schema_names(data_manager, 'trigger') >= set(SCHEMA_TRIGGERS)
+    assert not data_manager._execute_query(
+        "SELECT ID FROM flights WHERE DELAY_MINUTES IS NULL OR IS_DELAYED IS NULL "
+        "OR FLIGHT_DATE IS NULL LIMIT 1")
+    assert _results(data_manager, arguments) == before
+
+    plans_after = data_manager.query_plans()
+    method = 'get_delayed_flights_by_airport'
+    assert any(is_full_scan(detail) for detail in plans_before[method])
+    assert not any(is_full_scan(detail) for detail in plans_after[method])
+    print_plan_report(plans_before, plans_after)
+    report = capsys.readouterr().out
+    assert all(f"{name}\n" in report for name in plans_after)
+    assert '<-- full scan' in report.split(f"{method}\n", 1)[1].split('after:', 1)[0]
+
+
+def test_rows_written_after_optimizing_are_normalized(synthetic_db, tmp_path_factory):
+    """Flights inserted or updated without the normalized columns count as delayed."""
+    data_manager = FlightData(_unoptimized_copy(synthetic_db, tmp_path_factory, 'written'),
+                              query_cache_size=0)
+    data_manager.optimize_schema()
+    path = data_manager._engine.url.database
+    with sqlite3.connect(path) as connection:
+        on_time, origin = connection.execute(
+            "SELECT ID, ORIGIN_AIRPORT FROM flights WHERE DEPARTURE_DELAY = 0 LIMIT 1").fetchone()
+        connection.execute("UPDATE flights SET DEPARTURE_DELAY = 90 WHERE ID = ?", (on_time,))
+        columns = [row[1] for row in connection.execute("PRAGMA table_info(flights)")
+                   if row[1] not in ('ID', *NORMALIZED_COLUMNS)]
+        inserted = connection.execute("SELECT MAX(ID) + 1 FROM flights").fetchone()[0]
+        connection.execute(
+            f"INSERT INTO flights (ID, {', '.join(columns)}) "
+            f"SELECT ?, {', '.join(columns)} FROM flights WHERE ID = ?", (inserted, on_time))
+    delayed = {row['FLIGHT_ID'] for row in data_manager.get_delayed_flights_by_airport(origin)}
+    assert {on_time, inserted} <= delayed
+
+    raw = FlightData(data_manager._engine.url, query_cache_size=0)
+    raw._optimized = raw._has_flight_date = False
+    arguments = data_manager._sample_arguments()
+    assert _results(data_manager, arguments) == _results(raw, arguments)
+
+
+def test_schema_without_triggers_is_read_raw(synthetic_db, tmp_path_factory):
+    """Normalized columns without their triggers may be stale, so they are not used."""
+    path = copy_database(synthetic_db, tmp_path_factory, 'no_triggers')
+    assert FlightData(f'sqlite:///{path}')._optimized
+    with sqlite3.connect(path) as connection:
+        connection.execute(f"DROP TRIGGER {next(iter(SCHEMA_TRIGGERS))}")
+    data_manager = FlightData(f'sqlite:///{path}')
+    assert not data_manager._optimized
+    assert data_manager._delayed_expr() == "COALESCE(NULLIF(flights.DEPARTURE_DELAY, ''), 0) > 20"
+
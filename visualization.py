@@ -4,7 +4,9 @@ This module contains functions for visualizing flight delay data. It includes:
 - Visualization of the number of delayed flights per airline.
 - Plotting the percentage of delayed flights per hour for a specific date.
 - Creating a heatmap of delayed flights for each route.
-- Generating a map showing delayed flights between airports.
+- Generating a map showing delayed flights between airports, either as one
+  GeoJSON layer with clustered airport markers or as one polyline per route.
+  Rendered maps are cached on disk per date.
 Dependencies:
 - matplotlib.pyplot
 - pandas
@@ -13,24 +15,49 @@ Dependencies:
 - datetime
 - data (FlightData class)
 """
+import hashlib
+import os
+import shutil
+import time
 from datetime import datetime
 import folium
+from folium.plugins import FastMarkerCluster
 import matplotlib.pyplot as plt
 import pandas as pd
 import seaborn as sns
 from data import FlightData
 
+MAP_FILE = 'delayed_flights_map.html'
+# Rendered maps, one file per date, mode and data version; next to this module
+# rather than in the working directory, unless FLIGHT_DATA_MAP_CACHE is set
+MAP_CACHE_DIR = os.environ.get(
+    'FLIGHT_DATA_MAP_CACHE',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'map_cache'))
+# 'geojson' draws all routes as one GeoJSON layer and clusters the airports;
+# 'polylines' adds one marker per airport and one polyline per route
+MAP_MODES = ('geojson', 'polylines')
+# Builds a clustered marker from a [latitude, longitude, IATA code] row
+AIRPORT_MARKER_CALLBACK = """
+function (row) {
+    var marker = L.marker(new L.LatLng(row[0], row[1]));
+    marker.bindPopup(row[2]);
+    return marker;
+}
+"""
+
 
-def visualize_delayed_flights_per_airline(data_manager):
+def visualize_delayed_flights_per_airline(data_manager, output_path=None):
     """
     Visualize the number of delayed flights per airline.
     :param data_manager: Instance of FlightData to fetch flight data.
+    :param output_path: Image file to save the chart to instead of showing it.
+    :return: True if the chart was saved to output_path.
     """
     results = data_manager.get_all_delayed_flights_grouped_by_airline()
 
     if not results:
         print("No results found.")
-        return
+        return False
 
     airlines = [result['AIRLINE'] for result in results]
     # Ensure delay_count is an integer
@@ -43,21 +70,40 @@ def visualize_delayed_flights_per_airline(data_manager):
     plt.title('Number of Delayed Flights per Airline')
     plt.xticks(rotation=90)
     plt.tight_layout()
-    plt.show()
+    return show_or_save(output_path)
+
+
+def show_or_save(output_path=None):
+    """
+    Show the current figure, or save it to a file and close it.
+    :param output_path: Image file to save the figure to, or None to show it.
+    :return: True if the figure was saved, False if it was shown.
+    """
+    if output_path is None:
+        plt.show()
+        return False
+    plt.savefig(output_path)
+    plt.close()
+    return True
 
 
 def calculate_percentage(delayed_count, total_count):
     """Calculate the percentage of delayed flights."""
     return (delayed_count / total_count * 100) if total_count > 0 else 0
 
-def plot_delayed_flights_per_hour(data_manager, date):
+def plot_delayed_flights_per_hour(data_manager, date, output_path=None):
     """
     Plot the percentage of delayed flights per hour of the day for a specific date.
     :param data_manager: Instance of FlightData to fetch flight data.
     :param date: Date for which to plot the data (datetime object).
+    :param output_path: Image file to save the chart to instead of showing it.
+    :return: True if the chart was saved to output_path.
     """
     day, month, year = date.day, date.month, date.year
     results = data_manager.get_delayed_flights_per_hour(day, month, year)
+    if not any(result['total_count'] for result in results):
+        print("No results found.")
+        return False
 
     # Extract hour, delayed counts, and total counts, ensure hours are integers
     hours = [int(result['hour']) for result in results]
@@ -96,28 +142,34 @@ def plot_delayed_flights_per_hour(data_manager, date):
     plt.title(f'Percentage of Delayed Flights per Hour on {date.strftime("%d/%m/%Y")}')
     plt.ylim(0, 100)  # Limit y-axis to 0-100%
     plt.tight_layout()
-    plt.show()
+    return show_or_save(output_path)
 
 
-def plot_delayed_flights_heatmap(data_manager):
+def plot_delayed_flights_heatmap(data_manager, output_path=None, top_n=None, min_flights=1):
     """
     Plot a heatmap showing the percentage of delayed flights for each route.
     :param data_manager: Instance of FlightData to fetch flight data.
+    :param output_path: Image file to save the chart to instead of showing it.
+    :param top_n: Only plot routes between the top_n busiest airports.
+    :param min_flights: Only plot routes with at least this many flights.
+    :return: True if the chart was saved to output_path.
     """
-    data = data_manager.get_flight_delays_heatmap()
+    matrix = data_manager.get_flight_delays_heatmap_matrix(top_n, min_flights)
+    if not len(matrix):
+        print("No results found.")
+        return False
 
-    pivot_table = data.pivot(index="origin_airport",
-                            columns="destination_airport",
-                            values="percentage")
+    pivot_table = pd.DataFrame(matrix.to_dense(), index=matrix.rows, columns=matrix.columns)
 
     plt.figure(figsize=(12, 10))
     sns.heatmap(pivot_table, cmap="coolwarm", fmt=".1f", linewidths=.5, cbar=True, annot=False)
     plt.title("Percentage of Delayed Flights (Heatmap of Routes)")
     plt.xlabel("Destination Airport")
     plt.ylabel("Origin Airport")
-    plt.show()
+    return show_or_save(output_path)
 
-def plot_delayed_flights_map(data_manager, day, month, year):
+def plot_delayed_flights_map(data_manager, day, month, year, mode='geojson',
+                             use_cache=True, output_path=MAP_FILE):
     """
     Generate and save an interactive map showing the percentage of 
     delayed flights between airports for a specific date.
@@ -127,31 +179,110 @@ def plot_delayed_flights_map(data_manager, day, month, year):
     day (int): The day of the month.
     month (int): The month.
     year (int): The year.
+    mode (str): 'geojson' to draw the routes as one GeoJSON layer with
+    clustered airport markers, 'polylines' for one polyline per route.
+    use_cache (bool): Reuse a map rendered earlier for the same date, mode
+    and database version.
+    output_path (str): HTML file to save the map to.
 
     Returns:
-    None. If flight data is not available or required columns are missing, 
-    it prints an error message. Otherwise, it saves the map as an HTML file 
+    tuple: (seconds, size in bytes) of the saved map, or None if flight data
+    is not available or required columns are missing, in which case it
+    prints an error message. Otherwise, it saves the map as an HTML file 
     and prints a success message.
     """
+    started = time.perf_counter()
+    cache_path = map_cache_path(data_manager, day, month, year, mode) if use_cache else None
+    if cache_path and os.path.exists(cache_path):
+        shutil.copyfile(cache_path, output_path)
+        print(f"Map has been saved to {output_path} from the cache.")
+        return report_map(started, output_path)
+
     flights = data_manager.get_delayed_flights_per_route_map(day, month, year)
     if not flights:
         print("No flight data available.")
-        return
+        return None
 
     new_data_frame = pd.DataFrame(flights)
     if not validate_data_frame(new_data_frame):
         print("Required columns are missing in the data.")
-        return
+        return None
 
     airport_locations = data_manager.get_airport_coordinates()
     if not airport_locations:
         print("No airport coordinates data available.")
-        return
+        return None
 
     new_flight_folium_map = create_map()
-    add_airport_markers(new_flight_folium_map, airport_locations)
-    add_flight_routes(new_flight_folium_map, new_data_frame, airport_locations)
-    save_map(new_flight_folium_map)
+    if mode == 'geojson':
+        add_airport_cluster(new_flight_folium_map, airport_locations)
+        add_route_layer(new_flight_folium_map, new_data_frame, airport_locations)
+    else:
+        add_airport_markers(new_flight_folium_map, airport_locations)
+        add_flight_routes(new_flight_folium_map, new_data_frame, airport_locations)
+    save_map(new_flight_folium_map, output_path)
+    if cache_path:
+        os.makedirs(MAP_CACHE_DIR, exist_ok=True)
+        shutil.copyfile(output_path, cache_path)
+    return report_map(started, output_path)
+
+
+def map_cache_path(data_manager, day, month, year, mode):
+    """
+    Return the cache file of a rendered map.
+
+    Parameters:
+    data_manager (FlightData): An instance of FlightData, whose data version
+    is part of the key so that maps are re-rendered after the data changes.
+    day (int): The day of the month.
+    month (int): The month.
+    year (int): The year.
+    mode (str): Rendering mode.
+
+    Returns:
+    str: Path of the cache file.
+    """
+    version = hashlib.sha1(data_manager.data_version().encode()).hexdigest()[:12]
+    return os.path.join(
+        MAP_CACHE_DIR,
+        f"delayed_flights_map_{int(year):04d}-{int(month):02d}-{int(day):02d}"
+        f"_{mode}_{version}.html")
+
+
+def report_map(started, map_file=MAP_FILE):
+    """
+    Print how long the map took and how large the saved file is.
+
+    Parameters:
+    started (float): time.perf_counter() value when generation started.
+    map_file (str): The saved HTML file.
+
+    Returns:
+    tuple: (seconds, size in bytes).
+    """
+    elapsed = time.perf_counter() - started
+    size = os.path.getsize(map_file)
+    print(f"Map generated in {elapsed:.2f}s, {size / 1024:.0f} KiB.")
+    return elapsed, size
+
+
+def compare_map_rendering(data_manager, day, month, year):
+    """
+    Render the map for a date in every mode without the cache and print
+    the generation time and HTML size of each.
+
+    Parameters:
+    data_manager (FlightData): An instance of FlightData to fetch flight data.
+    day (int): The day of the month.
+    month (int): The month.
+    year (int): The year.
+    """
+    results = {mode: plot_delayed_flights_map(data_manager, day, month, year, mode,
+                                              use_cache=False)
+               for mode in MAP_MODES}
+    for mode, result in results.items():
+        if result:
+            print(f"{mode:<10} {result[0]:>8.2f}s {result[1] / 1024:>10.0f} KiB")
 
 
 def validate_data_frame(data_frame):
@@ -185,16 +316,14 @@ def add_airport_markers(new_flight_folium_map, airport_locations):
 
     Parameters:
     new_flight_folium_map (folium.Map): The Folium map object.
-    airport_locations (dict): A dictionary with airport codes as keys and coordinates as values.
+    airport_locations (dict): A dictionary with airport codes as keys and coordinates as values,
+    as returned by FlightData.get_airport_coordinates(), which only includes valid coordinates.
     """
     for airport, coords in airport_locations.items():
-        if coords and all(isinstance(coord, (int, float)) for coord in coords):
-            folium.Marker(
-                location=[coords[0], coords[1]],
-                popup=airport
-            ).add_to(new_flight_folium_map)
-        else:
-            print(f"Invalid coordinates for airport {airport}: {coords}")
+        folium.Marker(
+            location=[coords[0], coords[1]],
+            popup=airport
+        ).add_to(new_flight_folium_map)
 
 
 def add_flight_routes(new_flight_folium_map, data_frame, airport_locations):
@@ -213,27 +342,96 @@ def add_flight_routes(new_flight_folium_map, data_frame, airport_locations):
 
         origin_coords = airport_locations.get(origin)
         dest_coords = airport_locations.get(destination)
-        if (origin_coords and dest_coords and
-                all(isinstance(coord, (int, float)) for coord in origin_coords) and
-                all(isinstance(coord, (int, float)) for coord in dest_coords)):
+        if origin_coords and dest_coords:
             folium.PolyLine(
                 locations=[origin_coords, dest_coords],
                 color=get_color_for_percentage(percentage),
                 weight=percentage / 10 + 1
             ).add_to(new_flight_folium_map)
         else:
-            print(f"Invalid coordinates for route {origin} -> {destination}: "
+            print(f"Missing coordinates for route {origin} -> {destination}: "
                   f"{origin_coords}, {dest_coords}")
 
 
-def save_map(new_flight_folium_map):
+def add_airport_cluster(new_flight_folium_map, airport_locations):
+    """
+    Add all airports to the Folium map as one clustered marker layer, built
+    in the browser from a single array of coordinates.
+
+    Parameters:
+    new_flight_folium_map (folium.Map): The Folium map object.
+    airport_locations (dict): A dictionary with airport codes as keys and coordinates as values.
+    """
+    FastMarkerCluster(
+        data=[[coords[0], coords[1], airport] for airport, coords in airport_locations.items()],
+        callback=AIRPORT_MARKER_CALLBACK,
+        name='Airports'
+    ).add_to(new_flight_folium_map)
+
+
+def route_style(feature):
+    """
+    Style a route feature by its percentage of delayed flights.
+
+    Parameters:
+    feature (dict): GeoJSON feature.
+
+    Returns:
+    dict: Leaflet path style.
+    """
+    percentage = feature['properties']['percentage']
+    return {'color': get_color_for_percentage(percentage),
+            'weight': round(percentage / 10 + 1, 1)}
+
+
+def add_route_layer(new_flight_folium_map, data_frame, airport_locations):
+    """
+    Add all flight routes to the Folium map as one GeoJSON FeatureCollection,
+    colored with get_color_for_percentage.
+
+    Parameters:
+    new_flight_folium_map (folium.Map): The Folium map object.
+    data_frame (pd.DataFrame): The DataFrame containing flight route data.
+    airport_locations (dict): A dictionary with airport codes as keys and coordinates as values.
+    """
+    origins = data_frame['origin_airport'].map(airport_locations)
+    destinations = data_frame['destination_airport'].map(airport_locations)
+    known = origins.notna() & destinations.notna()
+    if not known.all():
+        print(f"Skipped {int((~known).sum())} routes with missing airport coordinates.")
+
+    routes = data_frame[known]
+    features = [
+        {
+            'type': 'Feature',
+            'geometry': {'type': 'LineString',
+                         'coordinates': [[round(origin[1], 4), round(origin[0], 4)],
+                                         [round(destination[1], 4), round(destination[0], 4)]]},
+            'properties': {'route': f"{origin_code} - {destination_code}",
+                           'percentage': percentage},
+        }
+        for origin_code, destination_code, origin, destination, percentage
+        in zip(routes['origin_airport'], routes['destination_airport'],
+               origins[known], destinations[known],
+               routes['percentage'].astype(float).round(1))
+    ]
+    folium.GeoJson(
+        {'type': 'FeatureCollection', 'features': features},
+        name='Routes',
+        style_function=route_style,
+        tooltip=folium.GeoJsonTooltip(fields=['route', 'percentage'],
+                                      aliases=['Route', 'Delayed %'])
+    ).add_to(new_flight_folium_map)
+
+
+def save_map(new_flight_folium_map, map_file=MAP_FILE):
     """
     Save the Folium map to an HTML file.
 
     Parameters:
     new_flight_folium_map (folium.Map): The Folium map object.
+    map_file (str): The HTML file to write.
     """
-    map_file = 'delayed_flights_map.html'
     new_flight_folium_map.save(map_file)
     print(f"Map has been saved to {map_file}.")
 